@@ -3,12 +3,16 @@ from abc import ABC, abstractmethod
 import torch
 import torch.utils.data as data_utils
 
-from nflows import distributions, flows, transforms
+from nflows import distributions, flows
+
+from .compiled import CompiledInference
+from .linear import FoldableLinear
 
 class BaseFlow(ABC):
     """ABC for flow-type density estimation."""
 
-    def __init__(self, dimensions, flow_steps=5, lr=1e-3, epochs=100, batch_size=256, device=None):
+    def __init__(self, dimensions, flow_steps=5, lr=1e-3, epochs=100, batch_size=256, device=None,
+                 compile_inference=False):
 
         self.dimensions = dimensions
         self.flow_steps = flow_steps
@@ -16,6 +20,8 @@ class BaseFlow(ABC):
         self.epochs = epochs
         self.device = device
         self.lr = lr   
+        self.compile_inference = compile_inference
+        self._compiled = {}
         transform = self._create_transform()
 
         self.flow = flows.Flow(
@@ -26,15 +32,20 @@ class BaseFlow(ABC):
         self.flow.to(self.device)
 
     def _create_linear_transform(self):
-        return transforms.CompositeTransform([
-            transforms.RandomPermutation(features=self.dimensions),
-            transforms.LULinear(self.dimensions, identity_init=True)
-        ])
+        return FoldableLinear(self.dimensions)
 
     @abstractmethod
     def _create_transform(context_features=None):
         pass
 
+    def _inference(self, name, f):
+        """f, or with compile_inference its torch.compile'd version."""
+        if not self.compile_inference:
+            return f
+        if name not in self._compiled:
+            self._compiled[name] = CompiledInference(f)
+        return self._compiled[name]
+
     def fit(self, data, val_data=None):
 
         optimiser = torch.optim.Adam(
@@ -79,7 +90,7 @@ class BaseFlow(ABC):
     def score(self, data):
         with torch.no_grad():
             self.flow.eval()
-            return self.flow.log_prob(data)
+            return self._inference('log_prob', self.flow.log_prob)(data)
 
     def score_batch(self, dataset):
         loader = data_utils.DataLoader(
@@ -0,0 +1,43 @@
+import warnings
+
+import torch
+
+from ..gmm.likelihood import compile_errors
+
+
+class CompiledInference:
+    """
+    A function compiled with torch.compile for inference.
+
+    Falls back to calling the function eagerly, for good, if torch.compile
+    is missing or compilation fails. Errors the eager function raises as
+    well are the caller's and are re-raised. Only the wrapped function is
+    pickled.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.compiled = None
+        if hasattr(torch, 'compile'):
+            self.compiled = torch.compile(f, dynamic=True)
+
+    def __getstate__(self):
+        return {'f': self.f}
+
+    def __setstate__(self, state):
+        self.__init__(state['f'])
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except compile_errors() as e:
+                # Raises here if the arguments are at fault, not the compiler
+                result = self.f(*args, **kwargs)
+                warnings.warn(
+                    'torch.compile failed, running eagerly: {}'.format(e)
+                )
+                self.compiled = None
+                return result
+
+        return self.f(*args, **kwargs)
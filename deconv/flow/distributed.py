@@ -0,0 +1,88 @@
+"""
+Data-parallel training of the SVI flows over several CPU processes.
+
+Each process joins a gloo process group and runs the flow's own fit, which
+then shards the data with a DistributedSampler and averages gradients with
+DistributedDataParallel. Rank 0 writes the trained parameters back.
+"""
+import os
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+class Objective(torch.nn.Module):
+    """
+    The training objective of a VariationalAutoencoder as a module.
+
+    DistributedDataParallel only synchronises gradients of outputs of a
+    module's forward, so fit wraps this rather than the model.
+    """
+
+    def __init__(self, model, use_iwae, num_samples, estimator):
+        super().__init__()
+        self.model = model
+        self.use_iwae = use_iwae
+        self.num_samples = num_samples
+        self.estimator = estimator
+
+    def forward(self, inputs):
+        if self.use_iwae:
+            return self.model.log_prob_lower_bound(
+                inputs,
+                num_samples=self.num_samples,
+                estimator=self.estimator
+            )
+        return self.model.stochastic_elbo(
+            inputs,
+            num_samples=self.num_samples,
+            estimator=self.estimator
+        )
+
+
+def all_reduce_sum(value):
+    """Sum a float across ranks."""
+    t = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.item()
+
+
+def broadcast_from_root(value):
+    """The float value of rank 0, on every rank."""
+    t = torch.tensor([value if value is not None else 0.0], dtype=torch.float64)
+    dist.broadcast(t, src=0)
+    return t.item()
+
+
+def _worker(rank, world_size, port, flow, data, val_data, path):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    # Share the cores between the processes rather than oversubscribing
+    torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+
+    try:
+        flow.fit(data, val_data=val_data)
+        if rank == 0:
+            torch.save(flow.model.state_dict(), path)
+    finally:
+        dist.destroy_process_group()
+
+
+def fit_distributed(flow, data, val_data=None, processes=2, port=29500):
+    """Fit flow on processes gloo ranks and load the result into flow."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model.pt')
+        mp.spawn(
+            _worker,
+            args=(processes, port, flow, data, val_data, path),
+            nprocs=processes
+        )
+        flow.model.load_state_dict(torch.load(path))
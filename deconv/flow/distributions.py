@@ -1,8 +1,62 @@
+import math
+
 import torch
 from torch.distributions import MultivariateNormal
 
 from nflows import distributions
 
+
+def deconv_gaussian_log_prob(X, noise_l, context, half_log_det=None):
+    """
+    log N(X; context, noise_l noise_l^T) without building a distribution.
+
+    X and noise_l are (n, 1, d) and (n, 1, d, d) with a sample axis to
+    broadcast over, or match context row for row. context is (n, K, d) or
+    (n, d). In the broadcast case the K residuals of each row are solved as
+    the columns of a single triangular system. half_log_det is the per-row
+    log|noise_l|, computed from the diagonal if not given.
+    """
+    d = X.shape[-1]
+    residual = X - context
+
+    if noise_l.dim() == 4 and noise_l.shape[1] == 1:
+        white = torch.linalg.solve_triangular(
+            noise_l[:, 0], residual.transpose(-2, -1), upper=False
+        )    # n, d, K
+        maha = white.pow(2).sum(dim=-2)
+    else:
+        white = torch.linalg.solve_triangular(
+            noise_l, residual[..., None], upper=False
+        )[..., 0]
+        maha = white.pow(2).sum(dim=-1)
+
+    if half_log_det is None:
+        half_log_det = noise_l.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+
+    return -0.5 * (maha + d * math.log(2 * math.pi)) - half_log_det
+
+
+class SampleMajorNormal(distributions.StandardNormal):
+    """
+    Standard normal whose conditional draws are made sample by sample.
+
+    The noise of each sample index is one separate draw of shape
+    [context_size, ...], made in sample order. Drawing n samples in chunks
+    then makes the same sequence of draws as drawing them at once, on any
+    device, so a chunked estimate matches the unchunked one for a given
+    seed. That costs one draw per sample rather than one per call.
+    """
+
+    def _sample(self, num_samples, context):
+        if context is None:
+            return super()._sample(num_samples, context)
+
+        return torch.stack([
+            torch.randn(context.shape[0], *self._shape, device=context.device)
+            for _ in range(num_samples)
+        ], dim=1)
+
+
 class DeconvGaussianToyNoise(distributions.Distribution):
 
     def log_prob(self, inputs, context):
@@ -12,20 +66,53 @@ class DeconvGaussianToyNoise(distributions.Distribution):
         return MultivariateNormal(loc=torch.zeros_like(context), covariance_matrix=noise).log_prob(context)
 
 class DeconvGaussianToy(distributions.Distribution):
+    """
+    Gaussian noise model for the toy flows.
+
+    Inputs are (X, C) with noise covariances or, with factorised=True, the
+    (X, noise_l, log|C|, ...) batches of a FactorisedDeconvDataset with
+    return_factors=True, which are used without refactorising the noise.
+    """
+
+    def __init__(self, factorised=False):
+        super().__init__()
+        self.factorised = factorised
 
     def log_prob(self, inputs, context):
 
-        X, noise = inputs
+        X, noise = inputs[0], inputs[1]
+
+        if self.factorised:
+            return deconv_gaussian_log_prob(X, noise, context, inputs[2] / 2)
 
         return MultivariateNormal(loc=context, covariance_matrix=noise).log_prob(X)
 
 
 class DeconvGaussian(distributions.Distribution):
+    """
+    Gaussian noise model with per-row Cholesky factors of the covariance.
 
-    def log_prob(self, inputs, context):
+    Inputs are (X, noise_l) or, from a FactorisedDeconvDataset, (X, noise_l,
+    log|C|, ...), in which case the log-determinant is not recomputed. If
+    dtype is given, for example torch.float64, the likelihood is evaluated
+    in it and returned in the dtype of the context.
+    """
 
-        X, noise_l = inputs
+    def __init__(self, dtype=None):
+        super().__init__()
+        self.dtype = dtype
+
+    def log_prob(self, inputs, context):
 
-        return MultivariateNormal(loc=context, scale_tril=noise_l).log_prob(X)
+        X, noise_l = inputs[0], inputs[1]
+        half_log_det = inputs[2] / 2 if len(inputs) > 2 else None
 
+        if self.dtype is None or self.dtype == context.dtype:
+            return deconv_gaussian_log_prob(X, noise_l, context, half_log_det)
 
+        return deconv_gaussian_log_prob(
+            X.to(self.dtype),
+            noise_l.to(self.dtype),
+            context.to(self.dtype),
+            None if half_log_det is None else half_log_det.to(self.dtype)
+        ).to(context.dtype)
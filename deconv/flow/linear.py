@@ -0,0 +1,80 @@
+import torch
+import torch.nn.functional as F
+
+from nflows import transforms
+
+
+class FoldableLinear(transforms.CompositeTransform):
+    """
+    RandomPermutation followed by LULinear.
+
+    In train mode, or whenever gradients are enabled, this is the plain
+    composite. For inference, in eval mode under no_grad, both layers are
+    folded into one dense matrix, its inverse and the log|det|, so each
+    call is a single matmul. The fold is cached until the mode is set
+    again, a state dict is loaded or the module is moved; parameters
+    changed in place in eval mode need another call to eval(). The state
+    dict is the same as the composite's.
+    """
+
+    def __init__(self, features):
+        super().__init__([
+            transforms.RandomPermutation(features=features),
+            transforms.LULinear(features, identity_init=True)
+        ])
+        self._folded = None
+
+    def train(self, mode=True):
+        self._folded = None
+        return super().train(mode)
+
+    def _apply(self, fn, *args, **kwargs):
+        self._folded = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._folded = None
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def _fold(self):
+        # No parameter pointers or versions in the check, which
+        # torch.compile would guard on and recompile for
+        if self._folded is None:
+            permutation, lu = self._transforms
+            perm = permutation._permutation
+
+            with torch.no_grad():
+                # lu(x[perm]) = W x[perm] + b, so the permutation moves the
+                # columns of W and the rows of its inverse
+                weight, logabsdet = lu.weight_and_logabsdet()
+                folded = torch.empty_like(weight)
+                folded[:, perm] = weight
+
+                weight_inverse = lu.weight_inverse()
+                folded_inverse = torch.empty_like(weight_inverse)
+                folded_inverse[perm, :] = weight_inverse
+
+            self._folded = (
+                folded, folded_inverse, lu.bias.detach(), logabsdet
+            )
+
+        return self._folded
+
+    def _use_folded(self):
+        return not self.training and not torch.is_grad_enabled()
+
+    def forward(self, inputs, context=None):
+        if not self._use_folded():
+            return super().forward(inputs, context)
+
+        weight, _, bias, logabsdet = self._fold()
+        outputs = F.linear(inputs, weight, bias)
+        return outputs, logabsdet * outputs.new_ones(outputs.shape[0])
+
+    def inverse(self, inputs, context=None):
+        if not self._use_folded():
+            return super().inverse(inputs, context)
+
+        _, weight_inverse, bias, logabsdet = self._fold()
+        outputs = F.linear(inputs - bias, weight_inverse)
+        return outputs, -logabsdet * outputs.new_ones(outputs.shape[0])
@@ -3,15 +3,12 @@ Implementation of models based on
 C. M. Bishop, "Mixture Density Networks", NCRG Report (1994)
 """
 
-import numpy as np
 import torch
 import math
 
 from torch import nn
 from torch.nn import functional as F
 
-from nflows import utils
-
 class MultivariateGaussianDiagonalMDN(nn.Module):
     def __init__(self,
                  features,
@@ -51,44 +48,54 @@ class MultivariateGaussianDiagonalMDN(nn.Module):
 
         return logits, means, logvars
 
-    def log_prob(self, inputs, context):
-        logits, means, logvars = self.get_mixture_components(context)
-
-        tmp = torch.zeros(inputs.shape[0], self._num_components)
-        for i in range(self._num_components):
-            tmp[:, i] = torch.log(F.softmax(logits, dim=-1)[i]) - \
-                        0.5 * torch.sum(np.log(2*math.pi) + logvars[:, i, :] + (inputs - means[:, i, :])**2 / logvars[:, i, :].exp(), dim=1)
-
-        return torch.logsumexp(tmp, dim=-1)
+    def _log_prob(self, inputs, logits, means, logvars):
+        """
+        Mixture log density of inputs (..., features) given components with
+        the same leading shape, which are broadcast against each other.
+        """
+        log_weights = F.log_softmax(logits, dim=-1)
+        diff = inputs.unsqueeze(-2) - means    # ..., num_components, features
 
-    def sample(self, num_samples, context):
-        batch_size = context.shape[0]
+        log_normal = -0.5 * torch.sum(
+            math.log(2 * math.pi) + logvars + diff.pow(2) * torch.exp(-logvars),
+            dim=-1
+        )
+        return torch.logsumexp(log_weights + log_normal, dim=-1)
 
-        logits, means, logvars = self.get_mixture_components(context)
+    def _sample(self, num_samples, logits, means, logvars):
+        # One component per draw, [batch_size, num_samples]
+        choices = torch.distributions.Categorical(logits=logits).sample(
+            (num_samples,)
+        ).T
+        index = choices[:, :, None].expand(-1, -1, self._features)
 
-        choices = torch.distributions.categorical.Categorical(F.softmax(logits, dim=-1)).sample((num_samples,)).view(-1)
+        chosen_means = torch.gather(means, 1, index)
+        chosen_logvars = torch.gather(logvars, 1, index)
 
-        ix = utils.repeat_rows(torch.arange(batch_size), num_samples)
+        return chosen_means + torch.exp(0.5 * chosen_logvars) * torch.randn_like(chosen_logvars)
 
-        chosen_means = means[ix, choices, :]
-        chosen_logvars = logvars[ix, choices, :]
+    def log_prob(self, inputs, context):
+        """
+        Log density of [batch_size, features] inputs, or of
+        [batch_size, num_samples, features] inputs, against whose sample axis
+        the components of each context row are broadcast.
+        """
+        components = self.get_mixture_components(context)
+        if inputs.dim() == 3:
+            components = [c[:, None] for c in components]
+        return self._log_prob(inputs, *components)
 
-        samples = chosen_means + torch.exp(0.5 * chosen_logvars) * torch.randn_like(chosen_logvars)
-        return samples.reshape(batch_size, num_samples, self._features)
+    def sample(self, num_samples, context):
+        return self._sample(num_samples, *self.get_mixture_components(context))
 
     def sample_and_log_prob(self, num_samples, context):
-        samples = self.sample(num_samples, context)
-
-        if context is not None:
-            samples = utils.merge_leading_dims(samples, num_dims=2)
-            context = utils.repeat_rows(context, num_reps=num_samples)
-        
-        log_prob = self.log_prob(samples, context)
-        
-        if context is not None:
-            # Split the context dimension from sample dimension.
-            samples = utils.split_leading_dim(samples, shape=[-1, num_samples])
-            log_prob = utils.split_leading_dim(log_prob, shape=[-1, num_samples])
+        # The components are computed once and broadcast over the samples
+        logits, means, logvars = self.get_mixture_components(context)
+
+        samples = self._sample(num_samples, logits, means, logvars)
+        log_prob = self._log_prob(
+            samples, logits[:, None], means[:, None], logvars[:, None]
+        )
 
         return samples, log_prob
 
@@ -137,8 +144,11 @@ class MultivariateGaussianMDN(nn.Module):
         self._num_components = num_components
         self._num_upper_params = (features * (features - 1)) // 2
 
-        self._row_ix, self._column_ix = np.triu_indices(features, k=1)
-        self._diag_ix = range(features)
+        # Indices of the precision factors' entries, on the model's device.
+        row_ix, column_ix = torch.triu_indices(features, features, offset=1)
+        self.register_buffer('_row_ix', row_ix, persistent=False)
+        self.register_buffer('_column_ix', column_ix, persistent=False)
+        self.register_buffer('_diag_ix', torch.arange(features), persistent=False)
 
         # Modules
         self._hidden_net = hidden_net
@@ -161,20 +171,10 @@ class MultivariateGaussianMDN(nn.Module):
         if custom_initialization:
             self._initialize()
 
-    def get_mixture_components(self, context):
+    def _precision_factors(self, context):
         """
-        :param context: torch.Tensor [batch_size, input_dim]
-            The input to the MDN.
-        :return: tuple(
-            torch Tensor [batch_size, n_mixtures],
-            torch.Tensor [batch_size, n_mixtures, output_dim],
-            torch.Tensor [batch_size, n_mixtures, output_dim, output_dim],
-            torch.Tensor [1],
-            torch.Tensor [batch_size, n_mixtures, output_dim, output_dim]
-            )
-            Tuple containing logits, means, precisions,
-            sum of log diagonal of precision factors, and precision factors themselves.
-            Recall upper triangular precision factor A such that SIGMA^-1 = A^T A.
+        Logits, means, sum of log diagonal of precision factors and the
+        precision factors themselves; see get_mixture_components.
         """
 
         h = self._hidden_net(context)
@@ -197,53 +197,109 @@ class MultivariateGaussianMDN(nn.Module):
         diagonal = F.softplus(unconstrained_diagonal) + self._epsilon
 
         # Create empty precision factor matrix, and fill with appropriate quantities.
-        precision_factors = torch.zeros(
+        precision_factors = means.new_zeros(
             means.shape[0], self._num_components, self._features, self._features
         )
         precision_factors[..., self._diag_ix, self._diag_ix] = diagonal
         precision_factors[..., self._row_ix, self._column_ix] = upper
 
+        # The sum of the log diagonal of A is used in the likelihood calculation.
+        sumlogdiag = torch.sum(torch.log(diagonal), dim=-1)
+
+        return logits, means, sumlogdiag, precision_factors
+
+    def get_mixture_components(self, context):
+        """
+        :param context: torch.Tensor [batch_size, input_dim]
+            The input to the MDN.
+        :return: tuple(
+            torch Tensor [batch_size, n_mixtures],
+            torch.Tensor [batch_size, n_mixtures, output_dim],
+            torch.Tensor [batch_size, n_mixtures, output_dim, output_dim],
+            torch.Tensor [1],
+            torch.Tensor [batch_size, n_mixtures, output_dim, output_dim]
+            )
+            Tuple containing logits, means, precisions,
+            sum of log diagonal of precision factors, and precision factors themselves.
+            Recall upper triangular precision factor A such that SIGMA^-1 = A^T A.
+        """
+        logits, means, sumlogdiag, precision_factors = self._precision_factors(context)
+
         # Precisions are given by SIGMA^-1 = A^T A.
         precisions = torch.matmul(
             torch.transpose(precision_factors, 2, 3), precision_factors
         )
 
-        # The sum of the log diagonal of A is used in the likelihood calculation.
-        sumlogdiag = torch.sum(torch.log(diagonal), dim=-1)
-
         return logits, means, precisions, sumlogdiag, precision_factors
 
+    def _log_prob(self, inputs, logits, means, sumlogdiag, precision_factors):
+        """
+        Mixture log density of inputs [batch_size, output_dim], or of inputs
+        [batch_size, num_samples, output_dim] under the components of their
+        row. The samples are the columns of one product with each precision
+        factor, which is never repeated per sample.
+        """
+        if inputs.dim() == 2:
+            return self._log_prob(
+                inputs[:, None], logits, means, sumlogdiag, precision_factors
+            )[:, 0]
+
+        output_dim = means.shape[-1]
+
+        # Split up evaluation into parts. The quadratic form is |A (x - mu)|^2.
+        a = logits - torch.logsumexp(logits, dim=-1, keepdim=True)
+        b = -(output_dim / 2.0) * math.log(2 * math.pi)
+        c = sumlogdiag
+        d1 = (inputs[:, None, :, :] - means[:, :, None, :]).transpose(-2, -1)
+        d = -0.5 * torch.matmul(precision_factors, d1).pow(2).sum(-2)   # n, K, S
+
+        return torch.logsumexp((a + b + c)[:, :, None] + d, dim=1)
+
     def log_prob(self, inputs, context=None):
         """
         Evaluates log p(inputs | context), where p is a multivariate mixture of Gaussians
         with mixture coefficients, means, and precisions given as a neural network function.
         :param inputs: torch.Tensor [batch_size, input_dim]
-            Input variable.
+            Input variable, or [batch_size, num_samples, input_dim], in which
+            case the components of each context row are broadcast over the
+            samples.
         :param context: torch.Tensor [batch_size, context_dim]
             Conditioning variable.
         :return: torch.Tensor [1]
             Log probability of inputs given context under model.
         """
+        components = self._precision_factors(context)
+        if inputs.dim() == 3:
+            return self._log_prob(inputs, *components)
+        return self._log_prob(inputs.reshape(-1, self._features), *components)
 
-        # Get necessary quantities.
-        logits, means, precisions, sumlogdiag, _ = self.get_mixture_components(context)
+    def _sample(self, num_samples, logits, means, precision_factors):
+        batch_size, n_mixtures, output_dim = means.shape
 
-        batch_size, n_mixtures, output_dim = means.size()
-        inputs = inputs.view(-1, 1, output_dim)
+        # Choose num_samples mixture components per example in the batch.
+        choices = torch.multinomial(
+            F.softmax(logits, dim=-1), num_samples=num_samples, replacement=True
+        )  # [batch_size, num_samples]
 
-        # Split up evaluation into parts.
-        a = logits - torch.logsumexp(logits, dim=-1, keepdim=True)
-        b = -(output_dim / 2.0) * np.log(2 * np.pi)
-        c = sumlogdiag
-        d1 = (inputs.expand_as(means) - means).view(
-            batch_size, n_mixtures, output_dim, 1
-        )
-        d2 = torch.matmul(precisions, d1)
-        d = -0.5 * torch.matmul(torch.transpose(d1, 2, 3), d2).view(
-            batch_size, n_mixtures
+        # Select means and precision factors, only for the chosen components.
+        chosen_means = torch.gather(
+            means, 1, choices[:, :, None].expand(-1, -1, output_dim)
         )
+        chosen_precision_factors = torch.gather(
+            precision_factors,
+            1,
+            choices[:, :, None, None].expand(-1, -1, output_dim, output_dim)
+        )  # [batch_size, num_samples, output_dim, output_dim]
 
-        return torch.logsumexp(a + b + c + d, dim=-1)
+        # Batch triangular solve to multiply standard normal samples by inverse
+        # of upper triangular precision factor.
+        zero_mean_samples = torch.linalg.solve_triangular(
+            chosen_precision_factors,
+            torch.randn_like(chosen_means).unsqueeze(-1),
+            upper=True
+        ).squeeze(-1)
+
+        return chosen_means + zero_mean_samples
 
     def sample(self, num_samples, context):
         """
@@ -257,64 +313,19 @@ class MultivariateGaussianMDN(nn.Module):
         :return: torch.Tensor [batch_size, num_samples, output_dim]
             Batch of generated samples.
         """
+        logits, means, _, precision_factors = self._precision_factors(context)
+        return self._sample(num_samples, logits, means, precision_factors)
+    
+    def sample_and_log_prob(self, num_samples, context=None):
+        # The components are computed once and broadcast over the samples,
+        # rather than recomputed for a context repeated num_samples times.
+        logits, means, sumlogdiag, precision_factors = self._precision_factors(context)
 
-        # Get necessary quantities.
-        logits, means, _, _, precision_factors = self.get_mixture_components(context)
-        batch_size, n_mixtures, output_dim = means.shape
-
-        # We need (batch_size * num_samples) samples in total.
-        means, precision_factors = (
-            utils.repeat_rows(means, num_samples),
-            utils.repeat_rows(precision_factors, num_samples),
-        )
-
-        # Normalize the logits for the coefficients.
-        coefficients = F.softmax(logits, dim=-1)  # [batch_size, num_components]
-
-        # Choose num_samples mixture components per example in the batch.
-        choices = torch.multinomial(
-            coefficients, num_samples=num_samples, replacement=True
-        ).view(
-            -1
+        samples = self._sample(num_samples, logits, means, precision_factors)
+        log_prob = self._log_prob(
+            samples, logits, means, sumlogdiag, precision_factors
         )  # [batch_size, num_samples]
 
-        # Create dummy index for indexing means and precision factors.
-        ix = utils.repeat_rows(torch.arange(batch_size), num_samples)
-
-        # Select means and precision factors.
-        chosen_means = means[ix, choices, :]
-        chosen_precision_factors = precision_factors[ix, choices, :, :]
-
-        # Batch triangular solve to multiply standard normal samples by inverse
-        # of upper triangular precision factor.
-        zero_mean_samples, _ = torch.triangular_solve(
-            torch.randn(
-                batch_size * num_samples, output_dim, 1
-            ),  # Need dummy final dimension.
-            chosen_precision_factors,
-        )
-
-        # Mow center samples at chosen means, removing dummy final dimension
-        # from triangular solve.
-        samples = chosen_means + zero_mean_samples.squeeze(-1)
-
-        return samples.reshape(batch_size, num_samples, output_dim)
-    
-    def sample_and_log_prob(self, num_samples, context=None):
-        
-        samples = self.sample(num_samples, context)
-        
-        if context is not None:
-            samples = utils.merge_leading_dims(samples, num_dims=2)
-            context = utils.repeat_rows(context, num_reps=num_samples)
-        
-        log_prob = self.log_prob(samples, context)
-        
-        if context is not None:
-            # Split the context dimension from sample dimension.
-            samples = utils.split_leading_dim(samples, shape=[-1, num_samples])
-            log_prob = utils.split_leading_dim(log_prob, shape=[-1, num_samples])
-        
         return samples, log_prob
 
     def _initialize(self):
@@ -28,9 +28,14 @@ class DeconvInputEncoder(nn.Module):
         )
 
     def forward(self, inputs):
-        x, noise_l = inputs
+        x, noise_l = inputs[0], inputs[1]
 
-        x = torch.cat((x, noise_l[:, self.idx[0], self.idx[1]]), dim=1)
+        if len(inputs) > 3:
+            noise_tril = inputs[3]
+        else:
+            noise_tril = noise_l[:, self.idx[0], self.idx[1]]
+
+        x = torch.cat((x, noise_tril), dim=1)
 
         return self.resnet(x)
 
@@ -0,0 +1,86 @@
+"""
+Precision policies for the SVI flows.
+
+The experiment scripts set float64 as the default tensor type, so without a
+policy every network runs in float64. A policy runs the networks (the flow
+MADEs and the inputs encoder) in a cheaper dtype and evaluates the
+likelihood, the sum of the ELBO terms and the logsumexp of the importance
+weights in a wider one.
+"""
+import contextlib
+
+import torch
+from torch import nn
+
+
+def _to_float32(module, inputs, output):
+    return output.float()
+
+
+class PrecisionPolicy:
+    """
+    networks is float64, float32 or bfloat16. With bfloat16 the parameters
+    are float32 and only the matmuls of the linear layers run in bfloat16,
+    under autocast; their outputs are cast back, so activations and the
+    log-determinants of the flows are float32. accumulate is the dtype of
+    the likelihood and of the reductions over samples.
+    """
+
+    def __init__(self, networks=torch.float32, accumulate=torch.float64):
+        self.networks = networks
+        self.accumulate = accumulate
+
+    @property
+    def param_dtype(self):
+        if self.networks == torch.bfloat16:
+            return torch.float32
+        return self.networks
+
+    def apply(self, module):
+        """Cast module's parameters and hook its linear layers in place."""
+        module.to(self.param_dtype)
+        if self.networks == torch.bfloat16:
+            for m in module.modules():
+                if isinstance(m, nn.Linear):
+                    m.register_forward_hook(_to_float32)
+        return module
+
+    @contextlib.contextmanager
+    def networks_context(self, device_type):
+        """Default dtype of the parameters, and autocast for bfloat16."""
+        default = torch.get_default_dtype()
+        torch.set_default_dtype(self.param_dtype)
+        try:
+            if self.networks == torch.bfloat16:
+                with torch.autocast(device_type, dtype=torch.bfloat16):
+                    yield
+            else:
+                yield
+        finally:
+            torch.set_default_dtype(default)
+
+    def cast(self, inputs, dtype):
+        return [
+            i.to(dtype) if torch.is_floating_point(i) else i for i in inputs
+        ]
+
+    def __repr__(self):
+        return 'PrecisionPolicy(networks={}, accumulate={})'.format(
+            self.networks, self.accumulate
+        )
+
+
+POLICIES = {
+    'fp64': PrecisionPolicy(torch.float64, torch.float64),
+    'fp32': PrecisionPolicy(torch.float32, torch.float64),
+    'bf16': PrecisionPolicy(torch.bfloat16, torch.float32),
+}
+
+
+def get_policy(precision):
+    """None, a PrecisionPolicy or one of the names in POLICIES."""
+    if precision is None or isinstance(precision, PrecisionPolicy):
+        return precision
+    if precision not in POLICIES:
+        raise ValueError('Unknown precision: {}'.format(precision))
+    return POLICIES[precision]
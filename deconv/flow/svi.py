@@ -1,25 +1,38 @@
 import torch
+import torch.distributed as dist
 import torch.utils.data as data_utils
+from torch.nn.parallel import DistributedDataParallel
 from torch.nn.utils import clip_grad_norm_
+from torch.utils.data.distributed import DistributedSampler
 
 from nflows import flows, transforms, utils
 from nflows.distributions import ConditionalDiagonalNormal, StandardNormal
 
-from .distributions import DeconvGaussian
+from .distributed import (
+    Objective, all_reduce_sum, broadcast_from_root, fit_distributed,
+    is_distributed
+)
+from .distributions import DeconvGaussian, SampleMajorNormal
 from .maf import MAFlow
 from .nn import DeconvInputEncoder
 from .vae import VariationalAutoencoder
 
 
-from ..utils.sampling import minibatch_sample
+from ..utils.sampling import (
+    iter_sample_chunks, minibatch_sample, write_sample_chunks
+)
+from ..utils.summary import summarise_chunks
 
 class SVIFlow(MAFlow):
 
     def __init__(self, dimensions, flow_steps, lr, epochs, context_size=64, hidden_features=128,
                  batch_size=256, kl_warmup=0.2, kl_init_factor=0.5,
-                 n_samples=50, grad_clip_norm=None, use_iwae=False, device=None):
+                 n_samples=50, grad_clip_norm=None, use_iwae=False,
+                 estimator='standard', device=None, compile_inference=False,
+                 precision=None):
         super().__init__(
-            dimensions, flow_steps, lr, epochs, batch_size, device
+            dimensions, flow_steps, lr, epochs, batch_size, device,
+            compile_inference=compile_inference
         )
         self.context_size = context_size
         self.hidden_features = hidden_features
@@ -29,12 +42,14 @@ class SVIFlow(MAFlow):
         self.n_samples = n_samples
         self.grad_clip_norm = grad_clip_norm
         self.use_iwae = use_iwae
+        self.estimator = estimator
 
         self.model = VariationalAutoencoder(
             prior=self._create_prior(),
             approximate_posterior=self._create_approximate_posterior(),
             likelihood=self._create_likelihood(),
-            inputs_encoder=self._create_input_encoder()
+            inputs_encoder=self._create_input_encoder(),
+            precision=precision
         )
 
         self.model.to(self.device)
@@ -55,7 +70,7 @@ class SVIFlow(MAFlow):
 
     def _create_approximate_posterior(self):
 
-        distribution = StandardNormal((self.dimensions,))
+        distribution = SampleMajorNormal((self.dimensions,))
 
         posterior_transform = self._create_transform(self.context_size, hidden_features=self.hidden_features)
 
@@ -80,32 +95,56 @@ class SVIFlow(MAFlow):
 
 
     def fit(self, data, val_data=None):
+        """
+        Fit the model, data-parallel if a process group is initialised.
+
+        In that case each rank trains on its shard of data with gradients
+        averaged by DistributedDataParallel, rank 0 alone scores val_data
+        and its loss is broadcast so that every rank's scheduler makes the
+        same decisions. See fit_distributed.
+        """
+        distributed = is_distributed()
+        root = not distributed or dist.get_rank() == 0
 
         optimiser = torch.optim.Adam(
             params=self.model.parameters(),
             lr=self.lr
         )
 
-        loader = data_utils.DataLoader(
-            data,
-            batch_size=self.batch_size,
-            shuffle=True,
-            num_workers=4,
-            pin_memory=True
+        objective_f = Objective(
+            self.model, self.use_iwae, self.n_samples, self.estimator
         )
 
+        if distributed:
+            sampler = DistributedSampler(data)
+            loader = data_utils.DataLoader(
+                data,
+                batch_size=self.batch_size,
+                sampler=sampler
+            )
+            objective_f = DistributedDataParallel(objective_f)
+        else:
+            loader = data_utils.DataLoader(
+                data,
+                batch_size=self.batch_size,
+                shuffle=True,
+                num_workers=4,
+                pin_memory=True
+            )
+
         scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
             optimiser,
             mode='max',
             factor=0.8,
             patience=20,
-            verbose=True,
             threshold=1e-6
         )
         
         for i in range(self.epochs):
 
             self.model.train()
+            if distributed:
+                sampler.set_epoch(i)
 
             train_loss = 0.0
 
@@ -121,16 +160,7 @@ class SVIFlow(MAFlow):
                 else:
                     torch.set_default_tensor_type(torch.FloatTensor)
                 
-                if self.use_iwae:
-                    objective = self.model.log_prob_lower_bound(
-                        d,
-                        num_samples=self.n_samples
-                    )
-                else:
-                    objective = self.model.stochastic_elbo(
-                        d,
-                        num_samples=self.n_samples
-                    )
+                objective = objective_f(d)
                 torch.set_default_tensor_type(torch.FloatTensor)
 
                 train_loss += torch.sum(objective).item()
@@ -142,26 +172,38 @@ class SVIFlow(MAFlow):
                         self.grad_clip_norm
                     )
                 optimiser.step()
-                
+
+            if distributed:
+                train_loss = all_reduce_sum(train_loss)
             train_loss /= len(data)
             
             if val_data:
-                val_loss = self.score_batch(
-                    val_data,
-                    log_prob=self.use_iwae,
-                    num_samples=self.n_samples
-                ) / len(val_data)
-                print('Epoch {}, Train Loss: {}, Val Loss: {}'.format(
-                    i,
-                    train_loss,
-                    val_loss
-                ))
+                val_loss = None
+                if root:
+                    val_loss = self.score_batch(
+                        val_data,
+                        log_prob=self.use_iwae,
+                        num_samples=self.n_samples
+                    ) / len(val_data)
+                if distributed:
+                    val_loss = broadcast_from_root(val_loss)
+                if root:
+                    print('Epoch {}, Train Loss: {}, Val Loss: {}'.format(
+                        i,
+                        train_loss,
+                        val_loss
+                    ))
                 scheduler.step(val_loss)
             else:
-                print('Epoch {}, Train Loss: {}'.format(i, train_loss))
+                if root:
+                    print('Epoch {}, Train Loss: {}'.format(i, train_loss))
                 scheduler.step(train_loss)
 
-    def score(self, data, log_prob=False, num_samples=None):
+    def fit_distributed(self, data, val_data=None, processes=2, port=29500):
+        """Fit over processes CPU ranks with gloo; see distributed.py."""
+        fit_distributed(self, data, val_data, processes=processes, port=port)
+
+    def score(self, data, log_prob=False, num_samples=None, chunk_size=None):
         
         if not num_samples:
             num_samples = self.n_samples
@@ -176,11 +218,16 @@ class SVIFlow(MAFlow):
                 torch.set_default_tensor_type(torch.FloatTensor)
 
             if log_prob:
-                return self.model.log_prob_lower_bound(data, num_samples=num_samples)
+                return self._inference(
+                    'log_prob_lower_bound', self.model.log_prob_lower_bound
+                )(data, num_samples=num_samples, chunk_size=chunk_size)
             else:
-                return self.model.stochastic_elbo(data, num_samples=num_samples)
+                return self._inference(
+                    'stochastic_elbo', self.model.stochastic_elbo
+                )(data, num_samples=num_samples)
 
-    def score_batch(self, dataset, log_prob=False, num_samples=None):
+    def score_batch(self, dataset, log_prob=False, num_samples=None,
+                    chunk_size=None):
         loader = data_utils.DataLoader(
             dataset,
             batch_size=self.batch_size,
@@ -191,15 +238,17 @@ class SVIFlow(MAFlow):
 
         for j, d in enumerate(loader):
             d = [a.to(self.device) for a in d]
-            score += torch.sum(self.score(d, log_prob, num_samples)).item()
+            score += torch.sum(
+                self.score(d, log_prob, num_samples, chunk_size)
+            ).item()
 
         return score
 
     def sample_prior(self, num_samples, device=torch.device('cpu')):
-        with torch.no_grad():
+        with torch.no_grad(), self.model._networks():
             self.model.eval()
             return minibatch_sample(
-                self.model._prior.sample,
+                self._inference('sample_prior', self.model._prior.sample),
                 num_samples,
                 self.dimensions,
                 self.batch_size,
@@ -209,52 +258,123 @@ class SVIFlow(MAFlow):
     def sample_posterior(self, x, num_samples, device=torch.device('cpu')):
         with torch.no_grad():
             self.model.eval()
-            context = self.model._inputs_encoder(x)
-            return minibatch_sample(
-                self.model._approximate_posterior.sample,
-                num_samples,
-                self.dimensions,
-                self.batch_size,
-                device,
-                context=context
-            )
-        
-    def _resample_posterior(self, x, num_samples, context):
+            context = self._inference(
+                'encoder', self.model._posterior_context
+            )(x)
+            with self.model._networks():
+                return minibatch_sample(
+                    self._inference(
+                        'sample_posterior', self.model._approximate_posterior.sample
+                    ),
+                    num_samples,
+                    self.dimensions,
+                    self.batch_size,
+                    device,
+                    context=context
+                )
         
-        samples, log_q_z = self.model._approximate_posterior.sample_and_log_prob(
+    def iter_posterior_samples(self, x, num_samples, star_chunk_size=None,
+                               sample_chunk_size=None,
+                               device=torch.device('cpu')):
+        """
+        Yield posterior samples in chunks over stars and samples.
+
+        The encoder runs once per star chunk. See iter_sample_chunks.
+        """
+        self.model.eval()
+
+        @torch.no_grad()
+        def encode(x_chunk):
+            return self.model._posterior_context(
+                [a.to(self.device) for a in x_chunk]
+            )
+
+        @torch.no_grad()
+        def sample(context, n):
+            with self.model._networks():
+                return self.model._approximate_posterior.sample(
+                    n, context=context
+                )
+
+        return iter_sample_chunks(
+            sample,
+            x,
             num_samples,
-            context=context
+            star_chunk_size or self.batch_size,
+            sample_chunk_size or self.batch_size,
+            prepare=encode,
+            device=device
         )
-        samples = utils.merge_leading_dims(samples, num_dims=2)
-        log_q_z = utils.merge_leading_dims(log_q_z, num_dims=2)
 
-        # Compute log prob of latents under the prior.
-        log_p_z = self.model._prior.log_prob(samples)
+    def sample_posterior_to_file(self, x, num_samples, path,
+                                 star_chunk_size=None,
+                                 sample_chunk_size=None):
+        """Stream posterior samples into a .npy memmap or HDF5 file."""
+        return write_sample_chunks(
+            self.iter_posterior_samples(
+                x, num_samples, star_chunk_size, sample_chunk_size
+            ),
+            path,
+            len(x[0]),
+            num_samples,
+            self.dimensions
+        )
 
-        # Compute log prob of inputs under the decoder,
-        # --- SR: fix bug: reapeat_rows needs torch.tensor input, not list (as previous input) ---
-        # ---     also log_probs expects inputs to be a tuple of data and corresponding errors ---
-        x = (utils.repeat_rows(x_i, num_reps=num_samples) for x_i in x)   # modified into tuple
+    def summarise_posterior(self, x, num_samples, quantiles=(0.16, 0.5, 0.84),
+                            star_chunk_size=None, sample_chunk_size=None,
+                            bins=256):
+        """
+        Posterior means, covariances and marginal quantiles for each star.
+
+        The samples are reduced as they are drawn and never stored; see
+        PosteriorSummary. Quantiles are (len(quantiles), n, d).
+        """
+        return summarise_chunks(
+            self.iter_posterior_samples(
+                x, num_samples, star_chunk_size, sample_chunk_size
+            ),
+            len(x[0]),
+            self.dimensions,
+            quantiles=quantiles,
+            bins=bins
+        )
+
+    def _resample_posterior(self, x, num_samples, context):
+
+        with self.model._networks():
+            samples, log_q_z = self.model._approximate_posterior.sample_and_log_prob(
+                num_samples,
+                context=context
+            )   # n, num_samples, ...
+
+            # Compute log prob of latents under the prior.
+            log_p_z = utils.split_leading_dim(
+                self.model._prior.log_prob(
+                    utils.merge_leading_dims(samples, num_dims=2)
+                ),
+                [-1, num_samples]
+            )
+
+        # Compute log prob of inputs under the decoder, broadcasting the
+        # inputs over the sample axis.
+        x = tuple(x_i.unsqueeze(1) for x_i in x)
         log_p_x = self.model._likelihood.log_prob(x, context=samples)
 
         # Compute ELBO.
         log_w = log_p_x + log_p_z - log_q_z
-        log_w = utils.split_leading_dim(log_w, [-1, num_samples])
         log_w -= torch.logsumexp(log_w, dim=-1)[:, None]
-        
-        samples = utils.split_leading_dim(samples, [-1, num_samples])
+
         idx = torch.distributions.Categorical(logits=log_w).sample([num_samples])
-        
+
         return samples[
-            torch.arange(len(x), device=self.device)[:, None, None],
-            idx.T[:, :, None],
-            torch.arange(self.dimensions, device=self.device)[None, None, :]
+            torch.arange(samples.shape[0], device=samples.device)[:, None],
+            idx.T
         ]
-    
+
     def resample_posterior(self, x, num_samples, device=torch.device('cpu')):
         with torch.no_grad():
             self.model.eval()
-            context = self.model._inputs_encoder(x)
+            context = self.model._posterior_context(x)
             
             return minibatch_sample(
                 self._resample_posterior,
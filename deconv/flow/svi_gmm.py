@@ -25,10 +25,11 @@ class GMMPosterior():
         self.module = gmm.module
         
     def sample_and_log_prob(self, num_samples, context):
-        x, L = context
+        x, L = context[0], context[1]
         cov = torch.matmul(L, L.transpose(-1, -2))
-        samples = self.gmm._sample_posterior((x, cov), num_samples)
-        log_prob = self.gmm.posterior_log_prob(samples, (x, cov))
+        posterior = self.gmm.posterior((x, cov))
+        samples = posterior.sample(num_samples)
+        log_prob = posterior.log_prob(samples)
         return samples, log_prob
         
     
@@ -7,6 +7,7 @@ from nflows import flows, transforms
 from nflows.distributions import ConditionalDiagonalNormal, StandardNormal
 
 from .distributions import DeconvGaussian, DeconvGaussianToy, DeconvGaussianToyNoise
+from .linear import FoldableLinear
 from .maf import MAFlow
 from .nn import DeconvInputEncoder
 from .vae import VariationalAutoencoder, VariationalAutoencoderToyNoise
@@ -70,14 +71,13 @@ class SVIFlowToyNoise(nn.Module):
             # w, noise_covar = data
             # x = torch.cat((w, noise_covar[:, self.idx[0], self.idx[1]]), dim=1)
             # return self.diagonal_mdn.get_context(x)
-            w, _ = data
+            w = data[0]
             return w
 
         return input_encoder
 
     def _create_linear_transform(self):
-        return transforms.CompositeTransform([transforms.RandomPermutation(features=self.dimensions),
-                                              transforms.LULinear(self.dimensions, identity_init=True)])
+        return FoldableLinear(self.dimensions)
 
     def _create_transform(self, flow_steps, context_features=None):
         return transforms.CompositeTransform([transforms.CompositeTransform([self._create_linear_transform(),
@@ -95,10 +95,12 @@ class SVIFlowToyNoise(nn.Module):
                                                               dropout_probability=0.0,
                                                               use_batch_norm=False)
 
-    def score(self, data):
+    def score(self, data, chunk_size=None):
         self.model.eval()
         if self.objective == 'iwae':
-            return self.model.log_prob_lower_bound(data, num_samples=self.K)
+            return self.model.log_prob_lower_bound(
+                data, num_samples=self.K, chunk_size=chunk_size
+            )
 
         elif self.objective == 'elbo':
             return self.model.stochastic_elbo(data, num_samples=self.K)
@@ -115,7 +117,9 @@ class SVIFlowToy(nn.Module):
                  maf_features,
                  maf_hidden_blocks,
                  K=1,
-                 act_fun=nn.functional.relu):
+                 act_fun=nn.functional.relu,
+                 precision=None,
+                 factorised_noise=False):
     
         super(SVIFlowToy, self).__init__()
 
@@ -130,11 +134,13 @@ class SVIFlowToy(nn.Module):
         self.maf_hidden_blocks = maf_hidden_blocks
         self.K = K
         self.act_fun = act_fun
+        self.factorised_noise = factorised_noise
 
         self.model = VariationalAutoencoder(prior=self._create_prior(),
                                             approximate_posterior=self._create_approximate_posterior(),
                                             likelihood=self._create_likelihood(),
-                                            inputs_encoder=self._create_input_encoder()).to(device)
+                                            inputs_encoder=self._create_input_encoder(),
+                                            precision=precision).to(device)
 
     def _create_approximate_posterior(self):
 
@@ -153,21 +159,20 @@ class SVIFlowToy(nn.Module):
                           distribution)
 
     def _create_likelihood(self):
-        return DeconvGaussianToy()
+        return DeconvGaussianToy(factorised=self.factorised_noise)
 
     def _create_input_encoder(self):
         def input_encoder(data):
             # w, noise_covar = data
             # x = torch.cat((w, noise_covar[:, self.idx[0], self.idx[1]]), dim=1)
             # return self.diagonal_mdn.get_context(x)
-            w, _ = data
+            w = data[0]
             return w
 
         return input_encoder
 
     def _create_linear_transform(self):
-        return transforms.CompositeTransform([transforms.RandomPermutation(features=self.dimensions),
-                                              transforms.LULinear(self.dimensions, identity_init=True)])
+        return FoldableLinear(self.dimensions)
 
     def _create_transform(self, flow_steps, context_features=None):
         return transforms.CompositeTransform([transforms.CompositeTransform([self._create_linear_transform(),
@@ -185,10 +190,12 @@ class SVIFlowToy(nn.Module):
                                                               dropout_probability=0.0,
                                                               use_batch_norm=False)
 
-    def score(self, data):
+    def score(self, data, chunk_size=None):
         self.model.eval()
         if self.objective == 'iwae':
-            return self.model.log_prob_lower_bound(data, num_samples=self.K)
+            return self.model.log_prob_lower_bound(
+                data, num_samples=self.K, chunk_size=chunk_size
+            )
 
         elif self.objective == 'elbo':
             return self.model.stochastic_elbo(data, num_samples=self.K)
@@ -335,18 +342,20 @@ class SVIFlow(MAFlow):
                 print('Epoch {}, Train Loss: {}'.format(i, train_loss))
 
 
-    def score(self, data, log_prob=False):
+    def score(self, data, log_prob=False, chunk_size=None):
         with torch.no_grad():
             self.model.eval()
             # data[1] = torch.linalg.cholesky(data[1])
             torch.set_default_tensor_type(torch.cuda.FloatTensor)
             if log_prob:
-                return self.model.log_prob_lower_bound(data, num_samples=100)
+                return self.model.log_prob_lower_bound(
+                    data, num_samples=100, chunk_size=chunk_size
+                )
             else:
                 return self.model.stochastic_elbo(data)
             torch.set_default_tensor_type(torch.FloatTensor)
 
-    def score_batch(self, dataset, log_prob=False):
+    def score_batch(self, dataset, log_prob=False, chunk_size=None):
         loader = data_utils.DataLoader(
             dataset,
             batch_size=self.batch_size,
@@ -357,7 +366,7 @@ class SVIFlow(MAFlow):
 
         for j, d in enumerate(loader):
             d = [a.to(self.device) for a in d]
-            score += torch.sum(self.score(d, log_prob)).item()
+            score += torch.sum(self.score(d, log_prob, chunk_size)).item()
 
         return score
 
@@ -4,74 +4,262 @@ Basic definitions for VAEs.
 Copied from the original NSF repo.
 """
 
+import contextlib
+import math
+
 import torch
 
 from torch import nn
+from torch.func import functional_call
+
+from nflows import flows, utils
+
+from .precision import get_policy
+
+ESTIMATORS = ('standard', 'stl', 'dreg')
+
+
+def streaming_log_mean_exp(terms_f, context, num_samples, chunk_size=None):
+    """log(mean(exp(terms))) over num_samples terms drawn chunk by chunk.
+
+    terms_f(context, n) returns a [batch_size, n] tensor of new terms. Each
+    chunk is reduced with logsumexp and merged into the running result with
+    logaddexp, which is exact, so only one chunk is held at a time.
+    """
+    chunk_size = chunk_size or num_samples
+    total = None
+
+    for start in range(0, num_samples, chunk_size):
+        n = min(chunk_size, num_samples - start)
+        chunk = torch.logsumexp(terms_f(context, n), dim=1)
+        total = chunk if total is None else torch.logaddexp(total, chunk)
+
+    return total - math.log(num_samples)
+
+
+class _LogProb(nn.Module):
+
+    def __init__(self, distribution):
+        super().__init__()
+        self.distribution = distribution
+
+    def forward(self, inputs, context):
+        if isinstance(self.distribution, flows.Flow):
+            # context is already embedded and repeated to match inputs
+            flow = self.distribution
+            noise, logabsdet = flow._transform(inputs, context=context)
+            return flow._distribution.log_prob(noise, context=context) + logabsdet
+        return self.distribution.log_prob(inputs, context=context)
+
+
+def detached_log_prob(distribution, inputs, context):
+    """
+    log_prob with gradients flowing to inputs but not to the parameters.
+
+    A flow takes its context already embedded.
+    """
+    params = {
+        'distribution.' + name: p.detach()
+        for name, p in distribution.named_parameters()
+    }
+    return functional_call(
+        _LogProb(distribution), params, (inputs,), {'context': context}
+    )
+
+
+def sample_and_detached_log_prob(distribution, num_samples, context):
+    """
+    Samples of shape [batch_size, num_samples, ...], with their log density
+    under distribution with its parameters and the context cut from the graph.
+
+    A flow repeats its embedded context once per sample, and the same copy
+    serves the sampling and the density pass. Any other distribution gets
+    the samples with their sample axis, and broadcasts its context over it.
+    Train or eval mode is left as it is, so with dropout active the two
+    passes draw their own masks.
+    """
+    if not isinstance(distribution, flows.Flow):
+        latents = distribution.sample(num_samples, context=context)
+        return latents, detached_log_prob(
+            distribution, latents, context.detach()
+        )
+
+    embedded_context = distribution._embedding_net(context)
+    noise = distribution._distribution.sample(
+        num_samples, context=embedded_context
+    )
+    embedded_context = utils.repeat_rows(embedded_context, num_samples)
+    latents, _ = distribution._transform.inverse(
+        utils.merge_leading_dims(noise, num_dims=2), context=embedded_context
+    )
+    # Split first, so gradients of both terms pass through the returned
+    # latents, where callers may hook them
+    latents = utils.split_leading_dim(latents, [-1, num_samples])
+    log_prob = detached_log_prob(
+        distribution,
+        utils.merge_leading_dims(latents, num_dims=2),
+        embedded_context.detach()
+    )
+    return latents, utils.split_leading_dim(log_prob, [-1, num_samples])
 
-from nflows import utils
 
 class VariationalAutoencoder(nn.Module):
     """Implementation of a standard VAE."""
 
-    def __init__(self, prior, approximate_posterior, likelihood, inputs_encoder=None):
+    def __init__(self, prior, approximate_posterior, likelihood, inputs_encoder=None,
+                 precision=None):
         """
         Args:
             prior: a distribution object, the prior.
             approximate_posterior: a distribution object, the encoder.
             likelihood: a distribution object, the decoder.
+            precision: None, or a PrecisionPolicy or its name ('fp64',
+                'fp32', 'bf16'). The networks then run in its dtype and the
+                likelihood and ELBO terms are computed in its accumulate
+                dtype. None leaves everything in the dtype of the inputs.
         """
         super().__init__()
         self._prior = prior
         self._approximate_posterior = approximate_posterior
         self._likelihood = likelihood
         self._inputs_encoder = inputs_encoder
+        self._precision = get_policy(precision)
+        if self._precision is not None:
+            self._precision.apply(self)
 
     def forward(self, *args):
         raise RuntimeError('Forward method cannot be called for a VAE object.')
 
-    def stochastic_elbo(self, inputs, num_samples=1, kl_multiplier=1, keepdim=False):
+    def stochastic_elbo(self, inputs, num_samples=1, kl_multiplier=1, keepdim=False,
+                        estimator='standard'):
         """Calculates an unbiased Monte-Carlo estimate of the evidence lower bound.
         Note: the KL term is also estimated via Monte Carlo.
         Args:
             inputs: Tensor of shape [batch_size, ...], the inputs.
             num_samples: int, number of samples to use for the Monte-Carlo estimate.
+            estimator: str, the gradient estimator, one of 'standard', or 'stl'
+                (sticking the landing), which drops the score-function term of
+                the encoder gradient. For the ELBO 'dreg' is the same as 'stl'.
         Returns:
             A Tensor of shape [batch_size], an ELBO estimate for each input.
         """
-        # Sample latents and calculate their log prob under the encoder.
-        if self._inputs_encoder is None:
-            posterior_context = inputs
-        else:
-            posterior_context = self._inputs_encoder(inputs)
-        latents, log_q_z = self._approximate_posterior.sample_and_log_prob(
+        elbo, _ = self._elbo_terms(
+            inputs,
+            self._posterior_context(inputs),
             num_samples,
-            context=posterior_context
+            kl_multiplier,
+            stop_q=self._check_estimator(estimator) != 'standard'
         )
-        latents = utils.merge_leading_dims(latents, num_dims=2)
-        log_q_z = utils.merge_leading_dims(log_q_z, num_dims=2)
+        if keepdim:
+            return elbo
+        else:
+            return torch.sum(elbo, dim=1) / num_samples  # Average ELBO across samples.
 
-        # Compute log prob of latents under the prior.
-        log_p_z = self._prior.log_prob(latents)
+    def _posterior_context(self, inputs):
+        if self._precision is not None:
+            inputs = self._precision.cast(inputs, self._precision.param_dtype)
+        if self._inputs_encoder is None:
+            return inputs
+        with self._networks():
+            return self._inputs_encoder(inputs)
 
-        # Compute log prob of inputs under the decoder,
-        # --- SR: fix bug: reapeat_rows needs torch.tensor input, not list (as previous input) ---
-        # ---     also log_probs expects inputs to be a tuple of data and corresponding errors ---
-        inputs = (utils.repeat_rows(i, num_reps=num_samples) for i in inputs)   # modified into tuple
-        log_p_x = self._likelihood.log_prob(inputs, context=latents)
+    def _networks(self):
+        """Context for running the flows and encoder under the policy."""
+        if self._precision is None:
+            return contextlib.nullcontext()
+        device = next(self.parameters()).device
+        return self._precision.networks_context(device.type)
+
+    @staticmethod
+    def _check_estimator(estimator):
+        if estimator not in ESTIMATORS:
+            raise ValueError('Unknown gradient estimator: {}'.format(estimator))
+        return estimator
+
+    def _elbo_terms(self, inputs, posterior_context, num_samples, kl_multiplier=1,
+                    stop_q=False):
+        """ELBO terms of shape [batch_size, num_samples] for encoded inputs.
+
+        Returns the terms and the latents they were computed from. With stop_q
+        the encoder density is evaluated with its parameters, and the context,
+        cut from the graph, so the encoder only gets pathwise gradients. That
+        needs a second, inverse pass through the encoder flow; see
+        sample_and_detached_log_prob.
+        """
+        with self._networks():
+            # Sample latents and calculate their log prob under the encoder.
+            if stop_q:
+                latents, log_q_z = sample_and_detached_log_prob(
+                    self._approximate_posterior,
+                    num_samples,
+                    posterior_context
+                )
+            else:
+                latents, log_q_z = self._approximate_posterior.sample_and_log_prob(
+                    num_samples,
+                    context=posterior_context
+                )   # [batch_size, num_samples, ...]
+
+            # Compute log prob of latents under the prior.
+            log_p_z = utils.split_leading_dim(
+                self._prior.log_prob(utils.merge_leading_dims(latents, num_dims=2)),
+                [-1, num_samples]
+            )
+
+        # Compute log prob of inputs under the decoder. The inputs get a
+        # sample axis of size one, which the likelihood broadcasts against
+        # the latents, so they are not copied num_samples times.
+        inputs = tuple(i.unsqueeze(1) for i in inputs)
+        context = latents
+        if self._precision is not None:
+            accumulate = self._precision.accumulate
+            inputs = self._precision.cast(inputs, accumulate)
+            context = latents.to(accumulate)
+            log_p_z = log_p_z.to(accumulate)
+            log_q_z = log_q_z.to(accumulate)
+        log_p_x = self._likelihood.log_prob(inputs, context=context)
 
         # Compute ELBO.
         # TODO: maybe compute KL analytically when possible?
-        elbo = log_p_x + kl_multiplier * (log_p_z - log_q_z)
-        elbo = utils.split_leading_dim(elbo, [-1, num_samples])
-        if keepdim:
-            return elbo
-        else:
-            return torch.sum(elbo, dim=1) / num_samples  # Average ELBO across samples.
+        return log_p_x + kl_multiplier * (log_p_z - log_q_z), latents
+
+    def log_prob_lower_bound(self, inputs, num_samples=100, chunk_size=None,
+                             estimator='standard'):
+        """Importance-weighted lower bound on log p(inputs).
 
-    def log_prob_lower_bound(self, inputs, num_samples=100):
-        elbo = self.stochastic_elbo(inputs, num_samples=num_samples, keepdim=True)
-        log_prob_lower_bound = torch.logsumexp(elbo, dim=1) - torch.log(torch.Tensor([num_samples]))
-        return log_prob_lower_bound
+        Args:
+            chunk_size: int or None, if given the samples are drawn and reduced
+                chunk_size at a time, merging the chunks with a running
+                logsumexp, so memory does not grow with num_samples.
+            estimator: str, the gradient estimator. 'standard' is the usual
+                IWAE gradient. 'stl' drops the score-function term of the
+                encoder gradient. 'dreg' (doubly reparameterised) also
+                reweights the pathwise encoder gradient by the squared
+                normalised importance weights, whose signal-to-noise ratio
+                does not decay with num_samples. The value of the bound is
+                the same for all three.
+        """
+        stop_q = self._check_estimator(estimator) != 'standard'
+
+        # Normaliser of the importance weights, known once all chunks are in
+        log_norm = []
+
+        def terms(context, n):
+            log_w, latents = self._elbo_terms(inputs, context, n, stop_q=stop_q)
+            if estimator == 'dreg' and latents.requires_grad:
+                log_w_detached = log_w.detach()
+                latents.register_hook(
+                    lambda grad: grad * torch.exp(
+                        log_w_detached - log_norm[0]
+                    ).to(grad.dtype)[:, :, None]
+                )
+            return log_w
+
+        bound = streaming_log_mean_exp(
+            terms, self._posterior_context(inputs), num_samples, chunk_size
+        )
+        log_norm.append(bound.detach()[:, None] + math.log(num_samples))
+        return bound
 
     def _decode(self, latents, mean):
         if mean:
@@ -156,41 +344,58 @@ class VariationalAutoencoderToyNoise(nn.Module):
         Returns:
             A Tensor of shape [batch_size], an ELBO estimate for each input.
         """
-        # Sample latents and calculate their log prob under the encoder.
-        if self._inputs_encoder is None:
-            posterior_context = inputs
+        elbo = self._elbo_terms(
+            inputs, self._posterior_context(inputs), num_samples, kl_multiplier
+        )
+        if keepdim:
+            return elbo
         else:
-            posterior_context = self._inputs_encoder(inputs)
-            
+            return torch.sum(elbo, dim=1) / num_samples  # Average ELBO across samples.
+
+    def _posterior_context(self, inputs):
+        if self._inputs_encoder is None:
+            return inputs
+        return self._inputs_encoder(inputs)
+
+    def _elbo_terms(self, inputs, posterior_context, num_samples, kl_multiplier=1):
+        """ELBO terms of shape [batch_size, num_samples] for encoded inputs."""
+        # Sample latents and calculate their log prob under the encoder.
         latents, log_q_z = self._approximate_posterior.sample_and_log_prob(
             num_samples,
             context=posterior_context
-        )
-        latents = utils.merge_leading_dims(latents, num_dims=2)
-        log_q_z = utils.merge_leading_dims(log_q_z, num_dims=2)
+        )   # [batch_size, num_samples, ...]
 
-        # Compute log prob of latents under the prior.
-        # --- SR: fix bug: reapeat_rows needs torch.tensor input, not list (as previous input) ---
-        # ---     also log_probs expects inputs to be a tuple of data and corresponding errors ---
-        inputs = (utils.repeat_rows(i, num_reps=num_samples) for i in inputs)   # modified into tuple
+        # Compute log prob of latents under the prior, broadcasting the
+        # inputs over the sample axis rather than repeating them.
+        inputs = tuple(i.unsqueeze(1) for i in inputs)
         log_p_z = self._prior.log_prob(inputs, context=latents)
 
         # Compute log prob of inputs under the decoder,
-        log_p_x = self._likelihood.log_prob(inputs[0] - latents)
+        log_p_x = utils.split_leading_dim(
+            self._likelihood.log_prob(
+                utils.merge_leading_dims(inputs[0] - latents, num_dims=2)
+            ),
+            [-1, num_samples]
+        )
 
         # Compute ELBO.
         # TODO: maybe compute KL analytically when possible?
-        elbo = log_p_x + kl_multiplier * (log_p_z - log_q_z)
-        elbo = utils.split_leading_dim(elbo, [-1, num_samples])
-        if keepdim:
-            return elbo
-        else:
-            return torch.sum(elbo, dim=1) / num_samples  # Average ELBO across samples.
+        return log_p_x + kl_multiplier * (log_p_z - log_q_z)
+
+    def log_prob_lower_bound(self, inputs, num_samples=100, chunk_size=None):
+        """Importance-weighted lower bound on log p(inputs).
 
-    def log_prob_lower_bound(self, inputs, num_samples=100):
-        elbo = self.stochastic_elbo(inputs, num_samples=num_samples, keepdim=True)
-        log_prob_lower_bound = torch.logsumexp(elbo, dim=1) - torch.log(torch.Tensor([num_samples]))
-        return log_prob_lower_bound
+        Args:
+            chunk_size: int or None, if given the samples are drawn and reduced
+                chunk_size at a time, merging the chunks with a running
+                logsumexp, so memory does not grow with num_samples.
+        """
+        return streaming_log_mean_exp(
+            lambda context, n: self._elbo_terms(inputs, context, n),
+            self._posterior_context(inputs),
+            num_samples,
+            chunk_size
+        )
 
     def _decode(self, latents, mean):
         if mean:
@@ -3,6 +3,7 @@ from abc import ABC, abstractmethod
 import torch
 import torch.distributions as dist
 
+from .conditional import cached_conditional
 from .util import k_means
 
 mvn = dist.multivariate_normal.MultivariateNormal
@@ -30,6 +31,34 @@ class BaseGMM(ABC):
         self.chol_covars = torch.empty(
             self.k, self.d, self.d, device=self.device
         )
+        self._conditionals = {}
+
+    def __setattr__(self, name, value):
+        if name in ('weights', 'means', 'covars'):
+            # New parameter tensors, from an M-step or otherwise, drop the
+            # cached conditionals rather than being told apart by address,
+            # which a new tensor can reuse
+            self.__dict__['_conditionals'] = {}
+        super().__setattr__(name, value)
+
+    def conditional(self, observed):
+        """
+        GMMConditional for the given observed columns, cached per split.
+
+        Use its condition() for the mixture over the remaining columns and
+        marginal_log_prob() for the density of the observed ones. The cache
+        is dropped when the parameters are assigned, and rebuilt when they
+        are modified in place.
+        """
+        key = tuple(
+            t._version for t in (self.weights, self.means, self.covars)
+        )
+        return cached_conditional(
+            self._conditionals,
+            key,
+            lambda: (self.weights, self.means, self.covars),
+            observed
+        )
 
     def _kmeans_init(self, X, max_iters=50, tol=1e-9):
         return k_means(X, self.k, max_iters, tol, self.device)[0]
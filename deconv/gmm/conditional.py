@@ -0,0 +1,111 @@
+"""
+Conditional and marginal distributions of a GMM for a fixed split of its
+dimensions into observed and unobserved ones.
+
+Everything that depends only on the split (the per-component Cholesky
+factors of the observed block, the regression matrices and the Schur
+complements) is computed once, so that queries over many rows are a few
+batched triangular solves.
+"""
+import math
+
+import torch
+
+from .posterior import GMMPosteriorParams
+
+
+class GMMConditional:
+    """
+    A GMM split into observed and unobserved dimensions.
+
+    observed lists the observed columns, in the order in which they appear
+    in query rows; the remaining columns, in increasing order, are the
+    unobserved ones.
+    """
+
+    def __init__(self, weights, means, covars, observed):
+        d = means.shape[1]
+        self.observed = list(observed)
+        self.unobserved = [i for i in range(d) if i not in set(self.observed)]
+
+        o, u = self.observed, self.unobserved
+
+        self.log_weights = torch.log(weights.reshape(-1))
+        self.means_o = means[:, o]
+        self.means_u = means[:, u]
+
+        covars_oo = covars[:, o][:, :, o]
+        covars_uo = covars[:, u][:, :, o]
+        covars_uu = covars[:, u][:, :, u]
+
+        self.chol_oo = torch.linalg.cholesky(covars_oo)
+        self.half_log_det_oo = self.chol_oo.diagonal(
+            dim1=-2, dim2=-1
+        ).log().sum(-1)
+
+        # A = covars_uo covars_oo^-1, via the transposed system
+        self.regression = torch.cholesky_solve(
+            covars_uo.transpose(-2, -1), self.chol_oo
+        ).transpose(-2, -1)    # k, u, o
+
+        self.covars = covars_uu - torch.matmul(
+            self.regression, covars_uo.transpose(-2, -1)
+        )    # k, u, u
+        self.chol = torch.linalg.cholesky(self.covars)
+
+    def _component_log_probs(self, X_o):
+        """Log weight plus log density of X_o under each component (n, k)."""
+        diff = X_o[:, None, :] - self.means_o    # n, k, o
+        white = torch.linalg.solve_triangular(
+            self.chol_oo, diff[:, :, :, None], upper=False
+        )[:, :, :, 0]
+
+        return self.log_weights - self.half_log_det_oo - 0.5 * (
+            white.pow(2).sum(-1) + len(self.observed) * math.log(2 * math.pi)
+        ), diff
+
+    def marginal_log_prob(self, X_o):
+        """Log density (n,) of the observed columns."""
+        log_p, _ = self._component_log_probs(X_o)
+        return torch.logsumexp(log_p, dim=1)
+
+    def condition(self, X_o):
+        """
+        Mixtures over the unobserved columns given each row of X_o.
+
+        The conditional covariances do not depend on X_o, so they and their
+        Cholesky factors are shared across rows without copies.
+        """
+        log_p, diff = self._component_log_probs(X_o)
+        log_weights = log_p - torch.logsumexp(log_p, dim=1, keepdim=True)
+
+        means = self.means_u + torch.matmul(
+            self.regression, diff[:, :, :, None]
+        )[:, :, :, 0]    # n, k, u
+
+        n = X_o.shape[0]
+        return GMMPosteriorParams(
+            log_weights,
+            means,
+            self.covars.expand(n, -1, -1, -1),
+            chol=self.chol.expand(n, -1, -1, -1)
+        )
+
+
+def cached_conditional(cache, key, params, observed):
+    """
+    Look up or build the GMMConditional for a split.
+
+    cache is a dict owned by the model, and entries are rebuilt when key,
+    which identifies the current parameter values, changes. params returns
+    the weights, means and covariances.
+    """
+    observed = tuple(int(i) for i in observed)
+
+    if observed in cache and cache[observed][0] == key:
+        return cache[observed][1]
+
+    with torch.no_grad():
+        conditional = GMMConditional(*params(), observed)
+    cache[observed] = (key, conditional)
+    return conditional
@@ -1,3 +1,6 @@
+import os
+
+import numpy as np
 import torch
 import torch.utils.data as data_utils
 
@@ -17,6 +20,134 @@ class DeconvDataset(data_utils.Dataset):
         return (self.X[i, :], self.noise_covars[i, :, :])
 
 
+class MaskedDeconvDataset(DeconvDataset):
+    """
+    DeconvDataset with a boolean mask of the observed dimensions.
+
+    Items are (X, C, mask), and the deconvolving fitters marginalise the
+    masked-out dimensions exactly. Without a mask, non-finite entries of X
+    are taken as missing. Missing entries of X and their noise covariance
+    rows and columns are zeroed so they cannot leak NaNs.
+    """
+
+    def __init__(self, X, noise_covars, mask=None):
+        X = torch.as_tensor(X)
+        noise_covars = torch.as_tensor(noise_covars)
+        if mask is None:
+            mask = torch.isfinite(X)
+        mask = torch.as_tensor(mask, dtype=torch.bool)
+
+        X = X.masked_fill(~mask, 0.0)
+        noise_covars = noise_covars.masked_fill(
+            ~(mask[:, :, None] & mask[:, None, :]), 0.0
+        )
+
+        super().__init__(X, noise_covars)
+        self.mask = mask
+
+    def __getitem__(self, i):
+        return (self.X[i, :], self.noise_covars[i, :, :], self.mask[i, :])
+
+
+class SharedDeconvDataset(DeconvDataset):
+    """
+    DeconvDataset whose arrays are attached by handle instead of copied.
+
+    In-memory arrays are moved into shared memory, so DataLoader workers and
+    processes started with torch.multiprocessing map the same pages rather
+    than receiving pickled copies. Datasets opened with from_npy are backed
+    by copy-on-write memmaps and only send the file paths to child processes,
+    which reopen them. A single (d, d) noise covariance is broadcast to every
+    row without being repeated. Use `subset` to take folds as index views of
+    the same arrays.
+    """
+
+    def __init__(self, X, noise_covars):
+        X = torch.as_tensor(X).share_memory_()
+        noise_covars = torch.as_tensor(noise_covars).share_memory_()
+        if noise_covars.dim() == 2:
+            noise_covars = noise_covars.expand(
+                (X.shape[0],) + noise_covars.shape
+            )
+        super().__init__(X, noise_covars)
+        self.paths = None
+
+    @classmethod
+    def from_npy(cls, x_path, c_path):
+        dataset = cls.__new__(cls)
+        dataset.paths = (x_path, c_path)
+        dataset._open()
+        return dataset
+
+    def _open(self):
+        x_path, c_path = self.paths
+        self.X = torch.from_numpy(np.load(x_path, mmap_mode='c'))
+        self.noise_covars = torch.from_numpy(np.load(c_path, mmap_mode='c'))
+
+    def __getstate__(self):
+        if self.paths is None:
+            return self.__dict__
+        return {'paths': self.paths}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'X' not in state:
+            self._open()
+
+    def subset(self, indices):
+        return data_utils.Subset(self, indices)
+
+
+class InMemoryBatches:
+    """
+    Minibatches of a dataset held in memory, without a DataLoader.
+
+    The rows are gathered into tensors once, on the given device. Each pass
+    draws a single permutation and yields contiguous slices of the permuted
+    tensors, instead of indexing and collating row by row.
+
+    dataset must be a DeconvDataset, or a Subset of one, as these can be
+    indexed with a tensor of rows; a TypeError is raised otherwise.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, device=None):
+        tensors = self._gather(dataset)
+        self.tensors = tuple(torch.as_tensor(t).to(device) for t in tensors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    @staticmethod
+    def _gather(dataset):
+        if isinstance(dataset, data_utils.Subset):
+            if isinstance(dataset.dataset, DeconvDataset):
+                return dataset.dataset[torch.as_tensor(dataset.indices)]
+        elif isinstance(dataset, DeconvDataset):
+            return dataset[torch.arange(len(dataset))]
+
+        raise TypeError(
+            'InMemoryBatches needs a DeconvDataset or a Subset of one, got '
+            '{}; use a DataLoader (in_memory=False) instead'.format(
+                type(dataset).__name__
+            )
+        )
+
+    def __len__(self):
+        n = self.tensors[0].shape[0]
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        tensors = self.tensors
+        if self.shuffle:
+            idx = torch.randperm(
+                tensors[0].shape[0], device=tensors[0].device
+            )
+            tensors = tuple(t[idx] for t in tensors)
+
+        for start in range(0, tensors[0].shape[0], self.batch_size):
+            stop = start + self.batch_size
+            yield [t[start:stop] for t in tensors]
+
+
 class H5DeconvDataset(data_utils.Dataset):
 
     def __init__(self, filepath, key, limit=None, batch_size=512):
@@ -41,7 +172,161 @@ class H5DeconvDataset(data_utils.Dataset):
 
         start = self.batch_size * i
         stop = self.batch_size * (i + 1)
+        if 'M' in self.group:
+            return (
+                self.group['X'][start:stop, :],
+                self.group['C'][start:stop, :, :],
+                self.group['M'][start:stop, :]
+            )
         return (
             self.group['X'][start:stop, :],
             self.group['C'][start:stop, :, :]
         )
+
+
+class MemmapDeconvDataset(data_utils.Dataset):
+
+    def __init__(self, dirpath, key, limit=None, batch_size=512):
+
+        self.dirpath = dirpath
+        self.key = key
+        self.limit = limit
+        self.arrays = None
+        self.batch_size = batch_size
+
+    def _open(self):
+        split_dir = os.path.join(self.dirpath, self.key)
+        arrays = [
+            np.load(os.path.join(split_dir, 'X.npy'), mmap_mode='r'),
+            np.load(os.path.join(split_dir, 'C.npy'), mmap_mode='r')
+        ]
+        if os.path.exists(os.path.join(split_dir, 'M.npy')):
+            arrays.append(
+                np.load(os.path.join(split_dir, 'M.npy'), mmap_mode='r')
+            )
+        return tuple(arrays)
+
+    def __len__(self):
+        if self.limit:
+            return self.limit // self.batch_size
+        else:
+            return self._open()[0].shape[0] // self.batch_size
+
+    def __getitem__(self, i):
+        if self.arrays is None:
+            self.arrays = self._open()
+
+        start = self.batch_size * i
+        stop = self.batch_size * (i + 1)
+        return tuple(np.array(a[start:stop]) for a in self.arrays)
+
+
+def factorise_noise(noise_covars, jitter=1e-6, max_tries=6, chunk_size=2**16):
+    """
+    Check noise covariances for positive-definiteness and factorise them.
+
+    Rows whose Cholesky decomposition fails are repaired by adding jitter
+    times their mean variance to the diagonal, increasing tenfold for up to
+    max_tries attempts. Rows that still fail, or contain non-finite values,
+    are flagged as invalid.
+
+    Returns the repaired covariances, their Cholesky factors and
+    log-determinants, a mask of valid rows and a mask of repaired rows.
+    """
+    noise_covars = torch.as_tensor(noise_covars).clone()
+    n, d, _ = noise_covars.shape
+
+    chol = torch.zeros_like(noise_covars)
+    logdet = noise_covars.new_zeros(n)
+    valid = torch.ones(n, dtype=torch.bool)
+    repaired = torch.zeros(n, dtype=torch.bool)
+    eye = torch.eye(d, dtype=noise_covars.dtype)
+
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        C = noise_covars[start:stop]
+
+        finite = torch.isfinite(C).all(dim=-1).all(dim=-1)
+        L, info = torch.linalg.cholesky_ex(C)
+        bad = (info != 0) & finite
+
+        scale = C.diagonal(dim1=-2, dim2=-1).mean(dim=-1).abs()
+        scale = scale.clamp(min=torch.finfo(C.dtype).tiny)
+
+        eps = jitter
+        for _ in range(max_tries):
+            idx = bad.nonzero(as_tuple=True)[0]
+            if len(idx) == 0:
+                break
+            C_fix = C[idx] + (eps * scale[idx])[:, None, None] * eye
+            L_fix, info_fix = torch.linalg.cholesky_ex(C_fix)
+            ok = info_fix == 0
+
+            C[idx[ok]] = C_fix[ok]
+            L[idx[ok]] = L_fix[ok]
+            bad[idx[ok]] = False
+            repaired[start + idx[ok]] = True
+            eps *= 10
+
+        valid[start:stop] = finite & ~bad
+        chol[start:stop] = L
+        logdet[start:stop] = 2 * L.diagonal(
+            dim1=-2, dim2=-1
+        ).log().sum(dim=-1)
+
+    return noise_covars, chol, logdet, valid, repaired
+
+
+class FactorisedDeconvDataset(DeconvDataset):
+    """
+    DeconvDataset with validated noise covariances and precomputed factors.
+
+    Items are (X, C) with repaired covariances for the GMM fitters, or with
+    return_factors=True (X, L, log|C|, tril(L)), which the SVI likelihoods and
+    DeconvInputEncoder use in place of refactorising the noise every epoch.
+    Rows whose covariance cannot be repaired are dropped unless
+    drop_invalid=False, in which case they are only flagged in `valid`.
+    """
+
+    def __init__(self, X, noise_covars, jitter=1e-6, max_tries=6,
+                 drop_invalid=True, return_factors=False):
+        X = torch.as_tensor(X)
+        covars, chol, logdet, valid, repaired = factorise_noise(
+            noise_covars, jitter=jitter, max_tries=max_tries
+        )
+
+        if (~valid).any() or repaired.any():
+            print('Noise covariances: {} repaired, {} invalid'.format(
+                repaired.sum().item(),
+                (~valid).sum().item()
+            ))
+
+        if drop_invalid:
+            X = X[valid]
+            covars = covars[valid]
+            chol = chol[valid]
+            logdet = logdet[valid]
+            repaired = repaired[valid]
+            valid = valid[valid]
+
+        super().__init__(X, covars)
+
+        d = covars.shape[-1]
+        idx = torch.tril_indices(d, d)
+
+        self.noise_l = chol
+        self.noise_logdet = logdet
+        self.noise_tril = chol[:, idx[0], idx[1]]
+        self.valid = valid
+        self.repaired = repaired
+        self.return_factors = return_factors
+
+    def __getitem__(self, i):
+        if self.return_factors:
+            return (
+                self.X[i, :],
+                self.noise_l[i, :, :],
+                self.noise_logdet[i],
+                self.noise_tril[i, :]
+            )
+        return (self.X[i, :], self.noise_covars[i, :, :])
@@ -4,6 +4,9 @@ import torch
 import torch.distributions as dist
 
 from .base import BaseGMM
+from .missing import masked_log_resps
+from .posterior import GMMPosteriorParams
+from .util import masked_k_means
 
 mvn = dist.multivariate_normal.MultivariateNormal
 
@@ -23,10 +26,22 @@ class DeconvGMM(BaseGMM):
         X = data[0]
         n = X.shape[0]
 
-        resps = self._kmeans_init(X)
+        if len(data) > 2:
+            # Cluster on the observed dimensions only, and take the missing
+            # ones from the centroids rather than the zero placeholders
+            mask = data[2]
+            resps, centroids = masked_k_means(
+                X, mask, self.k, device=self.device
+            )
+            cond_means = torch.where(
+                mask[:, None, :], X[:, None, :], centroids[None, :, :]
+            )
+        else:
+            resps = self._kmeans_init(X)
+            cond_means = X[:, None, :].repeat(1, self.k, 1)
+
         log_resps = torch.log(resps)
 
-        cond_means = X[:, None, :].repeat(1, self.k, 1)
         cond_covars = torch.eye(self.d, device=self.device).repeat(
             n, self.k, 1, 1
         )
@@ -38,6 +53,9 @@ class DeconvGMM(BaseGMM):
 
     def _e_step(self, data):
 
+        if len(data) > 2:
+            return self._masked_e_step(data)
+
         X, noise_covars = data
 
         T = self.covars[None, :, :, :] + noise_covars[:, None, :, :]
@@ -78,6 +96,35 @@ class DeconvGMM(BaseGMM):
         log_resps -= log_prob
         return torch.sum(log_prob), (log_resps, cond_means, cond_covars)
 
+    def posterior(self, data):
+        """Posterior mixtures of the latent points given noisy data."""
+        _, expectations = self._e_step(data)
+        if expectations is None:
+            raise torch.linalg.LinAlgError(
+                'Deconvolved covariances are not positive definite'
+            )
+        return GMMPosteriorParams(*expectations)
+
+    def posterior_moments(self, data):
+        """Analytic posterior means (n, d) and covariances (n, d, d)."""
+        return self.posterior(data).moments()
+
+    def _masked_e_step(self, data):
+
+        X, noise_covars, mask = data
+
+        try:
+            log_resps, cond_means, cond_covars = masked_log_resps(
+                X, noise_covars, mask, self.means, self.covars,
+                torch.log(self.weights[None, :, 0]), conditionals=True
+            )
+        except RuntimeError:
+            return torch.tensor(float('-inf')), None
+
+        log_prob = torch.logsumexp(log_resps, dim=1, keepdim=True)
+        log_resps -= log_prob
+        return torch.sum(log_prob), (log_resps, cond_means, cond_covars)
+
     def _m_step(self, data, expectations):
         log_resps, cond_means, cond_covars = expectations
         n = cond_means.shape[0]
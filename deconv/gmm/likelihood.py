@@ -0,0 +1,227 @@
+"""
+Log-likelihood kernels for deconvolving GMMs.
+
+Evaluates log sum_j w_j N(x | m_j, V_j + C) for a batch of noisy points
+directly from batched Cholesky factors, without going through
+torch.distributions and its argument validation.
+"""
+import math
+import warnings
+
+import torch
+
+
+def deconv_log_resps(x, noise_covars, means, covars, log_weights):
+    """
+    Unnormalised log responsibilities of a batch of noisy points.
+
+    Returns the (n, k) log responsibilities and the (n, k) Cholesky error
+    flags, which are non-zero where V_j + C_i is not positive-definite.
+    """
+    T = covars[None, :, :, :] + noise_covars[:, None, :, :]
+    T_chol, info = torch.linalg.cholesky_ex(T)
+
+    diff = x[:, None, :, None] - means[None, :, :, None]
+    maha = torch.linalg.solve_triangular(
+        T_chol, diff, upper=False
+    ).pow(2).sum(dim=(-2, -1))
+
+    half_log_det = T_chol.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+
+    log_resps = -0.5 * (x.shape[-1] * math.log(2 * math.pi) + maha)
+    log_resps = log_resps - half_log_det + log_weights
+
+    return log_resps, info
+
+
+def deconv_log_prob_kernel(x, noise_covars, means, covars, log_weights):
+    log_resps, info = deconv_log_resps(
+        x, noise_covars, means, covars, log_weights
+    )
+    return torch.logsumexp(log_resps, dim=1), info
+
+
+def check_cholesky(info):
+    if info.any():
+        raise torch.linalg.LinAlgError(
+            'V + C is not positive-definite for {} pairs of rows and '
+            'components'.format((info != 0).sum().item())
+        )
+
+
+def deconv_log_prob(x, noise_covars, means, covars, log_weights):
+    """Log-likelihood of each noisy point under a deconvolved GMM."""
+    log_prob, info = deconv_log_prob_kernel(
+        x, noise_covars, means, covars, log_weights
+    )
+    check_cholesky(info)
+    return log_prob
+
+
+def compile_errors():
+    """Exceptions raised by torch.compile when tracing or code generation fails."""
+    from torch._dynamo.exc import TorchDynamoException
+    from torch._inductor.exc import (
+        CppCompileError, InvalidCxxCompiler, OperatorIssue
+    )
+    return (
+        TorchDynamoException, CppCompileError, InvalidCxxCompiler,
+        OperatorIssue
+    )
+
+
+class CompiledDeconvLogProb:
+    """
+    deconv_log_prob with the kernel compiled by torch.compile.
+
+    Falls back to the eager kernel for good if torch.compile is missing or
+    compilation fails. AOTAutograd compiles the backward lazily, so the
+    first call that needs gradients also runs a backward pass through the
+    compiled kernel on a couple of rows, so that a failure there falls back
+    too rather than surfacing in the optimiser step. Errors the eager kernel
+    raises as well are the caller's and are re-raised.
+    """
+
+    def __init__(self):
+        self.kernel = None
+        self.backward_checked = False
+        if hasattr(torch, 'compile'):
+            self.kernel = torch.compile(deconv_log_prob_kernel, dynamic=True)
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def _check_backward(self, inputs):
+        rows = [t.detach()[:2] for t in inputs[:2]] + [
+            t.detach() for t in inputs[2:]
+        ]
+        rows = [
+            r.requires_grad_(t.requires_grad) for r, t in zip(rows, inputs)
+        ]
+        log_prob, _ = self.kernel(*rows)
+        torch.autograd.grad(
+            log_prob.sum(), [r for r in rows if r.requires_grad],
+            allow_unused=True
+        )
+        self.backward_checked = True
+
+    def __call__(self, x, noise_covars, means, covars, log_weights):
+        inputs = (x, noise_covars, means, covars, log_weights)
+
+        if self.kernel is not None:
+            try:
+                if not self.backward_checked and torch.is_grad_enabled() and \
+                        any(t.requires_grad for t in inputs):
+                    self._check_backward(inputs)
+                log_prob, info = self.kernel(*inputs)
+            except compile_errors() as e:
+                # Raises here if the inputs are at fault, not the compiler
+                log_prob = deconv_log_prob(*inputs)
+                warnings.warn(
+                    'torch.compile failed, using eager kernel: {}'.format(e)
+                )
+                self.kernel = None
+                return log_prob
+
+            check_cholesky(info)
+            return log_prob
+
+        return deconv_log_prob(*inputs)
+
+
+class DeconvLogProb(torch.autograd.Function):
+    """
+    deconv_log_prob with closed-form gradients.
+
+    With responsibilities r, alpha = T^-1 (x - m) and T = V + C, the
+    gradients are r alpha for the means, r (alpha alpha^T - T^-1) / 2 for the
+    covariances and r for the log weights. Only r and alpha are saved for the
+    backward pass, instead of keeping every (n, k, d, d) intermediate of the
+    forward alive in between. The backward refactorises T in chunks of rows
+    and gets r T^-1 as W^T (r W) with W = L^-1 from a triangular solve, so
+    its peak memory is bounded by the chunk rather than by n.
+    """
+
+    # (row, component) pairs per chunk of the backward pass
+    backward_chunk = 4096
+
+    @staticmethod
+    def forward(ctx, x, noise_covars, means, covars, log_weights):
+        T = covars[None, :, :, :] + noise_covars[:, None, :, :]
+        T_chol, info = torch.linalg.cholesky_ex(T)
+        check_cholesky(info)
+
+        diff = x[:, None, :, None] - means[None, :, :, None]
+        alpha = torch.cholesky_solve(diff, T_chol)
+
+        maha = (diff * alpha).sum(dim=(-2, -1))
+        half_log_det = T_chol.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+
+        log_resps = -0.5 * (x.shape[-1] * math.log(2 * math.pi) + maha)
+        log_resps = log_resps - half_log_det + log_weights
+
+        log_prob = torch.logsumexp(log_resps, dim=1)
+        resps = torch.exp(log_resps - log_prob[:, None])
+
+        ctx.save_for_backward(resps, alpha[:, :, :, 0], noise_covars, covars)
+        return log_prob
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        resps, alpha, noise_covars, covars = ctx.saved_tensors
+        grad_x = grad_noise = grad_means = grad_covars = None
+        grad_log_weights = None
+
+        r = grad_output[:, None] * resps    # n, k
+        r_alpha = r[:, :, None] * alpha     # n, k, d
+
+        if ctx.needs_input_grad[0]:
+            grad_x = -r_alpha.sum(dim=1)
+
+        if ctx.needs_input_grad[1] or ctx.needs_input_grad[3]:
+            n, k, d = alpha.shape
+            eye = torch.eye(d, dtype=alpha.dtype, device=alpha.device)
+            chunk = max(1, DeconvLogProb.backward_chunk // k)
+
+            grad_noise_chunks = []
+            grad_covars = covars.new_zeros(k, d, d)
+
+            for start in range(0, n, chunk):
+                rows = slice(start, start + chunk)
+                T_chol = torch.linalg.cholesky(
+                    covars[None, :, :, :] + noise_covars[rows, None, :, :]
+                )
+                # T^-1 = W^T W with W = L^-1
+                W = torch.linalg.solve_triangular(
+                    T_chol, eye.expand_as(T_chol), upper=False
+                )
+                r_rows = r[rows, :, None, None]
+                a = alpha[rows]
+                grad_T = 0.5 * (
+                    r_rows * a[:, :, :, None] * a[:, :, None, :] -
+                    torch.matmul(W.transpose(-2, -1), r_rows * W)
+                )
+                if ctx.needs_input_grad[1]:
+                    grad_noise_chunks.append(grad_T.sum(dim=1))
+                grad_covars += grad_T.sum(dim=0)
+
+            if ctx.needs_input_grad[1]:
+                grad_noise = torch.cat(grad_noise_chunks)
+            if not ctx.needs_input_grad[3]:
+                grad_covars = None
+
+        if ctx.needs_input_grad[2]:
+            grad_means = r_alpha.sum(dim=0)
+
+        if ctx.needs_input_grad[4]:
+            grad_log_weights = r.sum(dim=0)
+
+        return grad_x, grad_noise, grad_means, grad_covars, grad_log_weights
+
+
+def deconv_log_prob_analytic(x, noise_covars, means, covars, log_weights):
+    """deconv_log_prob, differentiated in closed form by DeconvLogProb."""
+    return DeconvLogProb.apply(x, noise_covars, means, covars, log_weights)
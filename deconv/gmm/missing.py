@@ -0,0 +1,121 @@
+"""
+Exact marginalisation of missing dimensions.
+
+Each row carries a boolean mask of its observed dimensions. Rows are grouped
+by missingness pattern and every group is solved on its observed sub-block
+only. Missing dimensions need no placeholder values or inflated variances,
+and they cost nothing in the solves.
+"""
+import math
+
+import torch
+
+from .likelihood import check_cholesky, deconv_log_resps
+
+
+def group_by_pattern(mask):
+    """
+    Yield (observed dimensions, rows) for each distinct pattern in mask.
+
+    rows is None when every row has the same pattern.
+    """
+    d = mask.shape[1]
+
+    # Each pattern packed into one integer, so a 1-D unique suffices
+    codes = (mask.long() << torch.arange(d, device=mask.device)).sum(dim=1)
+    patterns, inverse, counts = torch.unique(
+        codes, return_inverse=True, return_counts=True
+    )
+
+    if len(patterns) == 1:
+        yield mask[0].nonzero(as_tuple=True)[0], None
+        return
+
+    order = torch.argsort(inverse)
+    bits = 1 << torch.arange(d, device=mask.device)
+    for code, rows in zip(patterns, torch.split(order, counts.tolist())):
+        yield ((code & bits) != 0).nonzero(as_tuple=True)[0], rows
+
+
+def masked_log_resps(X, noise_covars, mask, means, covars, log_weights,
+                     conditionals=False):
+    """
+    Component log-likelihoods of partially observed noisy rows.
+
+    Returns the (n, k) unnormalised log responsibilities log w_j +
+    log N(x_o | m_jo, V_joo + C_oo). With conditionals=True it also returns
+    the means and covariances of the latent vectors over all d dimensions,
+    conditioned on the observed dimensions, as used by the EM M-step.
+    Differentiable with respect to means, covars and log_weights.
+    """
+    n, d = X.shape
+    k = means.shape[0]
+
+    if not conditionals:
+        return _masked_log_resps(X, noise_covars, mask, means, covars,
+                                 log_weights)
+
+    log_resps = X.new_empty(n, k)
+    cond_means = X.new_empty(n, k, d)
+    cond_covars = X.new_empty(n, k, d, d)
+
+    for obs, rows in group_by_pattern(mask):
+        if rows is None:
+            rows = slice(None)
+        x = X[rows][:, obs]
+        C = noise_covars[rows][:, obs][:, :, obs]
+
+        T = covars[:, obs][:, :, obs][None, :, :, :] + C[:, None, :, :]
+        T_chol = torch.linalg.cholesky(T)
+
+        diff = x[:, None, :] - means[None, :, obs]
+        T_inv_diff = torch.cholesky_solve(diff[:, :, :, None], T_chol)
+
+        log_resps[rows] = log_weights - 0.5 * (
+            (diff * T_inv_diff[:, :, :, 0]).sum(dim=-1) +
+            len(obs) * math.log(2 * math.pi)
+        ) - T_chol.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1)
+
+        V_ao = covars[:, :, obs]    # k, d, o
+        cond_means[rows] = means + torch.matmul(
+            V_ao, T_inv_diff
+        )[:, :, :, 0]
+
+        T_inv_V_oa = torch.cholesky_solve(
+            V_ao.transpose(-2, -1).expand(x.shape[0], k, len(obs), d),
+            T_chol
+        )
+        cond_covars[rows] = covars - torch.matmul(V_ao, T_inv_V_oa)
+
+    return log_resps, cond_means, cond_covars
+
+
+def _masked_log_resps(X, noise_covars, mask, means, covars, log_weights):
+    """Log responsibilities only, one fused kernel call per pattern."""
+    groups = []
+    for obs, rows in group_by_pattern(mask):
+        if rows is None:
+            x, C = X, noise_covars
+        else:
+            x, C = X[rows], noise_covars[rows]
+
+        if len(obs) < X.shape[1]:
+            x = x[:, obs]
+            C = C[:, obs][:, :, obs]
+            group_means = means[:, obs]
+            group_covars = covars[:, obs][:, :, obs]
+        else:
+            group_means, group_covars = means, covars
+
+        log_resps, info = deconv_log_resps(
+            x, C, group_means, group_covars, log_weights
+        )
+        check_cholesky(info)
+
+        if rows is None:
+            return log_resps
+        groups.append((rows, log_resps))
+
+    # Scatter the groups back into row order
+    rows = torch.cat([r for r, _ in groups])
+    return torch.cat([l for _, l in groups])[torch.argsort(rows)]
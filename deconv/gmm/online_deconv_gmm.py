@@ -2,7 +2,7 @@ import torch
 import torch.utils.data as data_utils
 
 from .deconv_gmm import DeconvGMM
-from .util import minibatch_k_means
+from .util import Rebatched, minibatch_k_means, reservoir_sample
 
 
 class OnlineDeconvGMM(DeconvGMM):
@@ -40,24 +40,36 @@ class OnlineDeconvGMM(DeconvGMM):
         self.sum_cond_means = self.means * self.sum_resps
 
     def fit(self, data, val_data=None, verbose=False, interval=1):
-        loader = data_utils.DataLoader(
-            data,
-            batch_size=self.batch_size,
-            num_workers=4,
-            shuffle=True,
-            pin_memory=True,
-            drop_last=True
-        )
-
-        init_loader = data_utils.DataLoader(
-            data,
-            batch_size=self.k_means_factor * self.batch_size,
-            num_workers=4,
-            shuffle=True,
-            pin_memory=True
-        )
-
-        n = len(data)
+        if isinstance(data, data_utils.IterableDataset):
+            # The M-step normalises by batch_size, so every batch must have
+            # exactly that many rows, whatever the stream yields.
+            loader = Rebatched(data, self.batch_size, drop_last=True)
+            # k-means iterates over its data, so seed it from a sample held
+            # in memory rather than re-reading the stream every iteration
+            init_loader = [
+                reservoir_sample(data, self.k_means_factor * self.batch_size)
+            ]
+            # Not needed by the online updates, and counting a stream
+            # means parsing it
+            n = None
+        else:
+            loader = data_utils.DataLoader(
+                data,
+                batch_size=self.batch_size,
+                num_workers=4,
+                shuffle=True,
+                pin_memory=True,
+                drop_last=True
+            )
+
+            init_loader = data_utils.DataLoader(
+                data,
+                batch_size=self.k_means_factor * self.batch_size,
+                num_workers=4,
+                shuffle=True,
+                pin_memory=True
+            )
+            n = len(data)
 
         n_inf = float('-inf')
 
@@ -87,7 +99,11 @@ class OnlineDeconvGMM(DeconvGMM):
                 val_ll = 0.0
                 break
 
-            train_ll = self.score_batch(data)
+            # A stream is not read again to score it: its train LL stays the
+            # sum over the epoch's E-steps, each under the parameters from
+            # before that batch's update.
+            if n is not None:
+                train_ll = self.score_batch(data)
             self.train_ll_curve.append(train_ll)
 
             if val_data:
@@ -190,12 +206,15 @@ class OnlineDeconvGMM(DeconvGMM):
     def score_batch(self, dataset):
         log_prob = 0.0
 
-        loader = data_utils.DataLoader(
-            dataset,
-            batch_size=self.batch_size,
-            num_workers=4,
-            pin_memory=True
-        )
+        if isinstance(dataset, data_utils.IterableDataset):
+            loader = data_utils.DataLoader(dataset, batch_size=None)
+        else:
+            loader = data_utils.DataLoader(
+                dataset,
+                batch_size=self.batch_size,
+                num_workers=4,
+                pin_memory=True
+            )
 
         for _, d in enumerate(loader):
             d = [a.to(self.device) for a in d]
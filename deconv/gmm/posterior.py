@@ -0,0 +1,111 @@
+"""
+Posterior of a deconvolved GMM for a batch of noisy points.
+
+For each point the posterior over the latent vector is itself a GMM. Its
+parameters are computed once per batch and can then be sampled and scored
+any number of times.
+"""
+import math
+
+import torch
+
+
+class GMMPosteriorParams:
+    """
+    Per-point posterior mixtures.
+
+    log_weights is (n, k), means is (n, k, d) and covars is (n, k, d, d).
+    The Cholesky factors of the covariances are computed on first use,
+    unless they are passed in as chol.
+    """
+
+    def __init__(self, log_weights, means, covars, chol=None):
+        self.log_weights = log_weights
+        self.means = means
+        self.covars = covars
+        self._chol = chol
+
+    def __len__(self):
+        return self.means.shape[0]
+
+    @property
+    def chol(self):
+        if self._chol is None:
+            self._chol = torch.linalg.cholesky(self.covars)
+        return self._chol
+
+    def sample(self, num_samples):
+        """Draw a component for each sample, then sample each one once."""
+        with torch.no_grad():
+            n, k, d = self.means.shape
+            idx = torch.multinomial(
+                torch.exp(self.log_weights), num_samples, replacement=True
+            )
+
+            samples = self.means.new_empty(n, num_samples, d)
+            for j in torch.unique(idx).tolist():
+                rows, cols = (idx == j).nonzero(as_tuple=True)
+                eps = torch.randn_like(samples[rows, cols])
+                samples[rows, cols] = self.means[rows, j] + torch.matmul(
+                    self.chol[rows, j], eps[:, :, None]
+                )[:, :, 0]
+
+            return samples
+
+    def log_prob(self, z):
+        """Log density of (n, d) or (n, num_samples, d) latent vectors."""
+        if z.dim() == 2:
+            return self.log_prob(z[:, None, :])[:, 0]
+
+        d = z.shape[-1]
+
+        # One triangular solve per component against all samples
+        diff = z[:, None, :, :] - self.means[:, :, None, :]   # n, k, s, d
+        maha = torch.linalg.solve_triangular(
+            self.chol, diff.transpose(-2, -1), upper=False
+        ).pow(2).sum(dim=-2)    # n, k, s
+
+        half_log_det = self.chol.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+
+        log_p = -0.5 * (d * math.log(2 * math.pi) + maha)
+        log_p = log_p - half_log_det[:, :, None] + self.log_weights[:, :, None]
+
+        return torch.logsumexp(log_p, dim=1)
+
+    def moments(self):
+        """Mean (n, d) and covariance (n, d, d) of each posterior mixture."""
+        weights = torch.exp(self.log_weights)
+        mean = (weights[:, :, None] * self.means).sum(dim=1)
+
+        diff = self.means - mean[:, None, :]
+        covar = (weights[:, :, None, None] * (
+            self.covars + diff[:, :, :, None] * diff[:, :, None, :]
+        )).sum(dim=1)
+
+        return mean, covar
+
+    def quantiles(self, q, iters=50):
+        """
+        Quantiles (len(q), n, d) of each dimension's marginal mixture.
+
+        Found by bisection on the mixture CDF between the extreme component
+        means +- 10 standard deviations.
+        """
+        q = torch.as_tensor(q, dtype=self.means.dtype, device=self.means.device)
+        weights = torch.exp(self.log_weights)[None, :, :, None]   # 1, n, k, 1
+        means = self.means[None]    # 1, n, k, d
+        stds = self.covars.diagonal(dim1=-2, dim2=-1).sqrt()[None]
+        normal = torch.distributions.Normal(means, stds)
+
+        lo = (means - 10 * stds).min(dim=2)[0].expand(len(q), -1, -1)
+        hi = (means + 10 * stds).max(dim=2)[0].expand(len(q), -1, -1)
+        target = q[:, None, None]
+
+        for _ in range(iters):
+            mid = (lo + hi) / 2
+            cdf = (weights * normal.cdf(mid[:, :, None, :])).sum(dim=2)
+            below = cdf < target
+            lo = torch.where(below, mid, lo)
+            hi = torch.where(below, hi, mid)
+
+        return (lo + hi) / 2
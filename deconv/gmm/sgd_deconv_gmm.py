@@ -1,31 +1,63 @@
+import math
+import weakref
+
 import torch
 import torch.distributions as dist
 import torch.utils.data as data_utils
 
+from .likelihood import (
+    CompiledDeconvLogProb, deconv_log_prob, deconv_log_prob_analytic
+)
+from .missing import masked_log_resps
+from .posterior import GMMPosteriorParams
 from .sgd_gmm import SGDGMMModule, BaseSGDGMM
 
-from ..utils.sampling import minibatch_sample
+from ..utils.sampling import (
+    iter_sample_chunks, minibatch_sample, write_sample_chunks
+)
 
 mvn = dist.multivariate_normal.MultivariateNormal
 
 
 class SGDDeconvGMMModule(SGDGMMModule):
 
+    def __init__(self, components, dimensions, w, device=None,
+                 cache_params=True, compile_likelihood=False,
+                 analytic_grad=False):
+        super().__init__(
+            components, dimensions, w, device, cache_params=cache_params
+        )
+        if analytic_grad and compile_likelihood:
+            raise ValueError(
+                'analytic_grad and compile_likelihood cannot be combined'
+            )
+        if analytic_grad:
+            self.log_prob_kernel = deconv_log_prob_analytic
+        elif compile_likelihood:
+            self.log_prob_kernel = CompiledDeconvLogProb()
+        else:
+            self.log_prob_kernel = deconv_log_prob
+
     def forward(self, data):
+        if len(data) > 2:
+            return self._masked_forward(data)
+
         x, noise_covars = data
 
-        weights = self.soft_max(self.soft_weights)
+        return self.log_prob_kernel(
+            x, noise_covars, self.means, self.covars, torch.log(self.weights)
+        )
 
-        T = self.covars[None, :, :, :] + noise_covars[:, None, :, :]
+    def _masked_forward(self, data):
+        x, noise_covars, mask = data
 
-        log_resp = mvn(loc=self.means, covariance_matrix=T).log_prob(
-            x[:, None, :]
-        )
-        log_resp += torch.log(weights)
+        log_weights = torch.log(self.weights)
 
-        log_prob = torch.logsumexp(log_resp, dim=1)
+        log_resp = masked_log_resps(
+            x, noise_covars, mask, self.means, self.covars, log_weights
+        )
 
-        return log_prob
+        return torch.logsumexp(log_resp, dim=1)
 
 
 class SGDDeconvDataset(data_utils.Dataset):
@@ -46,14 +78,22 @@ class SGDDeconvGMM(BaseSGDGMM):
     def __init__(self, components, dimensions, epochs=10000, lr=1e-3,
                  batch_size=64, tol=1e-6, w=1e-3,
                  k_means_factor=100, k_means_iters=10, lr_step=5,
-                 lr_gamma=0.1, device=None):
-        self.module = SGDDeconvGMMModule(components, dimensions, w, device)
+                 lr_gamma=0.1, device=None, cache_params=True,
+                 compile_likelihood=False, analytic_grad=False,
+                 in_memory=False, optimiser='adam', lbfgs_iters=20):
+        self.module = SGDDeconvGMMModule(
+            components, dimensions, w, device, cache_params=cache_params,
+            compile_likelihood=compile_likelihood,
+            analytic_grad=analytic_grad
+        )
         super().__init__(
             components, dimensions, epochs=epochs, lr=lr,
             batch_size=batch_size, w=w, tol=tol,
             k_means_factor=k_means_factor, k_means_iters=k_means_iters,
-            lr_step=lr_step, lr_gamma=lr_gamma, device=device
+            lr_step=lr_step, lr_gamma=lr_gamma, device=device,
+            in_memory=in_memory, optimiser=optimiser, lbfgs_iters=lbfgs_iters
         )
+        self._posterior_cache = None
         
     def _sample_prior(self, num_samples, context=None):
         return self._sample(num_samples)
@@ -69,66 +109,164 @@ class SGDDeconvGMM(BaseSGDGMM):
             )
             
     def posterior_params(self, x):
-        log_weights = torch.log(self.module.soft_max(self.module.soft_weights))
-        T = self.module.covars[None, :, :, :] + x[1][:, None, :, :]
-        
-        w = log_weights + dist.MultivariateNormal(
-            loc=self.module.means, covariance_matrix=T
-        ).log_prob(x[0][:, None, :])
-        p_weights = w - torch.logsumexp(w, axis=1)[:, None]
-        
+        X, noise_covars = x[0], x[1]
+        means = self.module.means
+        covars = self.module.covars
+
+        T = covars[None, :, :, :] + noise_covars[:, None, :, :]
         L_t = torch.linalg.cholesky(T)
-        T_inv = torch.cholesky_solve(torch.eye(self.d, device=self.device), L_t)
-        
-        diff = x[0][:, None, :] - self.module.means
-        T_prod = torch.matmul(T_inv, diff[:, :, :, None])
-        p_means = self.module.means + torch.matmul(
-            self.module.covars,
-            T_prod
-        ).squeeze()
-        
-        p_covars = self.module.covars - torch.matmul(
-            self.module.covars,
-            torch.matmul(T_inv, self.module.covars)
+
+        diff = X[:, None, :, None] - means[None, :, :, None]
+        T_prod = torch.cholesky_solve(diff, L_t)
+
+        w = torch.log(self.module.weights) - 0.5 * (
+            (diff * T_prod).sum(dim=(-2, -1)) +
+            self.d * math.log(2 * math.pi)
+        ) - L_t.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+        p_weights = w - torch.logsumexp(w, axis=1)[:, None]
+
+        p_means = means + torch.matmul(covars, T_prod)[:, :, :, 0]
+
+        p_covars = covars - torch.matmul(
+            covars,
+            torch.cholesky_solve(covars.expand(T.shape), L_t)
         )
         return p_weights, p_means, p_covars
-    
+
+    def posterior(self, x, cache=False):
+        """
+        Posterior parameters for a batch x = (X, noise_covars).
+
+        With cache=True the result is kept, and reused by later cached calls
+        with the same X and noise tensors, unmodified, while the model
+        parameters and grad mode are unchanged. It holds the (n, k, d, d)
+        posterior covariances until the next cached call, so it is off by
+        default. Results that carry a graph are never kept, since a backward
+        pass would free it.
+        """
+        if not cache:
+            return GMMPosteriorParams(*self.posterior_params(x))
+
+        key = (torch.is_grad_enabled(), x[0]._version, x[1]._version) + tuple(
+            (p.data_ptr(), p._version, p.requires_grad)
+            for p in self.module.parameters()
+        )
+
+        if self._posterior_cache is not None:
+            x_ref, noise_ref, cached_key, posterior = self._posterior_cache
+            if (x_ref() is x[0] and noise_ref() is x[1] and
+                    cached_key == key):
+                return posterior
+
+        posterior = GMMPosteriorParams(*self.posterior_params(x))
+        if posterior.means.requires_grad or posterior.covars.requires_grad:
+            self._posterior_cache = None
+        else:
+            self._posterior_cache = (
+                weakref.ref(x[0]), weakref.ref(x[1]), key, posterior
+            )
+        return posterior
+
+    def posterior_moments(self, x):
+        """Analytic posterior means (n, d) and covariances (n, d, d)."""
+        with torch.no_grad():
+            return self.posterior(x).moments()
+
+    def summarise_posterior(self, x, quantiles=(0.16, 0.5, 0.84),
+                            star_chunk_size=None, device=torch.device('cpu')):
+        """
+        Posterior means, covariances and marginal quantiles for each star.
+
+        Everything is computed from the posterior mixtures, one star chunk
+        at a time, without sampling. Quantiles are (len(quantiles), n, d).
+        """
+        star_chunk_size = star_chunk_size or self.batch_size
+        n_stars = len(x[0])
+        results = []
+
+        with torch.no_grad():
+            for start in range(0, n_stars, star_chunk_size):
+                x_chunk = [
+                    torch.as_tensor(a[start:start + star_chunk_size]).to(
+                        self.device
+                    ) for a in x
+                ]
+                posterior = self.posterior(x_chunk)
+                results.append(
+                    posterior.moments() + (posterior.quantiles(quantiles),)
+                )
+
+        means, covars, q = zip(*results)
+        return (
+            torch.cat(means).to(device),
+            torch.cat(covars).to(device),
+            torch.cat(q, dim=1).to(device)
+        )
+
     def posterior_log_prob(self, x, context):
-        p_weights, p_means, p_covars = self.posterior_params(context)
         if len(x.shape) == 2:
+            p_weights, p_means, p_covars = self.posterior_params(context)
             log_p = dist.MultivariateNormal(loc=p_means, covariance_matrix=p_covars).log_prob(x[:, None, None, :])
             return torch.logsumexp(log_p + p_weights, dim=2)
         else:
-            log_p = dist.MultivariateNormal(
-                loc=p_means, covariance_matrix=p_covars
-            ).log_prob(x.transpose(0, 1)[:, :, None, :])
-            return torch.logsumexp(log_p + p_weights, dim=2).transpose(0, 1)
+            return self.posterior(context).log_prob(x)
 
     def _sample_posterior(self, x, num_samples, context=None):
-        
-        p_weights, p_means, p_covars = self.posterior_params(x)
-        
-        idx = dist.Categorical(logits=p_weights).sample([num_samples])
-        samples = dist.MultivariateNormal(loc=p_means, covariance_matrix=p_covars).sample([num_samples])
-        
-        return samples.transpose(0, 1)[
-            torch.arange(len(x[0]), device=self.device)[:, None, None, None],
-            torch.arange(num_samples, device=self.device)[None, :, None, None],
-            idx.T[:, :, None, None],
-            torch.arange(self.d, device=self.device)[None, None, None, :]
-        ].squeeze()
+        return self.posterior(x).sample(num_samples).squeeze()
     
     def sample_posterior(self, x, num_samples, device=torch.device('cpu')):
         with torch.no_grad():
+            # Factorised once for all sample chunks, and freed on return
+            posterior = self.posterior(x)
+
+            def sample(x, n, context=None):
+                return posterior.sample(n)
+
             return minibatch_sample(
-                self._sample_posterior,
+                sample,
                 num_samples,
                 self.d,
                 self.batch_size,
                 device,
                 x=x
             )
-                                                          
-                                                    
-                                                          
-        
+
+    def iter_posterior_samples(self, x, num_samples, star_chunk_size=None,
+                               sample_chunk_size=None,
+                               device=torch.device('cpu')):
+        """
+        Yield posterior samples in chunks over stars and samples.
+
+        The posterior parameters are computed once per star chunk. See
+        iter_sample_chunks.
+        """
+        @torch.no_grad()
+        def posterior(x_chunk):
+            return self.posterior([a.to(self.device) for a in x_chunk])
+
+        def sample(posterior, n):
+            return posterior.sample(n)
+
+        return iter_sample_chunks(
+            sample,
+            x,
+            num_samples,
+            star_chunk_size or self.batch_size,
+            sample_chunk_size or self.batch_size,
+            prepare=posterior,
+            device=device
+        )
+
+    def sample_posterior_to_file(self, x, num_samples, path,
+                                 star_chunk_size=None,
+                                 sample_chunk_size=None):
+        """Stream posterior samples into a .npy memmap or HDF5 file."""
+        return write_sample_chunks(
+            self.iter_posterior_samples(
+                x, num_samples, star_chunk_size, sample_chunk_size
+            ),
+            path,
+            len(x[0]),
+            num_samples,
+            self.d
+        )
@@ -1,24 +1,36 @@
 from abc import ABC
-import copy
 
 import torch
 import torch.distributions as dist
 import torch.nn as nn
 import torch.utils.data as data_utils
 
+from .conditional import cached_conditional
+from .data import InMemoryBatches
 from .util import minibatch_k_means
 
 mvn = dist.multivariate_normal.MultivariateNormal
 
 
 class SGDGMMModule(nn.Module):
-
-    def __init__(self, components, dimensions, w, device=None):
+    """
+    GMM parameterised by softmax weights and Cholesky factors.
+
+    The weights, L and covariances are materialised at most once per
+    optimiser step: they are cached against the versions of the parameters
+    and the grad mode, and dropped once a backward pass has gone through
+    them, so forward, reg_loss and the posterior all share one copy. Pass
+    cache_params=False to rebuild them on every access.
+    """
+
+    def __init__(self, components, dimensions, w, device=None,
+                 cache_params=True):
         super().__init__()
 
         self.k = components
         self.d = dimensions
         self.device = device
+        self.cache_params = cache_params
 
         self.soft_weights = nn.Parameter(torch.zeros(self.k))
         self.soft_max = torch.nn.Softmax(dim=0)
@@ -33,24 +45,85 @@ class SGDGMMModule(nn.Module):
         self.d_idx = torch.eye(self.d, device=self.device).to(torch.bool)
         self.l_idx = torch.tril_indices(self.d, self.d, -1, device=self.device)
 
+        # Column of [0, exp(l_diag), l_lower] holding each entry of L
+        l_gather = torch.zeros(self.d, self.d, dtype=torch.long)
+        l_gather[self.d_idx.cpu()] = torch.arange(1, self.d + 1)
+        l_gather[self.l_idx[0].cpu(), self.l_idx[1].cpu()] = torch.arange(
+            self.d + 1, self.d + 1 + self.l_lower.shape[1]
+        )
+        self.register_buffer(
+            'l_gather', l_gather.flatten().to(device), persistent=False
+        )
+
         self.w = w * torch.eye(self.d, device=device)
 
+        self._cache = {}
+        self._cache_key = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        state['_cache_key'] = None
+        return state
+
+    def _materialise(self, name, compute):
+        if not self.cache_params:
+            return compute()
+
+        key = (torch.is_grad_enabled(),) + tuple(
+            (p.data_ptr(), p._version, p.requires_grad)
+            for p in (self.soft_weights, self.l_diag, self.l_lower)
+        )
+        if key != self._cache_key:
+            self._cache = {}
+            self._cache_key = key
+
+        if name not in self._cache:
+            value = compute()
+            if value.requires_grad:
+                # Backward frees the graph behind the cached value
+                value.register_hook(self._drop_cache)
+            self._cache[name] = value
+
+        return self._cache[name]
+
+    def _drop_cache(self, grad):
+        self._cache = {}
+        self._cache_key = None
+
+    def _compute_L(self):
+        params = torch.cat(
+            (
+                self.l_diag.new_zeros(self.k, 1),
+                torch.exp(self.l_diag),
+                self.l_lower
+            ),
+            dim=1
+        )
+        return params[:, self.l_gather].view(self.k, self.d, self.d)
+
+    @property
+    def weights(self):
+        return self._materialise(
+            'weights', lambda: self.soft_max(self.soft_weights)
+        )
+
     @property
     def L(self):
-        L = torch.zeros(self.k, self.d, self.d, device=self.device)
-        L[:, self.d_idx] = torch.exp(self.l_diag)
-        L[:, self.l_idx[0], self.l_idx[1]] = self.l_lower
-        return L
+        return self._materialise('L', self._compute_L)
 
     @property
     def covars(self):
-        return torch.matmul(self.L, torch.transpose(self.L, -2, -1))
+        return self._materialise(
+            'covars',
+            lambda: torch.matmul(self.L, torch.transpose(self.L, -2, -1))
+        )
 
     def forward(self, data):
 
         x = data[0]
 
-        weights = self.soft_max(self.soft_weights)
+        weights = self.weights
 
         log_resp = mvn(loc=self.means, scale_tril=self.L).log_prob(
             x[:, None, :]
@@ -70,7 +143,8 @@ class BaseSGDGMM(ABC):
     def __init__(self, components, dimensions, epochs=10000, lr=1e-3,
                  batch_size=64, tol=1e-6, max_no_improvement=20,
                  k_means_factor=100, w=1e-6, k_means_iters=10, lr_step=5,
-                 lr_gamma=0.1, device=None):
+                 lr_gamma=0.1, device=None, in_memory=False,
+                 optimiser='adam', lbfgs_iters=20):
         self.k = components
         self.d = dimensions
         self.epochs = epochs
@@ -81,6 +155,7 @@ class BaseSGDGMM(ABC):
         self.k_means_factor = k_means_factor
         self.k_means_iters = k_means_iters
         self.max_no_improvement = max_no_improvement
+        self.in_memory = in_memory
 
         if not device:
             self.device = torch.device('cpu')
@@ -88,16 +163,30 @@ class BaseSGDGMM(ABC):
             self.device = device
 
         self.module.to(device)
-
-        self.optimiser = torch.optim.Adam(
-            params=self.module.parameters(),
-            lr=self.lr
-        )
-        self.scheduler = torch.optim.lr_scheduler.MultiStepLR(
-            self.optimiser,
-            milestones=[lr_step, lr_step + 5],
-            gamma=lr_gamma
-        )
+        self._conditionals = {}
+
+        self.optimiser_type = optimiser
+        if optimiser == 'lbfgs':
+            # Each epoch is one L-BFGS step over full passes of the data
+            self.optimiser = torch.optim.LBFGS(
+                params=self.module.parameters(),
+                lr=1,
+                max_iter=lbfgs_iters,
+                line_search_fn='strong_wolfe'
+            )
+            self.scheduler = None
+        elif optimiser == 'adam':
+            self.optimiser = torch.optim.Adam(
+                params=self.module.parameters(),
+                lr=self.lr
+            )
+            self.scheduler = torch.optim.lr_scheduler.MultiStepLR(
+                self.optimiser,
+                milestones=[lr_step, lr_step + 5],
+                gamma=lr_gamma
+            )
+        else:
+            raise ValueError('Unknown optimiser: {}'.format(optimiser))
 
     @property
     def means(self):
@@ -107,15 +196,36 @@ class BaseSGDGMM(ABC):
     def covars(self):
         return self.module.covars.detach()
 
+    def conditional(self, observed):
+        """
+        GMMConditional for the given observed columns, cached per split.
+
+        Use its condition() for the mixture over the remaining columns and
+        marginal_log_prob() for the density of the observed ones. The cache
+        is dropped when fitting or initialising the parameters, and rebuilt
+        after in-place updates such as optimiser steps. Parameters replaced
+        through .data elsewhere need self._conditionals cleared.
+        """
+        key = tuple(p._version for p in self.module.parameters())
+        return cached_conditional(
+            self._conditionals,
+            key,
+            lambda: (self.module.weights, self.means, self.covars),
+            observed
+        )
+
     def reg_loss(self, n, n_total):
         l = (n / n_total) * self.w / torch.diagonal(self.module.covars, dim1=-1, dim2=-2)
         return l.sum()
 
     def fit(self, data, val_data=None, verbose=False, interval=1):
 
+        self._conditionals = {}
         n_total = len(data)
 
-        if self.batch_size is None:
+        if isinstance(data, data_utils.IterableDataset):
+            loader = data_utils.DataLoader(data, batch_size=None)
+        elif self.batch_size is None:
             loader = data_utils.DataLoader(
                 data,
                 batch_size=None,
@@ -123,15 +233,9 @@ class BaseSGDGMM(ABC):
                 sampler=data_utils.RandomSampler(data),
                 # pin_memory=True
             )
-            init_data = copy.deepcopy(data)
-            init_data.batch_size *= 16
-
-            init_loader = data_utils.DataLoader(
-                init_data,
-                batch_size=None,
-                # num_workers=8,
-                sampler=data_utils.RandomSampler(init_data),
-                # pin_memory=True
+        elif self.in_memory:
+            loader = InMemoryBatches(
+                data, self.batch_size, device=self.device
             )
         else:
             loader = data_utils.DataLoader(
@@ -142,13 +246,8 @@ class BaseSGDGMM(ABC):
                 # pin_memory=True
             )
 
-            init_loader = data_utils.DataLoader(
-                data,
-                batch_size=16 * self.batch_size,
-                # num_workers=8,
-                shuffle=True,
-                # pin_memory=True
-            )
+        if val_data:
+            val_loader = self._score_loader(val_data)
 
         self.init_params(loader)
 
@@ -163,32 +262,20 @@ class BaseSGDGMM(ABC):
             no_improvement_epochs = 0
 
         for i in range(self.epochs):
-            train_loss = 0.0
-            for j, d in enumerate(loader):
-
-                d = [a.to(self.device) for a in d]
-
-                self.optimiser.zero_grad()
-
-                log_prob = self.module(d)
-                loss = -1 * torch.mean(log_prob)
-
-                train_loss += torch.sum(log_prob).item()
-
-                n = d[0].shape[0]
-                loss += self.reg_loss(n, n_total)
-
-                loss.backward()
-                self.optimiser.step()
+            if self.optimiser_type == 'lbfgs':
+                train_loss = self._lbfgs_epoch(loader, n_total)
+            else:
+                train_loss = self._adam_epoch(loader, n_total)
             train_loss /= len(data)
 
             self.train_loss_curve.append(train_loss)
 
             if val_data:
-                val_loss = self.score_batch(val_data) / len(val_data)
+                val_loss = self._score_batches(val_loader) / len(val_data)
                 self.val_loss_curve.append(val_loss)
 
-            self.scheduler.step()
+            if self.scheduler is not None:
+                self.scheduler.step()
 
             if verbose and i % interval == 0:
                 if val_data:
@@ -222,17 +309,80 @@ class BaseSGDGMM(ABC):
 
             prev_loss = train_loss
 
+    def _adam_epoch(self, loader, n_total):
+        train_loss = 0.0
+        for j, d in enumerate(loader):
+
+            d = [a.to(self.device) for a in d]
+
+            self.optimiser.zero_grad()
+
+            log_prob = self.module(d)
+            loss = -1 * torch.mean(log_prob)
+
+            train_loss += torch.sum(log_prob).item()
+
+            n = d[0].shape[0]
+            loss += self.reg_loss(n, n_total)
+
+            loss.backward()
+            self.optimiser.step()
+
+        return train_loss
+
+    def _lbfgs_epoch(self, loader, n_total):
+        log_probs = []
+
+        def closure():
+            self.optimiser.zero_grad()
+            total_loss = 0.0
+            total_log_prob = 0.0
+            for d in loader:
+                d = [a.to(self.device) for a in d]
+
+                log_prob = self.module(d)
+                loss = -1 * torch.sum(log_prob) / n_total
+
+                n = d[0].shape[0]
+                loss += self.reg_loss(n, n_total)
+
+                loss.backward()
+                total_loss += loss.item()
+                total_log_prob += torch.sum(log_prob).item()
+
+            log_probs.append(total_log_prob)
+            return total_loss
+
+        self.optimiser.step(closure)
+
+        # As with Adam, report the log-likelihood before the step
+        return log_probs[0]
+
     def score(self, data):
         return self.module(data)
 
     def score_batch(self, dataset):
-        loader = data_utils.DataLoader(
+        return self._score_batches(self._score_loader(dataset))
+
+    def _score_loader(self, dataset):
+        if isinstance(dataset, data_utils.IterableDataset):
+            batch_size = None
+        else:
+            batch_size = self.batch_size
+
+        if self.in_memory and batch_size is not None:
+            return InMemoryBatches(
+                dataset, batch_size, shuffle=False, device=self.device
+            )
+
+        return data_utils.DataLoader(
             dataset,
-            batch_size=self.batch_size,
+            batch_size=batch_size,
             # num_workers=4,
             # pin_memory=True
         )
 
+    def _score_batches(self, loader):
         log_prob = 0
         with torch.no_grad():
             for j, d in enumerate(loader):
@@ -240,20 +390,28 @@ class BaseSGDGMM(ABC):
                 log_prob += torch.sum(self.score(d)).item()
 
         return log_prob
-    
+
     def _sample(self, num_samples):
-        
-        weights = self.module.soft_max(self.module.soft_weights)
-        idx = dist.Categorical(probs=weights).sample([num_samples])
-        X = dist.MultivariateNormal(loc=self.module.means, scale_tril=self.module.L).sample([num_samples])
-        
-        return X[
-            torch.arange(num_samples, device=self.device),
-            idx,
-            :
-        ]
+        """Draw exact multinomial counts, then sample each component once."""
+        with torch.no_grad():
+            weights = self.module.weights
+            means = self.module.means
+            L = self.module.L
+
+            counts = dist.Multinomial(num_samples, probs=weights).sample()
+
+            X = means.new_empty(num_samples, self.d)
+            start = 0
+            for j in counts.nonzero(as_tuple=True)[0].tolist():
+                stop = start + int(counts[j])
+                eps = torch.randn_like(X[start:stop])
+                X[start:stop] = means[j] + eps @ L[j].T
+                start = stop
+
+            return X[torch.randperm(num_samples, device=means.device)]
 
     def init_params(self, loader):
+        self._conditionals = {}
         counts, centroids = minibatch_k_means(loader, self.k, max_iters=self.k_means_iters, device=self.device)
         self.module.soft_weights.data = torch.log(counts / counts.sum())
         self.module.means.data = centroids
@@ -264,9 +422,14 @@ class BaseSGDGMM(ABC):
 class SGDGMM(BaseSGDGMM):
 
     def __init__(self, components, dimensions, epochs=10000, lr=1e-3,
-                 batch_size=64, tol=1e-6, w=1e-3, device=None):
-        self.module = SGDGMMModule(components, dimensions, w, device)
+                 batch_size=64, tol=1e-6, w=1e-3, device=None,
+                 cache_params=True, in_memory=False, optimiser='adam',
+                 lbfgs_iters=20):
+        self.module = SGDGMMModule(
+            components, dimensions, w, device, cache_params=cache_params
+        )
         super().__init__(
             components, dimensions, epochs=epochs, lr=lr,
-            batch_size=batch_size, w=w, tol=tol, device=device
+            batch_size=batch_size, w=w, tol=tol, device=device,
+            in_memory=in_memory, optimiser=optimiser, lbfgs_iters=lbfgs_iters
         )
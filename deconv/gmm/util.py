@@ -1,4 +1,5 @@
 import torch
+import torch.utils.data as data_utils
 
 
 def k_means(X, k, max_iters=50, tol=1e-9, device=None):
@@ -33,6 +34,48 @@ def k_means(X, k, max_iters=50, tol=1e-9, device=None):
         return resp.float(), centroids
 
 
+def masked_k_means(X, mask, k, max_iters=50, tol=1e-9, device=None):
+    """
+    k-means of partially observed rows on their observed dimensions.
+
+    Distances only run over the dimensions each row observes, and every
+    centroid coordinate is the mean of the cluster's rows that observe it;
+    coordinates that no row of a cluster observes keep their value.
+    """
+    n, d = X.shape
+    m = mask.to(X.dtype)
+
+    big = torch.finfo(X.dtype).max
+    observed = mask.any(dim=0)
+    x_min = torch.where(mask, X, big).min(dim=0)[0].where(observed, X.new_zeros(()))
+    x_max = torch.where(mask, X, -big).max(dim=0)[0].where(observed, X.new_zeros(()))
+
+    centroids = torch.rand(
+        k, d, device=device
+    ) * (x_max - x_min) + x_min
+
+    prev_distance = torch.tensor(float('inf'), device=device)
+
+    for i in range(max_iters):
+        distances = (
+            (X[:, None, :] - centroids[None, :, :]).pow(2) * m[:, None, :]
+        ).sum(dim=2).sqrt()
+        labels = distances.min(dim=1)[1]
+        resp = torch.nn.functional.one_hot(labels, k).to(X.dtype)
+
+        counts = resp.T @ m
+        centroids = torch.where(
+            counts > 0, (resp.T @ (X * m)) / counts.clamp(min=1), centroids
+        )
+        total_distance = distances.gather(1, labels[:, None]).sum()
+
+        if torch.abs(total_distance - prev_distance) < tol:
+            break
+        prev_distance = total_distance
+
+    return resp, centroids
+
+
 def minibatch_k_means(loader, k, max_iters=50, tol=1e-3, device=None):
     """
     Do minibatch version of k-means
@@ -74,3 +117,66 @@ def minibatch_k_means(loader, k, max_iters=50, tol=1e-3, device=None):
     print('Finished minibatch_k_means')
     return counts, centroids
 
+
+def reservoir_sample(stream, size):
+    """
+    Uniform sample of size rows, without replacement, from one pass over a
+    stream of batches.
+
+    stream is an IterableDataset yielding tuples of tensors with rows of any
+    count, as for Rebatched. Every row gets a uniform random key and the
+    size rows with the smallest keys are kept, so at most size rows plus one
+    batch are held at a time. Returns the sampled rows as a list of tensors.
+    """
+    rows, keys = None, None
+
+    for batch in data_utils.DataLoader(stream, batch_size=None):
+        batch_keys = torch.rand(batch[0].shape[0], device=batch[0].device)
+        if rows is not None:
+            batch = [torch.cat(a) for a in zip(rows, batch)]
+            batch_keys = torch.cat([keys, batch_keys])
+
+        keep = torch.topk(
+            batch_keys, min(size, batch_keys.shape[0]), largest=False
+        ).indices
+        rows = [a[keep] for a in batch]
+        keys = batch_keys[keep]
+
+    return rows
+
+
+class Rebatched:
+    """
+    Regroup a stream of batches into batches of batch_size rows.
+
+    stream is an IterableDataset yielding tuples of tensors with rows of any
+    count. Each iteration re-reads the stream, so it can serve as the loader
+    for several epochs. With drop_last the short final batch is skipped.
+    """
+
+    def __init__(self, stream, batch_size, drop_last=False):
+        self.stream = stream
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        pieces = []
+        n = 0
+
+        for batch in data_utils.DataLoader(self.stream, batch_size=None):
+            pieces.append(batch)
+            n += batch[0].shape[0]
+
+            if n < self.batch_size:
+                continue
+
+            joined = [torch.cat(a) for a in zip(*pieces)]
+            n_full = (n // self.batch_size) * self.batch_size
+            for start in range(0, n_full, self.batch_size):
+                yield [a[start:start + self.batch_size] for a in joined]
+
+            pieces = [[a[n_full:] for a in joined]]
+            n -= n_full
+
+        if n > 0 and not self.drop_last:
+            yield [torch.cat(a) for a in zip(*pieces)]
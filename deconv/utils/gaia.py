@@ -0,0 +1,235 @@
+"""
+Ingest of Gaia DR2 source catalogues.
+
+Assembles data vectors and noise covariances from the astrometric and
+photometric columns, either for a whole DataFrame or as a stream of
+torch batches that can be fed to the online and SGD fitters while the
+catalogue is still being parsed.
+"""
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+import torch.utils.data as data_utils
+
+columns = [
+    'ra',
+    'dec',
+    'parallax',
+    'pmra',
+    'pmdec',
+    'bp_rp',
+    'phot_g_mean_mag'
+]
+
+error_columns = [
+    'ra_error',
+    'dec_error',
+    'parallax_error',
+    'pmra_error',
+    'pmdec_error',
+]
+
+corr_map = {
+    'ra_dec_corr': [0, 1],
+    'ra_parallax_corr': [0, 2],
+    'ra_pmra_corr': [0, 3],
+    'ra_pmdec_corr': [0, 4],
+    'dec_parallax_corr': [1, 2],
+    'dec_pmra_corr': [1, 3],
+    'dec_pmdec_corr': [1, 4],
+    'parallax_pmra_corr': [2, 3],
+    'parallax_pmdec_corr': [2, 4],
+    'pmra_pmdec_corr': [3, 4]
+}
+
+catalogue_columns = columns + error_columns + list(corr_map.keys())
+
+photometric_error = 0.01
+
+
+def catalogue_to_numpy(df, return_mask=False):
+    """
+    Assemble data vectors and noise covariances from a catalogue.
+
+    Missing values are filled with 0 and given a huge variance. With
+    return_mask=True a boolean mask of the observed dimensions is returned as
+    well, which lets the fitters marginalise the missing ones exactly.
+    """
+    n = len(df)
+    d = len(columns)
+
+    X = df[columns].fillna(0.0).to_numpy(dtype=np.float32, copy=True)
+
+    errors = np.full((n, d), photometric_error, dtype=np.float32)
+    errors[:, :len(error_columns)] = df[error_columns].fillna(1e6).to_numpy(
+        dtype=np.float32
+    )
+
+    C = np.zeros((n, d, d), dtype=np.float32)
+    diag = np.arange(d)
+    C[:, diag, diag] = errors
+
+    for column, (i, j) in corr_map.items():
+        C[:, i, j] = df[column].fillna(0).to_numpy(dtype=np.float32)
+        C[:, i, j] *= (C[:, i, i] * C[:, j, j])
+        C[:, j, i] = C[:, i, j]
+
+    C[:, diag, diag] = C[:, diag, diag]**2
+
+    if return_mask:
+        M = df[columns].notna().to_numpy(copy=True)
+        M[:, :len(error_columns)] &= df[error_columns].notna().to_numpy()
+        return X, C, M
+
+    return X, C
+
+
+def read_catalogue_chunks(path, chunk_size):
+    """
+    Yield DataFrames of at most chunk_size rows from a CSV or VOTable file.
+
+    CSV files are parsed incrementally. The VOTable parser cannot stream, so
+    only the catalogue columns are read and the DataFrames are built one
+    chunk at a time from them.
+    """
+    if os.path.splitext(path)[1] in ('.vot', '.xml', '.votable'):
+        from astropy.io.votable import parse_single_table
+
+        tb = parse_single_table(path, columns=catalogue_columns).to_table()
+        for start in range(0, len(tb), chunk_size):
+            yield tb[start:start + chunk_size].to_pandas()
+    else:
+        import pandas as pd
+
+        for df in pd.read_csv(path, usecols=catalogue_columns,
+                              chunksize=chunk_size):
+            yield df
+
+
+def count_catalogue_rows(path):
+    """Count the rows of a CSV or VOTable file without assembling them."""
+    if os.path.splitext(path)[1] in ('.vot', '.xml', '.votable'):
+        from astropy.io.votable import parse_single_table
+
+        table = parse_single_table(path, columns=catalogue_columns[:1])
+        return len(table.array)
+
+    with open(path, 'rb') as f:
+        return sum(1 for _ in f) - 1
+
+
+class CatalogueStream(data_utils.IterableDataset):
+    """
+    Stream of ready (X, C) batches assembled from catalogue files.
+
+    Parsing and covariance assembly run in a background thread that stays
+    up to `prefetch` chunks ahead of the consumer, so they overlap with
+    fitting. Pass the stream straight to OnlineDeconvGMM.fit or
+    SGDDeconvGMM.fit in place of a map-style dataset; rows are produced in
+    file order, so the catalogue should already be shuffled. When used with
+    DataLoader workers, the files are shared out between them. With
+    return_mask=True the batches are (X, C, mask). The final batch is short
+    unless drop_last is set.
+
+    len() counts the rows of every file, which for VOTables means parsing
+    them; pass n_rows if it is known. Files already streamed once are not
+    counted again.
+    """
+
+    def __init__(self, paths, batch_size=512, chunk_size=None, n_rows=None,
+                 prefetch=2, return_mask=False, drop_last=False):
+        if isinstance(paths, str):
+            if os.path.isdir(paths):
+                paths = [
+                    os.path.join(paths, f) for f in sorted(os.listdir(paths))
+                ]
+            else:
+                paths = [paths]
+
+        self.paths = paths
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size or 64 * batch_size
+        self.n_rows = n_rows
+        self.prefetch = prefetch
+        self.return_mask = return_mask
+        self.drop_last = drop_last
+        self._path_rows = {}
+
+    def __len__(self):
+        if self.n_rows is None:
+            self.n_rows = sum(
+                self._path_rows.get(p) or count_catalogue_rows(p)
+                for p in self.paths
+            )
+        return self.n_rows
+
+    def _worker_paths(self):
+        info = data_utils.get_worker_info()
+        if info is None:
+            return self.paths
+        return self.paths[info.id::info.num_workers]
+
+    def _chunks(self, paths):
+        for path in paths:
+            rows = 0
+            for df in read_catalogue_chunks(path, self.chunk_size):
+                rows += len(df)
+                yield catalogue_to_numpy(df, return_mask=self.return_mask)
+            self._path_rows[path] = rows
+
+    def _prefetched_chunks(self, paths):
+        chunks = queue.Queue(maxsize=self.prefetch)
+        done = object()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for chunk in self._chunks(paths):
+                    if stop.is_set():
+                        return
+                    chunks.put(chunk)
+            except Exception as e:
+                chunks.put(e)
+            chunks.put(done)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is done:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stop.set()
+            while producer.is_alive():
+                try:
+                    chunks.get_nowait()
+                except queue.Empty:
+                    producer.join(0.1)
+
+    def __iter__(self):
+        rest = None
+
+        for chunk in self._prefetched_chunks(self._worker_paths()):
+            if rest is not None:
+                chunk = tuple(
+                    np.concatenate((r, a)) for r, a in zip(rest, chunk)
+                )
+
+            n = chunk[0].shape[0]
+            n_full = (n // self.batch_size) * self.batch_size
+            for start in range(0, n_full, self.batch_size):
+                stop = start + self.batch_size
+                yield tuple(torch.from_numpy(a[start:stop]) for a in chunk)
+
+            rest = tuple(a[n_full:] for a in chunk)
+
+        if rest is not None and rest[0].shape[0] > 0 and not self.drop_last:
+            yield tuple(torch.from_numpy(a) for a in rest)
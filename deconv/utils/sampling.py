@@ -1,9 +1,16 @@
+import os
+import queue
+import threading
+
+import numpy as np
 import torch
 
     
 def minibatch_sample(sample_f, num_samples, dimensions, batch_size, device=torch.device('cpu'), context=None, x=None):
     
-    if x is not None:
+    if isinstance(x, (tuple, list)):
+        ld = len(x[0])
+    elif x is not None:
         ld = len(x)
     elif context is not None:
         ld = context.shape[0]
@@ -21,4 +28,107 @@ def minibatch_sample(sample_f, num_samples, dimensions, batch_size, device=torch
         else:
             samples[:, start:stop, :] = sample_f(x, n, context=context).to(device)
         
-    return samples
\ No newline at end of file
+    return samples
+
+
+def _rows(x, start, stop):
+    if isinstance(x, (tuple, list)):
+        return [torch.as_tensor(a[start:stop]) for a in x]
+    return torch.as_tensor(x[start:stop])
+
+
+def iter_sample_chunks(sample_f, x, num_samples, star_chunk_size,
+                       sample_chunk_size, prepare=None,
+                       device=torch.device('cpu')):
+    """
+    Yield (star offset, sample offset, samples) in chunks over both axes.
+
+    x is a tensor or array, or a tuple of them, indexed by star; memmaps and
+    h5py datasets are only read one star chunk at a time. prepare is applied
+    once to each star chunk, for example to run an encoder, and
+    sample_f(prepared, n) returns a (stars, n, d) tensor.
+    """
+    n_stars = len(x[0]) if isinstance(x, (tuple, list)) else len(x)
+
+    for star_start in range(0, n_stars, star_chunk_size):
+        star_stop = min(star_start + star_chunk_size, n_stars)
+        chunk = _rows(x, star_start, star_stop)
+        if prepare is not None:
+            chunk = prepare(chunk)
+
+        for sample_start in range(0, num_samples, sample_chunk_size):
+            n = min(sample_chunk_size, num_samples - sample_start)
+            yield star_start, sample_start, sample_f(chunk, n).to(device)
+
+
+def _open_output(path, shape):
+    if os.path.splitext(path)[1] in ('.h5', '.hdf5'):
+        import h5py
+
+        store = h5py.File(path, 'w')
+        out = store.create_dataset(
+            'samples',
+            shape,
+            dtype=np.float32,
+            chunks=(min(shape[0], 512), min(shape[1], 64), shape[2])
+        )
+        return store, out
+
+    out = np.lib.format.open_memmap(
+        path, mode='w+', dtype=np.float32, shape=shape
+    )
+    return None, out
+
+
+def write_sample_chunks(chunks, path, n_stars, num_samples, dimensions,
+                        max_queue=4):
+    """
+    Write the chunks of iter_sample_chunks to a .npy memmap or HDF5 file.
+
+    Writing happens in a background thread fed through a queue of at most
+    max_queue chunks, so it overlaps with sampling while memory stays
+    bounded. HDF5 output goes to a 'samples' dataset.
+    """
+    store, out = _open_output(path, (n_stars, num_samples, dimensions))
+    chunk_queue = queue.Queue(maxsize=max_queue)
+    errors = []
+
+    def write():
+        while True:
+            item = chunk_queue.get()
+            if item is None:
+                return
+            if errors:
+                continue
+            star_start, sample_start, samples = item
+            try:
+                out[
+                    star_start:star_start + samples.shape[0],
+                    sample_start:sample_start + samples.shape[1]
+                ] = samples
+            except Exception as e:
+                errors.append(e)
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+
+    try:
+        for star_start, sample_start, samples in chunks:
+            if errors:
+                break
+            chunk_queue.put(
+                (star_start, sample_start, samples.cpu().numpy())
+            )
+    finally:
+        chunk_queue.put(None)
+        writer.join()
+
+        if store is not None:
+            store.close()
+        else:
+            out.flush()
+
+    if errors:
+        raise errors[0]
+
+    return path
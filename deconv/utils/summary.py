@@ -0,0 +1,136 @@
+import torch
+
+
+class PosteriorSummary:
+    """
+    Per-star posterior means, covariances and quantiles from sample chunks.
+
+    Consumes the (star offset, sample offset, samples) chunks of
+    iter_sample_chunks without keeping the samples. Moments are merged chunk
+    by chunk with Chan's parallel form of Welford's update. Quantiles of each
+    dimension come from a histogram per star whose range is set by the first
+    chunk to mean +- width standard deviations, with one overflow bin on
+    either side bounded by the running minimum and maximum, so they are
+    approximate to about a bin width.
+
+    Only the star chunk currently being sampled is held in memory; the
+    results for finished chunks are (n, d) or (n, d, d) tensors.
+    """
+
+    def __init__(self, n_stars, dimensions, quantiles=(0.16, 0.5, 0.84),
+                 bins=256, width=5.0):
+        self.q = torch.as_tensor(quantiles, dtype=torch.float64)
+        self.bins = bins
+        self.width = width
+
+        self.means = torch.zeros(n_stars, dimensions, dtype=torch.float64)
+        self.covars = torch.zeros(
+            n_stars, dimensions, dimensions, dtype=torch.float64
+        )
+        self.quantiles = torch.zeros(
+            len(self.q), n_stars, dimensions, dtype=torch.float64
+        )
+
+        self._star_start = None
+
+    def update(self, star_start, sample_start, samples):
+        samples = samples.detach().to('cpu', torch.float64)
+
+        if star_start != self._star_start:
+            if self._star_start is not None:
+                self._finalise_chunk()
+            self._start_chunk(star_start, samples)
+
+        n_b = samples.shape[1]
+        b_mean = samples.mean(dim=1)
+        diff = samples - b_mean[:, None, :]
+        b_M2 = torch.matmul(diff.transpose(1, 2), diff)
+
+        n = self._count + n_b
+        delta = b_mean - self._mean
+        self._mean += delta * n_b / n
+        self._M2 += b_M2 + (
+            delta[:, :, None] * delta[:, None, :] * self._count * n_b / n
+        )
+        self._count = n
+
+        self._min = torch.min(self._min, samples.min(dim=1)[0])
+        self._max = torch.max(self._max, samples.max(dim=1)[0])
+
+        idx = torch.floor(
+            (samples - self._lo[:, None, :]) / self._step[:, None, :]
+        ).clamp_(-1, self.bins).long() + 1
+        self._hist.scatter_add_(
+            2,
+            idx.transpose(1, 2),
+            torch.ones_like(idx, dtype=torch.float64).transpose(1, 2)
+        )
+
+    def finalise(self):
+        """Summarise the last star chunk and return the results."""
+        if self._star_start is not None:
+            self._finalise_chunk()
+            self._star_start = None
+        return self.means, self.covars, self.quantiles
+
+    def _start_chunk(self, star_start, samples):
+        m, _, d = samples.shape
+        self._star_start = star_start
+        self._count = 0
+        self._mean = samples.new_zeros(m, d)
+        self._M2 = samples.new_zeros(m, d, d)
+        self._min = samples.min(dim=1)[0]
+        self._max = samples.max(dim=1)[0]
+
+        centre = samples.mean(dim=1)
+        half = self.width * samples.std(dim=1).nan_to_num_(0.0)
+        half = torch.where(half > 0, half, torch.ones_like(half))
+        self._lo = centre - half
+        self._step = 2 * half / self.bins
+        self._hist = samples.new_zeros(m, d, self.bins + 2)
+
+    def _finalise_chunk(self):
+        start = self._star_start
+        stop = start + self._mean.shape[0]
+
+        self.means[start:stop] = self._mean
+        self.covars[start:stop] = self._M2 / max(self._count - 1, 1)
+        self.quantiles[:, start:stop] = self._histogram_quantiles().permute(
+            2, 0, 1
+        )
+
+    def _histogram_quantiles(self):
+        m, d, _ = self._hist.shape
+        hi = self._lo + self.bins * self._step
+        inner = self._lo[:, :, None] + self._step[:, :, None] * torch.arange(
+            self.bins + 1, dtype=torch.float64
+        )
+        edges = torch.cat([
+            torch.min(self._min, self._lo)[:, :, None],
+            inner,
+            torch.max(self._max, hi)[:, :, None]
+        ], dim=2)    # m, d, bins + 3
+
+        cdf = self._hist.cumsum(dim=2)
+        target = (self.q * self._count).expand(m, d, -1).contiguous()
+        idx = torch.searchsorted(cdf, target).clamp_(max=self.bins + 1)
+
+        below = torch.where(
+            idx > 0,
+            cdf.gather(2, (idx - 1).clamp(min=0)),
+            torch.zeros_like(target)
+        )
+        in_bin = self._hist.gather(2, idx)
+        frac = ((target - below) / in_bin.clamp(min=1)).clamp_(0, 1)
+
+        left = edges.gather(2, idx)
+        right = edges.gather(2, idx + 1)
+        return left + frac * (right - left)    # m, d, q
+
+
+def summarise_chunks(chunks, n_stars, dimensions, **kwargs):
+    """Reduce the chunks of iter_sample_chunks to means, covars, quantiles."""
+    summary = PosteriorSummary(n_stars, dimensions, **kwargs)
+    for chunk in chunks:
+        summary.update(*chunk)
+    return summary.finalise()
@@ -0,0 +1,73 @@
+"""
+Inference entry points of MAFlow and SVIFlow, eager against compiled.
+
+The eager and compiled models are timed in alternating rounds, after a
+warm-up call that includes compilation, and the median round is reported.
+"""
+import statistics
+import time
+
+import torch
+
+from deconv.gmm.data import DeconvDataset
+from deconv.flow.maf import MAFlow
+from deconv.flow.svi import SVIFlow
+
+
+def rows_per_second(f, n):
+    start = time.perf_counter()
+    f()
+    return n / (time.perf_counter() - start)
+
+
+def bench_compiled_inference(D, n, num_samples, rounds=5):
+    torch.manual_seed(0)
+    X = torch.randn(n, D)
+    noise_l = torch.linalg.cholesky(
+        torch.eye(D) + 0.1 * torch.ones(D, D)
+    ).repeat(n, 1, 1)
+    dataset = DeconvDataset(X, noise_l)
+
+    models = {}
+    for compile_inference in (False, True):
+        torch.manual_seed(0)
+        maf = MAFlow(D, batch_size=512, compile_inference=compile_inference)
+        torch.manual_seed(0)
+        svi = SVIFlow(
+            D, 5, 1e-3, 1, batch_size=512,
+            compile_inference=compile_inference
+        )
+        models[compile_inference] = (maf, svi)
+
+    def entry_points(maf, svi):
+        return {
+            'MAFlow.score_batch': lambda: maf.score_batch(dataset),
+            'SVIFlow.score_batch': lambda: svi.score_batch(
+                dataset, num_samples=num_samples
+            ),
+            'SVIFlow.sample_prior': lambda: svi.sample_prior(n),
+            'SVIFlow.sample_posterior': lambda: svi.sample_posterior(
+                (X, noise_l), num_samples
+            ),
+        }
+
+    print('D={}, {} rows, {} samples per row for SVIFlow, median of {} '
+          'rounds'.format(D, n, num_samples, rounds))
+    for name in entry_points(*models[False]):
+        fs = {c: entry_points(*models[c])[name] for c in (False, True)}
+        for f in fs.values():
+            f()     # Warm up, which includes compilation
+
+        rates = {False: [], True: []}
+        for _ in range(rounds):
+            for c, f in fs.items():
+                rates[c].append(rows_per_second(f, n))
+
+        eager, compiled = (statistics.median(rates[c]) for c in (False, True))
+        print('{}: eager {:.0f} rows/s, compiled {:.0f} rows/s ({:+.0%})'.format(
+            name, eager, compiled, compiled / eager - 1
+        ))
+
+
+if __name__ == '__main__':
+    bench_compiled_inference(D=7, n=4096, num_samples=10)
@@ -0,0 +1,55 @@
+import time
+
+import torch
+from torch.distributions import MultivariateNormal
+
+from deconv.flow.distributions import DeconvGaussian
+
+
+def mvn_log_prob(inputs, context):
+    """The previous DeconvGaussian, for reference."""
+    return MultivariateNormal(
+        loc=context, scale_tril=inputs[1]
+    ).log_prob(inputs[0])
+
+
+def time_log_prob(log_prob, inputs, context, repeats=50):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = log_prob(inputs, context)
+        grad, = torch.autograd.grad(out.sum(), context)
+    return (time.perf_counter() - start) / repeats, out
+
+
+def bench_deconv_gaussian(n, K, D):
+    torch.manual_seed(0)
+    X = torch.randn(n, D)
+    A = torch.randn(n, D, D)
+    noise_l = torch.linalg.cholesky(
+        A @ A.transpose(-2, -1) / D + torch.eye(D)
+    )
+    logdet = 2 * noise_l.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+    context = torch.randn(n, K, D, requires_grad=True)
+
+    inputs = (X[:, None], noise_l[:, None])
+    factorised = (X[:, None], noise_l[:, None], logdet[:, None])
+
+    reference = mvn_log_prob(
+        tuple(a.double() for a in inputs), context.double()
+    )
+
+    print('n={}, K={}, D={}, forward and backward'.format(n, K, D))
+    for label, log_prob, x in (
+        ('MultivariateNormal', mvn_log_prob, inputs),
+        ('Fused float32', DeconvGaussian().log_prob, inputs),
+        ('Fused float32, cached log-det', DeconvGaussian().log_prob, factorised),
+        ('Fused float64', DeconvGaussian(torch.float64).log_prob, inputs)
+    ):
+        elapsed, out = time_log_prob(log_prob, x, context)
+        print('{}: {:.2f} ms, max error {:.1e}'.format(
+            label, 1e3 * elapsed, (out.double() - reference).abs().max().item()
+        ))
+
+
+if __name__ == '__main__':
+    bench_deconv_gaussian(n=512, K=50, D=7)
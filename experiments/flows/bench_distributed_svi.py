@@ -0,0 +1,72 @@
+"""
+Scaling of SVIFlow.fit over 1..N CPU processes with gloo.
+
+Each configuration trains the same model from the same seed for a fixed
+number of epochs, and reports the wall time, the speed-up over the single
+process fit and the validation ELBO. Each rank takes batches of
+batch_size, so with N processes the global batch is N times larger and
+there are N times fewer optimiser steps per epoch; the ELBOs are close but
+not equal. Times include spawning the processes.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+from deconv.gmm.data import DeconvDataset
+from deconv.flow.svi import SVIFlow
+
+
+def make_data(n, seed):
+    rng = np.random.default_rng(seed)
+    centres = np.array([[0.0, 0.0], [3.0, 3.0], [3.0, -3.0]])
+    X = centres[rng.integers(3, size=n)] + 0.3 * rng.standard_normal((n, 2))
+    noise_covars = np.repeat(0.5 * np.eye(2)[None], n, axis=0)
+    X += rng.standard_normal((n, 2)) * np.sqrt(0.5)
+    return DeconvDataset(
+        torch.Tensor(X.astype(np.float32)),
+        torch.linalg.cholesky(torch.Tensor(noise_covars.astype(np.float32)))
+    )
+
+
+def make_flow(epochs):
+    torch.manual_seed(0)
+    return SVIFlow(
+        2, 3, 1e-3, epochs, context_size=16, hidden_features=32,
+        batch_size=256, n_samples=10
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--n', type=int, default=8192)
+    parser.add_argument('--epochs', type=int, default=3)
+    args = parser.parse_args()
+
+    print('cores: {}'.format(os.cpu_count()))
+
+    train_data = make_data(args.n, 1)
+    val_data = make_data(2048, 2)
+
+    baseline = None
+    for processes in args.processes:
+        flow = make_flow(args.epochs)
+
+        start = time.perf_counter()
+        if processes == 1:
+            flow.fit(train_data)
+        else:
+            flow.fit_distributed(train_data, processes=processes)
+        elapsed = time.perf_counter() - start
+
+        if baseline is None:
+            baseline = elapsed
+
+        torch.manual_seed(1)
+        val = flow.score_batch(val_data, num_samples=50) / len(val_data)
+        print('processes {}: {:.1f}s, speed-up {:.2f}x, val ELBO {:.4f}'.format(
+            processes, elapsed, baseline / elapsed, val
+        ))
@@ -0,0 +1,85 @@
+import time
+
+import torch
+from nflows import utils
+
+from deconv.flow.svi import SVIFlow
+
+
+def repeated_elbo(model, inputs, num_samples):
+    """The ELBO with the inputs repeated once per sample, for reference."""
+    context = model._inputs_encoder(inputs)
+    latents, log_q_z = model._approximate_posterior.sample_and_log_prob(
+        num_samples, context=context
+    )
+    latents = utils.merge_leading_dims(latents, num_dims=2)
+    log_q_z = utils.merge_leading_dims(log_q_z, num_dims=2)
+    log_p_z = model._prior.log_prob(latents)
+    inputs = tuple(utils.repeat_rows(i, num_reps=num_samples) for i in inputs)
+    log_p_x = model._likelihood.log_prob(inputs, context=latents)
+    elbo = log_p_x + log_p_z - log_q_z
+    return utils.split_leading_dim(elbo, [-1, num_samples]).mean(dim=1)
+
+
+def likelihood_saved_bytes(model, elbo, inputs, num_samples):
+    """Bytes saved for backward by the likelihood term alone."""
+    total = [0]
+
+    def pack(t):
+        total[0] += t.numel() * t.element_size()
+        return t
+
+    likelihood = model._likelihood
+    log_prob = likelihood.log_prob
+
+    def counted(*args, **kwargs):
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            return log_prob(*args, **kwargs)
+
+    likelihood.log_prob = counted
+    try:
+        elbo(model, inputs, num_samples)
+    finally:
+        del likelihood.log_prob
+
+    return total[0]
+
+
+def time_step(model, elbo, inputs, num_samples, repeats=5):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.zero_grad()
+        loss = -elbo(model, inputs, num_samples).mean()
+        loss.backward()
+    return (time.perf_counter() - start) / repeats
+
+
+def bench_elbo_sample_axis(D, n, num_samples):
+    torch.manual_seed(0)
+    svi = SVIFlow(D, 5, 1e-3, 1, batch_size=n, n_samples=num_samples)
+
+    X = torch.randn(n, D)
+    noise_l = torch.linalg.cholesky(
+        torch.eye(D) + 0.1 * torch.ones(D, D)
+    ).repeat(n, 1, 1)
+    inputs = (X, noise_l)
+
+    def broadcast_elbo(model, inputs, num_samples):
+        return model.stochastic_elbo(inputs, num_samples=num_samples)
+
+    print('D={}, batch {}, {} samples'.format(D, n, num_samples))
+    for label, elbo in (
+        ('Repeated rows', repeated_elbo),
+        ('Broadcast', broadcast_elbo)
+    ):
+        print('{}: {:.1f} ms/step, likelihood saves {:.2f} MB'.format(
+            label,
+            1e3 * time_step(svi.model, elbo, inputs, num_samples),
+            likelihood_saved_bytes(
+                svi.model, elbo, inputs, num_samples
+            ) / 2**20
+        ))
+
+
+if __name__ == '__main__':
+    bench_elbo_sample_axis(D=7, n=512, num_samples=50)
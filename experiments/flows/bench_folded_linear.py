@@ -0,0 +1,58 @@
+import time
+
+import torch
+
+from deconv.flow.linear import FoldableLinear
+from deconv.flow.maf import MAFlow
+
+
+def timed(f, repeats=20):
+    f()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        f()
+    return (time.perf_counter() - start) / repeats
+
+
+def bench_folded_linear(D, n, flow_steps):
+    torch.manual_seed(0)
+    maf = MAFlow(D, flow_steps=flow_steps)
+    # Move the LU layers away from their identity initialisation
+    for name, p in maf.flow.named_parameters():
+        if name.endswith('_entries'):
+            p.data.normal_(0, 0.3)
+    maf.flow.eval()
+    X = torch.randn(n, D)
+
+    def score():
+        with torch.no_grad():
+            return maf.flow.log_prob(X)
+
+    def sample():
+        with torch.no_grad():
+            return maf.flow.sample(n)
+
+    use_folded = FoldableLinear._use_folded
+    results = {}
+    for label, folded in (('Unfolded', False), ('Folded', True)):
+        if not folded:
+            FoldableLinear._use_folded = lambda self: False
+        try:
+            torch.manual_seed(1)
+            results[label] = (timed(score), timed(sample), score())
+        finally:
+            FoldableLinear._use_folded = use_folded
+
+    print('D={}, {} rows, {} flow steps'.format(D, n, flow_steps))
+    for label, (t_score, t_sample, _) in results.items():
+        print('{}: log_prob {:.1f} ms, sample {:.1f} ms'.format(
+            label, 1e3 * t_score, 1e3 * t_sample
+        ))
+    print('Max log_prob difference: {:.1e}'.format(
+        (results['Folded'][2] - results['Unfolded'][2]).abs().max().item()
+    ))
+
+
+if __name__ == '__main__':
+    bench_folded_linear(D=7, n=4096, flow_steps=5)
+    bench_folded_linear(D=2, n=4096, flow_steps=10)
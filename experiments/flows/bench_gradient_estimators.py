@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+import torch
+import torch.utils.data as data_utils
+
+from deconv.gmm.data import DeconvDataset
+from deconv.flow.svi import SVIFlow
+
+
+def make_data(n, seed):
+    rng = np.random.default_rng(seed)
+    centres = np.array([[0.0, 0.0], [3.0, 3.0], [3.0, -3.0]])
+    X = centres[rng.integers(3, size=n)] + 0.3 * rng.standard_normal((n, 2))
+    noise_covars = np.repeat(0.5 * np.eye(2)[None], n, axis=0)
+    X += rng.standard_normal((n, 2)) * np.sqrt(0.5)
+    return DeconvDataset(
+        torch.Tensor(X.astype(np.float32)),
+        torch.linalg.cholesky(torch.Tensor(noise_covars.astype(np.float32)))
+    )
+
+
+def train(train_data, val_data, estimator, n_samples, max_epochs,
+          eval_samples, target=None):
+    """
+    (training wall time, val IWAE) after each epoch, stopping early once
+    target is reached. Evaluation is not timed.
+    """
+    torch.manual_seed(0)
+    svi = SVIFlow(
+        2, 3, 1e-3, max_epochs, context_size=16, hidden_features=32,
+        batch_size=256, n_samples=n_samples, use_iwae=True,
+        estimator=estimator
+    )
+    optimiser = torch.optim.Adam(svi.model.parameters(), lr=svi.lr)
+    loader = data_utils.DataLoader(
+        train_data, batch_size=svi.batch_size, shuffle=True
+    )
+
+    elapsed = 0.0
+    history = []
+    for epoch in range(max_epochs):
+        svi.model.train()
+        start = time.perf_counter()
+        for d in loader:
+            optimiser.zero_grad()
+            loss = -svi.model.log_prob_lower_bound(
+                d, num_samples=n_samples, estimator=estimator
+            ).mean()
+            loss.backward()
+            optimiser.step()
+        elapsed += time.perf_counter() - start
+
+        val = svi.score_batch(
+            val_data, log_prob=True, num_samples=eval_samples, chunk_size=50
+        ) / len(val_data)
+        history.append((elapsed, val))
+        if target is not None and val >= target:
+            break
+
+    return history
+
+
+def time_to_target(history, target):
+    for epoch, (elapsed, val) in enumerate(history):
+        if val >= target:
+            return elapsed, epoch + 1
+    return None, len(history)
+
+
+def bench_gradient_estimators(max_epochs=30, eval_samples=200):
+    train_data = make_data(4000, 0)
+    val_data = make_data(1000, 1)
+
+    # The target is what the current setup, standard IWAE with 50 samples,
+    # reaches in max_epochs
+    histories = {
+        ('standard', 50): train(
+            train_data, val_data, 'standard', 50, max_epochs, eval_samples
+        )
+    }
+    target = max(val for _, val in histories['standard', 50]) - 0.01
+    print('Target val IWAE (K={}): {:.4f}'.format(eval_samples, target))
+
+    for estimator, n_samples in (
+        ('standard', 10),
+        ('stl', 10),
+        ('dreg', 10),
+        ('dreg', 50)
+    ):
+        histories[estimator, n_samples] = train(
+            train_data, val_data, estimator, n_samples, max_epochs,
+            eval_samples, target=target
+        )
+
+    for (estimator, n_samples), history in histories.items():
+        elapsed, epochs = time_to_target(history, target)
+        print('{}, K={}: {} after {} epochs, best {:.4f}'.format(
+            estimator,
+            n_samples,
+            'not reached' if elapsed is None else '{:.1f} s'.format(elapsed),
+            epochs,
+            max(val for _, val in history)
+        ))
+
+
+if __name__ == '__main__':
+    bench_gradient_estimators()
@@ -0,0 +1,163 @@
+"""
+Time and peak memory of an SVIMDNFlow training step with the MDN
+posterior's sample_and_log_prob, against the previous path.
+
+The previous path repeated the means and (K, d, d) precision factors
+num_samples times before choosing a component per draw, and evaluated the
+log density on the context repeated num_samples times, building the
+precision matrices of every component for every draw. It is reproduced
+here, with its row indexing fixed. 'broadcast' evaluates the density with
+the factors broadcast against the sample axis, which matmul expands to a
+(K, d, d) copy per draw; 'gathered' is the current path, one product of
+each factor with all the draws of its row. Each variant runs in a fresh
+process and its peak memory is the growth of the resident set over the
+step. --mdn-only steps the MDN posterior alone, without the flows.
+"""
+import argparse
+import math
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+from nflows import utils
+
+from deconv.flow.svi_mdn import SVIMDNFlow
+
+
+def repeated_sample(mdn, num_samples, context):
+    logits, means, _, _, precision_factors = mdn.get_mixture_components(context)
+    batch_size, n_mixtures, output_dim = means.shape
+
+    means, precision_factors = (
+        utils.repeat_rows(means, num_samples),
+        utils.repeat_rows(precision_factors, num_samples),
+    )
+    choices = torch.multinomial(
+        torch.softmax(logits, dim=-1), num_samples=num_samples, replacement=True
+    ).view(-1)
+    ix = torch.arange(batch_size * num_samples)
+
+    chosen_means = means[ix, choices, :]
+    chosen_precision_factors = precision_factors[ix, choices, :, :]
+    zero_mean_samples = torch.linalg.solve_triangular(
+        chosen_precision_factors,
+        torch.randn(batch_size * num_samples, output_dim, 1),
+        upper=True
+    )
+    samples = chosen_means + zero_mean_samples.squeeze(-1)
+    return samples.reshape(batch_size, num_samples, output_dim)
+
+
+def repeated_sample_and_log_prob(mdn, num_samples, context):
+    samples = repeated_sample(mdn, num_samples, context)
+    samples = utils.merge_leading_dims(samples, num_dims=2)
+
+    # The log density through the precision matrices, as before
+    logits, means, precisions, sumlogdiag, _ = mdn.get_mixture_components(
+        utils.repeat_rows(context, num_reps=num_samples)
+    )
+    batch_size, n_mixtures, output_dim = means.size()
+    d1 = (samples.view(-1, 1, output_dim) - means)[..., None]
+    d = -0.5 * torch.matmul(
+        d1.transpose(2, 3), torch.matmul(precisions, d1)
+    ).view(batch_size, n_mixtures)
+    log_prob = torch.logsumexp(
+        torch.log_softmax(logits, dim=-1) + sumlogdiag + d
+        - (output_dim / 2.0) * torch.log(torch.tensor(2 * torch.pi)),
+        dim=-1
+    )
+
+    return (
+        utils.split_leading_dim(samples, shape=[-1, num_samples]),
+        utils.split_leading_dim(log_prob, shape=[-1, num_samples])
+    )
+
+
+def broadcast_sample_and_log_prob(mdn, num_samples, context):
+    # Broadcasting the (K, d, d) factors against the sample axis, which
+    # makes matmul expand them per sample
+    logits, means, sumlogdiag, precision_factors = mdn._precision_factors(context)
+    samples = mdn._sample(num_samples, logits, means, precision_factors)
+
+    d1 = (samples[:, :, None, :] - means[:, None]).unsqueeze(-1)
+    d = -0.5 * torch.matmul(
+        precision_factors[:, None], d1
+    ).squeeze(-1).pow(2).sum(-1)
+    log_prob = torch.logsumexp(
+        torch.log_softmax(logits, dim=-1)[:, None] + sumlogdiag[:, None] + d
+        - (means.shape[-1] / 2.0) * math.log(2 * math.pi),
+        dim=-1
+    )
+    return samples, log_prob
+
+
+def run(variant, d, n, num_samples, steps, mdn_only=False):
+    torch.manual_seed(0)
+    svi = SVIMDNFlow(d, 3, 1e-3, 1, context_size=64, batch_size=n,
+                     n_samples=num_samples)
+    mdn = svi.model._approximate_posterior
+    if variant == 'repeated':
+        mdn.sample_and_log_prob = lambda num_samples, context: \
+            repeated_sample_and_log_prob(mdn, num_samples, context)
+    elif variant == 'broadcast':
+        mdn.sample_and_log_prob = lambda num_samples, context: \
+            broadcast_sample_and_log_prob(mdn, num_samples, context)
+
+    X = torch.randn(n, d)
+    noise_l = 0.5 * torch.eye(d).repeat(n, 1, 1)
+    optimiser = torch.optim.Adam(svi.model.parameters(), lr=1e-3)
+
+    context = torch.randn(n, 64)
+
+    def step():
+        optimiser.zero_grad()
+        if mdn_only:
+            loss = -mdn.sample_and_log_prob(num_samples, context)[1].mean()
+        else:
+            loss = -svi.model.stochastic_elbo(
+                (X, noise_l), num_samples=num_samples
+            ).mean()
+        loss.backward()
+        optimiser.step()
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    step()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    elapsed = (time.perf_counter() - start) / steps
+
+    print('{:9s} {:7.1f} ms/step  peak +{:6.0f} MB'.format(
+        variant, 1e3 * elapsed, peak / 1024
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variant', default=None)
+    parser.add_argument('--d', type=int, default=7)
+    parser.add_argument('--n', type=int, default=256)
+    parser.add_argument('--num-samples', type=int, default=50)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--mdn-only', action='store_true')
+    args = parser.parse_args()
+
+    if args.variant is not None:
+        run(args.variant, args.d, args.n, args.num_samples, args.steps,
+            args.mdn_only)
+    else:
+        print('d={}, batch {}, {} samples{}'.format(
+            args.d, args.n, args.num_samples,
+            ', MDN only' if args.mdn_only else ''
+        ))
+        for variant in ['repeated', 'broadcast', 'gathered']:
+            subprocess.run(
+                [sys.executable, __file__, '--variant', variant] +
+                sys.argv[1:],
+                check=True
+            )
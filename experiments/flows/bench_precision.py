@@ -0,0 +1,134 @@
+"""
+Throughput and log-likelihood differences of the precision policies.
+
+As in the training scripts, float64 is the default tensor type, so without
+a policy the networks run in float64. For each policy the same weights are
+trained for a fixed number of ELBO steps and timed. Then the untrained
+weights are scored on held-out data next to the float64 model holding the
+same weights: the prior flow's log density of fixed points, whose
+difference is due to precision alone, and the mean IWAE bound, whose
+difference also includes Monte Carlo noise, as the samples are drawn in
+another dtype; the noise floor is the float64 model with another seed.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from deconv.flow.svi import SVIFlow
+from deconv.flow.svi_no_mdn import SVIFlowToy
+
+
+def make_data(n, d, seed):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((n, d)) + 2 * rng.integers(2, size=(n, 1))
+    noise_l = np.repeat(0.5 * np.eye(d)[None], n, axis=0)
+    return torch.tensor(X), torch.tensor(noise_l)
+
+
+def make_svi(d, precision):
+    torch.manual_seed(0)
+    return SVIFlow(
+        d, 5, 1e-3, 1, context_size=64, hidden_features=128,
+        batch_size=512, n_samples=20, precision=precision
+    )
+
+
+def make_toy(d, precision):
+    torch.manual_seed(0)
+    return SVIFlowToy(
+        dimensions=d, objective='iwae', posterior_context_size=d,
+        batch_size=512, device=torch.device('cpu'), maf_steps_prior=5,
+        maf_steps_posterior=5, maf_features=128, maf_hidden_blocks=2, K=20,
+        precision=precision
+    )
+
+
+def train_throughput(model, data, batch_size, steps, num_samples):
+    """Rows per second of ELBO forward and backward passes."""
+    optimiser = torch.optim.Adam(model.parameters(), lr=1e-4)
+    model.train()
+
+    def step(i):
+        start = (i * batch_size) % (len(data[0]) - batch_size)
+        d = [a[start:start + batch_size] for a in data]
+        optimiser.zero_grad()
+        loss = -model.stochastic_elbo(d, num_samples=num_samples).mean()
+        loss.backward()
+        optimiser.step()
+
+    step(0)
+    start = time.perf_counter()
+    for i in range(steps):
+        step(i + 1)
+    return steps * batch_size / (time.perf_counter() - start)
+
+
+def iwae(model, data, num_samples, seed=1):
+    model.eval()
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        return model.log_prob_lower_bound(
+            data, num_samples=num_samples, chunk_size=50
+        ).double()
+
+
+def prior_log_prob(model, points):
+    model.eval()
+    with torch.no_grad(), model._networks():
+        return model._prior.log_prob(
+            points.to(torch.get_default_dtype())
+        ).double()
+
+
+def run(name, make, d, args):
+    train = make_data(args.n, d, 1)
+    val = make_data(args.n_val, d, 2)
+
+    reference = make(d, None).model
+    reference_ll = iwae(reference, val, args.eval_samples).mean().item()
+    reference_prior = prior_log_prob(reference, val[0])
+    state = reference.state_dict()
+
+    print('{} (d={})'.format(name, d))
+    print('  IWAE noise floor (fp64, other seed) {:.2e}'.format(abs(
+        iwae(reference, val, args.eval_samples, seed=2).mean().item() -
+        reference_ll
+    )))
+    for precision in [None, 'fp32', 'bf16']:
+        model = make(d, precision).model
+        model.load_state_dict(state)
+
+        rate = train_throughput(
+            model, train, args.batch_size, args.steps, args.n_samples
+        )
+        # Training has moved the weights, so score the untrained ones
+        model.load_state_dict(state)
+        ll = iwae(model, val, args.eval_samples).mean().item()
+        prior_error = (
+            prior_log_prob(model, val[0]) - reference_prior
+        ).abs().max().item()
+
+        print(
+            '  {:5s} {:8.0f} rows/s  mean IWAE {:.5f} (diff {:.2e})  '
+            'max prior |log p - fp64| {:.2e}'.format(
+                str(precision), rate, ll, abs(ll - reference_ll), prior_error
+            )
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=8192)
+    parser.add_argument('--n-val', type=int, default=1024)
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--n-samples', type=int, default=20)
+    parser.add_argument('--eval-samples', type=int, default=200)
+    args = parser.parse_args()
+
+    torch.set_default_tensor_type(torch.DoubleTensor)
+
+    run('SVIFlow', make_svi, 7, args)
+    run('SVIFlowToy', make_toy, 2, args)
@@ -0,0 +1,69 @@
+import time
+
+import torch
+
+from deconv.flow.svi import SVIFlow
+from deconv.flow.vae import streaming_log_mean_exp
+
+
+def check_iwae_chunks(D, n, num_samples, chunk_sizes, device=None):
+    """
+    Fails if any chunk size changes the bound beyond float64 rounding.
+    """
+    torch.manual_seed(0)
+
+    # The merge itself is exact: reduce fixed terms in chunks
+    terms = 50 * torch.randn(n, num_samples, dtype=torch.float64)
+    full = torch.logsumexp(terms, dim=1) - torch.log(
+        torch.tensor(num_samples, dtype=torch.float64)
+    )
+    for chunk_size in chunk_sizes:
+        offset = [0]
+
+        def next_terms(context, k):
+            offset[0] += k
+            return terms[:, offset[0] - k:offset[0]]
+
+        streamed = streaming_log_mean_exp(
+            next_terms, None, num_samples, chunk_size
+        )
+        error = (streamed - full).abs().max().item()
+        print('Fixed terms, chunk size {}: max difference {:.1e}'.format(
+            chunk_size, error
+        ))
+        assert error < 1e-10
+
+    # On a model, the posterior noise is drawn sample by sample, so with
+    # the same seed every chunk size gives the same bound, up to the
+    # rounding of the merge, which float64 keeps near 1e-14
+    svi = SVIFlow(
+        D, 5, 1e-3, 1, batch_size=n, precision='fp64', device=device
+    )
+    X = torch.randn(n, D, device=device)
+    noise_l = 0.5 * torch.eye(D, device=device).repeat(n, 1, 1)
+
+    bounds = {}
+    for chunk_size in (None,) + tuple(chunk_sizes):
+        torch.manual_seed(1)
+        start = time.perf_counter()
+        bounds[chunk_size] = svi.score(
+            (X, noise_l), log_prob=True, num_samples=num_samples,
+            chunk_size=chunk_size
+        )
+        print('Chunk size {}: mean bound {:.6f}, max difference from '
+              'unchunked {:.1e}, {:.2f} s'.format(
+                  chunk_size or num_samples,
+                  bounds[chunk_size].mean().item(),
+                  (bounds[chunk_size] - bounds[None]).abs().max().item(),
+                  time.perf_counter() - start
+              ))
+        assert (bounds[chunk_size] - bounds[None]).abs().max().item() < 1e-10
+
+
+if __name__ == '__main__':
+    check_iwae_chunks(D=2, n=128, num_samples=1000, chunk_sizes=(1, 64, 333))
+    if torch.cuda.is_available():
+        check_iwae_chunks(
+            D=2, n=128, num_samples=1000, chunk_sizes=(1, 64, 333),
+            device=torch.device('cuda')
+        )
@@ -18,7 +18,7 @@ from deconv.utils.make_2d_toy_noise_covar import covar_gen
 from deconv.utils.compute_2d_log_likelihood import compute_data_ll
 from deconv.utils.misc import get_logger
 from deconv.flow.svi_no_mdn import SVIFlowToy, SVIFlowToyNoise
-from deconv.gmm.data import DeconvDataset
+from deconv.gmm.data import SharedDeconvDataset
 from sklearn.datasets import load_boston
 
 parser = argparse.ArgumentParser()
@@ -111,18 +111,14 @@ def main():
     #     covar[np.newaxis, :, :], n_train, axis=0)
 
     # train_dataset = DeconvDataset(train_data, train_covars)
-    for i, (train_index, eval_index) in enumerate(kf.split(train_data)):
-        X_train, X_eval = train_data[train_index], train_data[eval_index]
-        train_covars = np.repeat(
-            covar[np.newaxis, :, :], X_train.shape[0], axis=0)
-        eval_covars = np.repeat(
-            covar[np.newaxis, :, :], X_eval.shape[0], axis=0)
+    dataset = SharedDeconvDataset(train_data, covar)
 
-        train_dataset = DeconvDataset(X_train, train_covars)
+    for i, (train_index, eval_index) in enumerate(kf.split(train_data)):
+        train_dataset = dataset.subset(train_index)
         train_loader = DataLoader(
             train_dataset, batch_size=args.batch_size, shuffle=True)
 
-        eval_dataset = DeconvDataset(X_eval, eval_covars)
+        eval_dataset = dataset.subset(eval_index)
         eval_loader = DataLoader(
             eval_dataset, batch_size=args.batch_size, shuffle=False)
 
@@ -19,7 +19,7 @@ from deconv.utils.make_2d_toy_noise_covar import covar_gen
 from deconv.utils.compute_2d_log_likelihood import compute_data_ll
 from deconv.utils.misc import get_logger
 from deconv.flow.svi_no_mdn import SVIFlowToy, SVIFlowToyNoise
-from deconv.gmm.data import DeconvDataset
+from deconv.gmm.data import SharedDeconvDataset
 from sklearn.datasets import load_boston
 
 parser = argparse.ArgumentParser()
@@ -109,22 +109,18 @@ def main():
 
     best_eval = np.zeros((n_combs, 5))
 
+    dataset = SharedDeconvDataset(train_data, covar)
+
     counter = 0
     for lr, fspr, fspo, maf_f, maf_h in product(lr_list, flow_steps_posterior_list, flow_steps_posterior_list, maf_features_list, maf_hidden_blocks_list):
         logger.info((lr, fspr, fspo, maf_f, maf_h))
 
         for i, (train_index, eval_index) in enumerate(kf.split(train_data)):
-            X_train, X_eval = train_data[train_index], train_data[eval_index]
-            train_covars = np.repeat(
-                covar[np.newaxis, :, :], X_train.shape[0], axis=0)
-            eval_covars = np.repeat(
-                covar[np.newaxis, :, :], X_eval.shape[0], axis=0)
-
-            train_dataset = DeconvDataset(X_train, train_covars)
+            train_dataset = dataset.subset(train_index)
             train_loader = DataLoader(
                 train_dataset, batch_size=args.batch_size, shuffle=True)
 
-            eval_dataset = DeconvDataset(X_eval, eval_covars)
+            eval_dataset = dataset.subset(eval_index)
             eval_loader = DataLoader(
                 eval_dataset, batch_size=args.batch_size, shuffle=False)
 
@@ -152,7 +148,7 @@ def main():
             model.eval()
             with torch.no_grad():
                 best_eval_loss = compute_eval_loss(
-                    model, eval_loader, device, X_eval.shape[0])
+                    model, eval_loader, device, len(eval_index))
 
                 best_model = copy.deepcopy(model.state_dict())
 
@@ -173,7 +169,7 @@ def main():
                 model.eval()
                 with torch.no_grad():
                     eval_loss = compute_eval_loss(
-                        model, eval_loader, device, X_eval.shape[0])
+                        model, eval_loader, device, len(eval_index))
 
                     if eval_loss < best_eval_loss:
                         best_model = copy.deepcopy(model.state_dict())
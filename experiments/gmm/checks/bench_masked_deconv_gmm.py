@@ -0,0 +1,88 @@
+"""
+Cost of the exact masked likelihood against the placeholder encoding.
+
+Rows have Gaia-like missingness: the parallax and proper motions or the
+colour are missing for a fraction of them. The placeholder encoding fills
+them with 0 and a 1e12 variance and runs the full d-dimensional kernel;
+the masked path groups rows by pattern and solves each group on its
+observed block. Times are per batch of the SGD module, forward only and
+forward plus backward.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from deconv.gmm.sgd_deconv_gmm import SGDDeconvGMMModule
+
+
+def gaia_like_mask(n, d, two_param, no_colour, rng):
+    mask = np.ones((n, d), dtype=bool)
+    rows = rng.random(n)
+    mask[rows < two_param, 2:5] = False
+    mask[rows > 1 - no_colour, 5] = False
+    return torch.from_numpy(mask)
+
+
+def timed(f, repeats):
+    f()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        f()
+    return 1e3 * (time.perf_counter() - start) / repeats
+
+
+def forward_backward(module, batch):
+    module.zero_grad()
+    module(batch).sum().backward()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=512)
+    parser.add_argument('--d', type=int, default=7)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+
+    n, d = args.n, args.d
+    X = torch.randn(n, d)
+    A = 0.1 * torch.randn(n, d, d)
+    C = A @ A.transpose(-2, -1) + 0.01 * torch.eye(d)
+
+    print('n={}, d={}'.format(n, d))
+    for two_param, no_colour in [(0.0, 0.0), (0.3, 0.1), (0.7, 0.1)]:
+        M = gaia_like_mask(n, d, two_param, no_colour, rng)
+
+        X_fill = X.masked_fill(~M, 0.0)
+        C_fill = C.masked_fill(~(M[:, :, None] & M[:, None, :]), 0.0)
+        C_fill += torch.diag_embed((~M).float() * 1e12)
+
+        for k in [8, 64]:
+            module = SGDDeconvGMMModule(k, d, 1e-3)
+            module.means.data = torch.randn(k, d)
+
+            placeholder = (X_fill, C_fill)
+            masked = (X, C, M)
+
+            with torch.no_grad():
+                t_fill = timed(lambda: module(placeholder), args.repeats)
+                t_masked = timed(lambda: module(masked), args.repeats)
+            t_fill_b = timed(
+                lambda: forward_backward(module, placeholder), args.repeats
+            )
+            t_masked_b = timed(
+                lambda: forward_backward(module, masked), args.repeats
+            )
+
+            print(
+                'missing {:.0%} 2-param, {:.0%} colour, K={:2d}: forward '
+                'placeholder {:6.2f} ms, masked {:6.2f} ms; forward+backward '
+                'placeholder {:6.2f} ms, masked {:6.2f} ms'.format(
+                    two_param, no_colour, k, t_fill, t_masked,
+                    t_fill_b, t_masked_b
+                )
+            )
@@ -0,0 +1,90 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from deconv.gmm.sgd_deconv_gmm import SGDDeconvGMM, SGDDeconvGMMModule, mvn
+
+from data import generate_data
+
+
+def time_steps(gmm, X, C, steps):
+    """Run the training step of BaseSGDGMM.fit on fixed batches."""
+    n = X.shape[0]
+    batch_size = gmm.batch_size
+
+    def step(j):
+        start = (j * batch_size) % (n - batch_size)
+        d = [X[start:start + batch_size], C[start:start + batch_size]]
+
+        gmm.optimiser.zero_grad()
+        log_prob = gmm.module(d)
+        loss = -1 * torch.mean(log_prob)
+        loss += gmm.reg_loss(batch_size, n)
+        loss.backward()
+        gmm.optimiser.step()
+
+    for j in range(10):
+        step(j)
+
+    start = time.perf_counter()
+    for j in range(steps):
+        step(j)
+    return steps / (time.perf_counter() - start)
+
+
+class MVNDeconvGMMModule(SGDDeconvGMMModule):
+    """The forward pass through torch.distributions, for reference."""
+
+    def forward(self, data):
+        x, noise_covars = data
+        T = self.covars[None, :, :, :] + noise_covars[:, None, :, :]
+        log_resp = mvn(loc=self.means, covariance_matrix=T).log_prob(
+            x[:, None, :]
+        )
+        log_resp += torch.log(self.weights)
+        return torch.logsumexp(log_resp, dim=1)
+
+
+def bench_sgd_gmm_step(D, K, N, batch_size, steps):
+
+    data, _ = generate_data(D, 1, N)
+    X_train, nc_train, _, _ = data
+
+    X = torch.Tensor(X_train.reshape(-1, D).astype(np.float32))
+    C = torch.Tensor(nc_train.reshape(-1, D, D).astype(np.float32))
+
+    variants = [
+        ('MultivariateNormal', {'cache_params': False}, MVNDeconvGMMModule),
+        ('kernel', {'cache_params': False}, None),
+        ('kernel, cache_params', {}, None),
+        ('compiled kernel, cache_params', {'compile_likelihood': True}, None),
+        ('analytic gradients, cache_params', {'analytic_grad': True}, None)
+    ]
+
+    for label, kwargs, module_class in variants:
+        torch.manual_seed(0)
+        gmm = SGDDeconvGMM(K, D, batch_size=batch_size, **kwargs)
+        if module_class is not None:
+            gmm.module = module_class(K, D, gmm.w, **kwargs)
+            gmm.optimiser = torch.optim.Adam(
+                params=gmm.module.parameters(), lr=gmm.lr
+            )
+        gmm.module.means.data = X[torch.randperm(X.shape[0])[:K]]
+
+        rate = time_steps(gmm, X, C, steps)
+        print('{}: {:.1f} steps/s'.format(label, rate))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-D', type=int, default=7)
+    parser.add_argument('-K', type=int, default=64)
+    parser.add_argument('-N', type=int, default=8192)
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--steps', type=int, default=100)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    bench_sgd_gmm_step(args.D, args.K, args.N, args.batch_size, args.steps)
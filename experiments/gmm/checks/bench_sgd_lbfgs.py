@@ -0,0 +1,78 @@
+import time
+
+import numpy as np
+import torch
+
+from deconv.gmm.sgd_deconv_gmm import SGDDeconvGMM
+from deconv.gmm.data import DeconvDataset
+
+from data import generate_data
+
+
+def fit_and_report(label, gmm, train_data, test_data):
+    start = time.perf_counter()
+    gmm.fit(train_data, val_data=test_data)
+    elapsed = time.perf_counter() - start
+
+    if gmm.optimiser_type == 'lbfgs':
+        state = gmm.optimiser.state[gmm.optimiser.param_groups[0]['params'][0]]
+        passes = state['func_evals']
+    else:
+        passes = len(gmm.train_loss_curve)
+
+    print('{}: {} passes, {:.1f} s, train {:.4f}, test {:.4f}'.format(
+        label,
+        passes,
+        elapsed,
+        gmm.score_batch(train_data) / len(train_data),
+        gmm.score_batch(test_data) / len(test_data)
+    ))
+
+
+def bench_sgd_lbfgs(D, K, N):
+
+    data, _ = generate_data(D, K, N)
+    X_train, nc_train, X_test, nc_test = data
+
+    train_data = DeconvDataset(
+        torch.Tensor(X_train.reshape(-1, D).astype(np.float32)),
+        torch.Tensor(
+            nc_train.reshape(-1, D, D).astype(np.float32)
+        )
+    )
+
+    test_data = DeconvDataset(
+        torch.Tensor(X_test.reshape(-1, D).astype(np.float32)),
+        torch.Tensor(
+            nc_test.reshape(-1, D, D).astype(np.float32)
+        )
+    )
+
+    torch.manual_seed(0)
+    adam = SGDDeconvGMM(
+        K,
+        D,
+        batch_size=250,
+        epochs=200,
+        lr=1e-1,
+        in_memory=True
+    )
+    fit_and_report('Adam', adam, train_data, test_data)
+
+    torch.manual_seed(0)
+    lbfgs = SGDDeconvGMM(
+        K,
+        D,
+        batch_size=len(train_data),
+        epochs=50,
+        in_memory=True,
+        optimiser='lbfgs'
+    )
+    fit_and_report('L-BFGS', lbfgs, train_data, test_data)
+
+
+if __name__ == '__main__':
+    D = 2
+    K = 3
+    N = 500
+    bench_sgd_lbfgs(D, K, N)
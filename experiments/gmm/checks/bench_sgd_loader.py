@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+import torch
+
+from deconv.gmm.sgd_deconv_gmm import SGDDeconvGMM
+from deconv.gmm.data import DeconvDataset
+
+from data import generate_data
+
+
+def time_epochs(train_data, K, D, batch_size, epochs, in_memory):
+    torch.manual_seed(0)
+    gmm = SGDDeconvGMM(
+        K,
+        D,
+        batch_size=batch_size,
+        epochs=epochs,
+        lr=1e-1,
+        k_means_iters=1,
+        in_memory=in_memory
+    )
+    gmm.tol = 0.0
+
+    start = time.perf_counter()
+    gmm.fit(train_data)
+    elapsed = time.perf_counter() - start
+
+    return elapsed / len(gmm.train_loss_curve)
+
+
+def bench_sgd_loader(D, K, N, batch_size, epochs=20):
+
+    data, _ = generate_data(D, K, N)
+    X_train, nc_train, _, _ = data
+
+    train_data = DeconvDataset(
+        torch.Tensor(X_train.reshape(-1, D).astype(np.float32)),
+        torch.Tensor(
+            nc_train.reshape(-1, D, D).astype(np.float32)
+        )
+    )
+
+    t_loader = time_epochs(
+        train_data, K, D, batch_size, epochs, in_memory=False
+    )
+    t_memory = time_epochs(
+        train_data, K, D, batch_size, epochs, in_memory=True
+    )
+
+    print('D={}, K={}, N={}, batch size {}'.format(
+        D, K, len(train_data), batch_size
+    ))
+    print('DataLoader: {:.1f} ms/epoch'.format(1e3 * t_loader))
+    print('In memory: {:.1f} ms/epoch'.format(1e3 * t_memory))
+
+
+if __name__ == '__main__':
+    # The workload of check_sgd_deconv_gmm.py and a larger one
+    bench_sgd_loader(2, 3, 500, 250)
+    bench_sgd_loader(2, 3, 5000, 250)
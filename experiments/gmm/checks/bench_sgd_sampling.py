@@ -0,0 +1,66 @@
+import time
+
+import torch
+import torch.distributions as dist
+
+from deconv.gmm.sgd_deconv_gmm import SGDDeconvGMM
+
+
+def oversampled_prior(gmm, num_samples):
+    """Draw from every component and keep one, for reference."""
+    weights = gmm.module.weights
+    idx = dist.Categorical(probs=weights).sample([num_samples])
+    X = dist.MultivariateNormal(
+        loc=gmm.module.means, scale_tril=gmm.module.L
+    ).sample([num_samples])
+    return X[torch.arange(num_samples), idx, :]
+
+
+def oversampled_posterior(gmm, x, num_samples):
+    """Draw from every posterior component and keep one, for reference."""
+    p_weights, p_means, p_covars = gmm.posterior_params(x)
+    idx = dist.Categorical(logits=p_weights).sample([num_samples])
+    samples = dist.MultivariateNormal(
+        loc=p_means, covariance_matrix=p_covars
+    ).sample([num_samples])
+    return samples.transpose(0, 1)[
+        torch.arange(len(x[0]))[:, None, None, None],
+        torch.arange(num_samples)[None, :, None, None],
+        idx.T[:, :, None, None],
+        torch.arange(gmm.d)[None, None, None, :]
+    ].squeeze()
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def bench_sgd_sampling(D, K, n_prior, n_stars, n_posterior):
+    torch.manual_seed(0)
+    gmm = SGDDeconvGMM(K, D)
+    gmm.module.means.data = 10 * torch.randn(K, D)
+    gmm.module.l_lower.data.normal_(0, 0.3)
+
+    x = (10 * torch.randn(n_stars, D), torch.eye(D).repeat(n_stars, 1, 1))
+
+    with torch.no_grad():
+        print('Prior, {} samples: {:.3f} s oversampled, {:.3f} s exact'.format(
+            n_prior,
+            timed(oversampled_prior, gmm, n_prior),
+            timed(gmm._sample, n_prior)
+        ))
+        print(
+            'Posterior, {} stars x {} samples: '
+            '{:.3f} s oversampled, {:.3f} s exact'.format(
+                n_stars,
+                n_posterior,
+                timed(oversampled_posterior, gmm, x, n_posterior),
+                timed(gmm._sample_posterior, x, n_posterior)
+            )
+        )
+
+
+if __name__ == '__main__':
+    bench_sgd_sampling(D=7, K=64, n_prior=200000, n_stars=512, n_posterior=64)
@@ -0,0 +1,72 @@
+"""
+Posterior sampling held in memory against streaming it to disk.
+
+Each variant runs in a fresh process, and its memory is the growth of the
+peak resident set over the sampling call, measured the same way for both.
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from deconv.gmm.sgd_deconv_gmm import SGDDeconvGMM
+
+
+def run(variant, path, D, K, n_stars, n_posterior):
+    torch.manual_seed(0)
+    star_chunk_size, sample_chunk_size = 512, 256
+    gmm = SGDDeconvGMM(K, D, batch_size=star_chunk_size)
+    gmm.module.means.data = 10 * torch.randn(K, D)
+
+    x = (
+        10 * torch.randn(n_stars, D),
+        torch.eye(D).repeat(n_stars, 1, 1)
+    )
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if variant == 'in-memory':
+        with torch.no_grad():
+            samples = gmm.sample_posterior(x, n_posterior)
+    else:
+        gmm.sample_posterior_to_file(
+            x, n_posterior, path, star_chunk_size, sample_chunk_size
+        )
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+    print('{:9s} {:6.2f} s, peak +{:6.0f} MB'.format(
+        variant, elapsed, peak / 1024
+    ))
+
+
+def bench_streaming_sampler(D, K, n_stars, n_posterior):
+    path = os.path.join(tempfile.mkdtemp(), 'samples.npy')
+
+    print('{} stars x {} samples, D={}, K={} ({:.0f} MB of samples)'.format(
+        n_stars, n_posterior, D, K, n_stars * n_posterior * D * 4 / 2**20
+    ))
+    for variant in ('in-memory', 'streamed'):
+        subprocess.run(
+            [sys.executable, __file__, variant, path] +
+            [str(a) for a in (D, K, n_stars, n_posterior)],
+            check=True
+        )
+
+    samples = np.load(path, mmap_mode='r')
+    print('File shape {}, finite: {}'.format(
+        samples.shape, np.isfinite(samples).all()
+    ))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # Child process of bench_streaming_sampler
+        run(sys.argv[1], sys.argv[2], *map(int, sys.argv[3:]))
+    else:
+        bench_streaming_sampler(D=7, K=16, n_stars=8192, n_posterior=512)
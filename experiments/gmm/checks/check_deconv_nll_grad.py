@@ -0,0 +1,127 @@
+import resource
+import subprocess
+import sys
+
+import torch
+
+from deconv.gmm.likelihood import deconv_log_prob, deconv_log_prob_analytic
+
+
+def random_inputs(n, K, D, dtype=torch.float64):
+    x = torch.randn(n, D, dtype=dtype)
+    noise_l = torch.randn(n, D, D, dtype=dtype).tril() * 0.3
+    noise_l += torch.eye(D, dtype=dtype)
+    means = torch.randn(K, D, dtype=dtype)
+    covar_l = torch.randn(K, D, D, dtype=dtype).tril() * 0.5
+    covar_l += torch.eye(D, dtype=dtype)
+    log_weights = torch.log_softmax(torch.randn(K, dtype=dtype), dim=0)
+    return x, noise_l, means, covar_l, log_weights
+
+
+def parameterised(log_prob):
+    """Build the covariances from factors, as SGDDeconvGMMModule does."""
+    def f(x, noise_l, means, covar_l, log_weights):
+        return log_prob(
+            x,
+            noise_l @ noise_l.transpose(-2, -1),
+            means,
+            covar_l @ covar_l.transpose(-2, -1),
+            log_weights
+        )
+    return f
+
+
+def saved_bytes(log_prob, inputs):
+    """Bytes of tensors saved for the backward pass of log_prob."""
+    total = [0]
+
+    def pack(t):
+        total[0] += t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        log_prob(*inputs)
+
+    return total[0]
+
+
+def backward_peak(name, n=4096, K=64, D=7):
+    """
+    Growth of the peak resident set over a forward and backward pass, in MB.
+
+    Runs in a fresh process, so that the peak is that of this pass alone.
+    """
+    if __name__ != '__main__' or len(sys.argv) < 2:
+        out = subprocess.run(
+            [sys.executable, __file__, name, str(n), str(K), str(D)],
+            check=True, capture_output=True, text=True
+        )
+        return float(out.stdout.split()[-1])
+
+    log_prob = {
+        'autograd': deconv_log_prob, 'analytic': deconv_log_prob_analytic
+    }[name]
+    torch.manual_seed(0)
+    x, noise_l, means, covar_l, log_weights = random_inputs(n, K, D)
+    noise_covars = noise_l @ noise_l.transpose(-2, -1)
+    covar_l.requires_grad_()
+    means.requires_grad_()
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    log_prob(
+        x, noise_covars, means, covar_l @ covar_l.transpose(-2, -1),
+        log_weights
+    ).sum().backward()
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024
+
+
+def check_deconv_nll_grad():
+    torch.manual_seed(0)
+
+    inputs = [
+        t.requires_grad_() for t in random_inputs(6, 3, 3)
+    ]
+    print('gradcheck: {}'.format(
+        torch.autograd.gradcheck(
+            parameterised(deconv_log_prob_analytic), inputs
+        )
+    ))
+
+    inputs = [
+        t.requires_grad_() for t in random_inputs(512, 64, 7)
+    ]
+    x, noise_l, means, covar_l, log_weights = inputs
+    noise_covars = (noise_l @ noise_l.transpose(-2, -1)).detach()
+    covars = covar_l @ covar_l.transpose(-2, -1)
+    kernel_inputs = (x, noise_covars, means, covars, log_weights)
+
+    grads = {}
+    for name, log_prob in (
+        ('autograd', deconv_log_prob),
+        ('analytic', deconv_log_prob_analytic)
+    ):
+        out = log_prob(*kernel_inputs)
+        grads[name] = torch.autograd.grad(
+            out.sum(), (x, means, covar_l, log_weights), retain_graph=True
+        )
+        print('{}: {:.1f} MB saved for backward'.format(
+            name, saved_bytes(log_prob, kernel_inputs) / 2**20
+        ))
+
+    err = max(
+        ((a - b).abs().max() / b.abs().max()).item()
+        for a, b in zip(grads['autograd'], grads['analytic'])
+    )
+    print('Max relative gradient difference: {}'.format(err))
+
+    for name in ('autograd', 'analytic'):
+        print('{}: peak +{:.0f} MB over forward and backward '
+              '(n=4096, K=64, D=7, float64)'.format(name, backward_peak(name)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # Child process of backward_peak
+        print(backward_peak(sys.argv[1], *map(int, sys.argv[2:])))
+    else:
+        check_deconv_nll_grad()
@@ -0,0 +1,55 @@
+import time
+
+import torch
+
+from deconv.gmm.sgd_gmm import SGDGMM
+
+
+def joint_log_prob(gmm, X):
+    return torch.logsumexp(
+        torch.distributions.MultivariateNormal(
+            loc=gmm.means, covariance_matrix=gmm.covars
+        ).log_prob(X[:, None, :]) + torch.log(gmm.module.weights),
+        dim=1
+    )
+
+
+def check_gmm_conditional(D, K, observed, n_check, n_rows):
+    torch.manual_seed(0)
+    gmm = SGDGMM(K, D)
+    gmm.module.means.data = 3 * torch.randn(K, D)
+    gmm.module.l_lower.data.normal_(0, 0.5)
+    gmm.module.soft_weights.data.normal_()
+
+    with torch.no_grad():
+        X = gmm._sample(n_check)
+    unobserved = [i for i in range(D) if i not in observed]
+
+    cond = gmm.conditional(observed)
+    X_o, X_u = X[:, observed], X[:, unobserved]
+
+    # log p(x) = log p(x_o) + log p(x_u | x_o)
+    err = (
+        cond.marginal_log_prob(X_o) + cond.condition(X_o).log_prob(X_u) -
+        joint_log_prob(gmm, X)
+    ).abs().max().item()
+    print('Max error in marginal times conditional density: {:.2e}'.format(
+        err
+    ))
+    print('Cached per split: {}'.format(gmm.conditional(observed) is cond))
+
+    with torch.no_grad():
+        X_o = gmm._sample(n_rows)[:, observed]
+
+    start = time.perf_counter()
+    for rows in torch.split(X_o, 100000):
+        cond.condition(rows).moments()
+    print('{} rows conditioned, with moments, in {:.2f} s'.format(
+        n_rows, time.perf_counter() - start
+    ))
+
+
+if __name__ == '__main__':
+    check_gmm_conditional(
+        D=7, K=16, observed=[5, 6, 0], n_check=1000, n_rows=1000000
+    )
@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+import torch
+
+from deconv.gmm.deconv_gmm import DeconvGMM
+from deconv.gmm.sgd_deconv_gmm import SGDDeconvGMMModule
+
+from data import generate_data
+
+
+def gaia_like_mask(n, D, two_param=0.3, no_colour=0.1):
+    """Drop parallax and proper motions, or the colour, like Gaia rows."""
+    mask = np.ones((n, D), dtype=bool)
+    rows = np.random.rand(n)
+    mask[rows < two_param, 2:5] = False
+    mask[rows > 1 - no_colour, 5] = False
+    return mask
+
+
+def time_forward(module, batch, repeats=20):
+    with torch.no_grad():
+        module(batch)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            module(batch)
+    return (time.perf_counter() - start) / repeats
+
+
+def check_masked_deconv_gmm(D, K, N, batch_size=512, seed=0):
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    data, params = generate_data(D, K, N)
+    X_train, nc_train, _, _ = data
+
+    X = torch.Tensor(X_train.reshape(-1, D).astype(np.float32))
+    C = torch.Tensor(nc_train.reshape(-1, D, D).astype(np.float32))
+    M = torch.from_numpy(gaia_like_mask(X.shape[0], D))
+
+    # Placeholder encoding of the missing values, as in pandas_to_numpy
+    X_fill = X.masked_fill(~M, 0.0)
+    C_fill = C.masked_fill(~(M[:, :, None] & M[:, None, :]), 0.0)
+    C_fill += torch.diag_embed((~M).float() * 1e12)
+
+    gmm = DeconvGMM(K, D, epochs=50)
+    gmm.fit((X, C, M))
+
+    _, (r_masked, _, _) = gmm._e_step((X, C, M))
+    _, (r_fill, _, _) = gmm._e_step((X_fill, C_fill))
+
+    print('Max responsibility difference against placeholders: {}'.format(
+        (r_masked.exp() - r_fill.exp()).abs().max().item()
+    ))
+    print('Non-finite placeholder responsibilities: {}'.format(
+        (~torch.isfinite(r_fill)).sum().item()
+    ))
+
+    module = SGDDeconvGMMModule(K, D, 1e-3)
+    module.means.data = gmm.means.float()
+
+    idx = torch.randperm(X.shape[0])[:batch_size]
+    t_fill = time_forward(module, (X_fill[idx], C_fill[idx]))
+    t_masked = time_forward(module, (X[idx], C[idx], M[idx]))
+
+    print('Placeholder forward: {:.2f} ms'.format(1e3 * t_fill))
+    print('Masked forward: {:.2f} ms'.format(1e3 * t_masked))
+
+
+if __name__ == '__main__':
+    D = 7
+    K = 8
+    N = 1000
+    check_masked_deconv_gmm(D, K, N)
@@ -0,0 +1,66 @@
+import numpy as np
+import torch
+
+from deconv.gmm.deconv_gmm import DeconvGMM
+from deconv.gmm.sgd_deconv_gmm import SGDDeconvGMM
+from deconv.utils.summary import summarise_chunks
+
+from data import generate_data
+
+
+def max_error(a, b):
+    return (a - b).abs().max().item()
+
+
+def check_posterior_summary(D, K, N, num_samples):
+    torch.manual_seed(0)
+
+    data, _ = generate_data(D, K, N)
+    X_train, nc_train, X_test, nc_test = data
+
+    train_data = (
+        torch.Tensor(X_train.reshape(-1, D).astype(np.float32)),
+        torch.Tensor(nc_train.reshape(-1, D, D).astype(np.float32))
+    )
+    test_data = (
+        torch.Tensor(X_test.reshape(-1, D).astype(np.float32)),
+        torch.Tensor(nc_test.reshape(-1, D, D).astype(np.float32))
+    )
+
+    gmm = DeconvGMM(K, D, epochs=200)
+    gmm.fit(train_data)
+
+    sgd_gmm = SGDDeconvGMM(K, D, batch_size=64)
+    sgd_gmm.module.soft_weights.data = torch.log(gmm.weights[:, 0])
+    sgd_gmm.module.means.data = gmm.means
+    sgd_gmm.module.l_diag.data = torch.log(
+        torch.linalg.cholesky(gmm.covars).diagonal(dim1=-2, dim2=-1)
+    )
+    sgd_gmm.module.l_lower.data = torch.linalg.cholesky(gmm.covars)[
+        :, sgd_gmm.module.l_idx[0], sgd_gmm.module.l_idx[1]
+    ]
+
+    em_means, em_covars = gmm.posterior_moments(test_data)
+    means, covars, quantiles = sgd_gmm.summarise_posterior(test_data)
+    print('EM vs SGD analytic moments: means {:.2e}, covars {:.2e}'.format(
+        max_error(em_means, means), max_error(em_covars, covars)
+    ))
+
+    s_means, s_covars, s_quantiles = summarise_chunks(
+        sgd_gmm.iter_posterior_samples(test_data, num_samples, 64, 1000),
+        len(test_data[0]),
+        D
+    )
+    scale = covars.diagonal(dim1=-2, dim2=-1).sqrt().max().item()
+    print(
+        'Streamed samples vs analytic, in posterior std: '
+        'means {:.3f}, covars {:.3f}, quantiles {:.3f}'.format(
+            max_error(s_means, means) / scale,
+            max_error(s_covars, covars) / scale**2,
+            max_error(s_quantiles, quantiles) / scale
+        )
+    )
+
+
+if __name__ == '__main__':
+    check_posterior_summary(D=2, K=3, N=500, num_samples=20000)
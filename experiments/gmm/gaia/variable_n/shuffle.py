@@ -1,60 +1,238 @@
 """
 Script to shuffle the hdf5 dataset.
 
-Does everything in memory.
+Uses an external-memory shuffle so that the full catalogue never has to be
+held in RAM: rows are streamed once from the input store and scattered into
+randomly chosen bucket files on disk, then each bucket is loaded, permuted in
+memory and appended to the output. Peak memory is bounded by --max-memory.
+
+The input and output can each be either an hdf5 store (with train/val/test
+groups holding X and C datasets) or a directory of .npy files laid out as
+<dir>/<split>/X.npy and <dir>/<split>/C.npy, which can be opened as memmaps.
 """
 import argparse
+import math
+import os
+import shutil
+import tempfile
 
 import numpy as np
 import h5py
 
 np.random.seed(9246130)
 
+SPLITS = ('train', 'val', 'test')
 
-def shuffle_store(hdf5_in, hdf5_out):
-    """Create a shuffled copy of dataset."""
-    store_in = h5py.File(hdf5_in, 'r')
-    store_out = h5py.File(hdf5_out)
 
-    for d in ('train', 'val', 'test'):
+def is_hdf5(path):
+    return os.path.splitext(path)[1] in ('.h5', '.hdf5')
 
-        print('Shuffling {}'.format(d))
 
-        group = store_out.create_group(d)
-        X = store_in[d]['X'][()]
-        C = store_in[d]['C'][()]
+class StoreReader:
+    """Read-only access to the splits of an hdf5 or memmap store."""
 
-        print('X shape: {}'.format(X.shape))
-        print('C shape: {}'.format(C.shape))
+    def __init__(self, path):
+        self.path = path
+        if is_hdf5(path):
+            self.store = h5py.File(path, 'r')
+        else:
+            self.store = None
 
-        idx = np.random.permutation(X.shape[0])
+    def arrays(self, split):
+        if self.store is not None:
+            group = self.store[split]
+            return group['X'], group['C']
+        return (
+            np.load(os.path.join(self.path, split, 'X.npy'), mmap_mode='r'),
+            np.load(os.path.join(self.path, split, 'C.npy'), mmap_mode='r')
+        )
 
-        group.create_dataset(
-            'X',
-            X.shape,
-            maxshape=X.shape,
-            dtype=np.float32,
-            chunks=(512, 7),
-            compression='lzf'
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+
+class StoreWriter:
+    """Write access to the splits of an hdf5 or memmap store."""
+
+    def __init__(self, path):
+        self.path = path
+        if is_hdf5(path):
+            self.store = h5py.File(path, 'w')
+        else:
+            self.store = None
+            os.makedirs(path, exist_ok=True)
+
+    def create(self, split, x_shape, c_shape):
+        if self.store is not None:
+            group = self.store.create_group(split)
+            group.create_dataset(
+                'X',
+                x_shape,
+                maxshape=x_shape,
+                dtype=np.float32,
+                chunks=(512,) + x_shape[1:],
+                compression='lzf'
+            )
+            group.create_dataset(
+                'C',
+                c_shape,
+                maxshape=c_shape,
+                dtype=np.float32,
+                chunks=(512,) + c_shape[1:],
+                compression='lzf'
+            )
+            return group['X'], group['C']
+
+        split_dir = os.path.join(self.path, split)
+        os.makedirs(split_dir, exist_ok=True)
+        X = np.lib.format.open_memmap(
+            os.path.join(split_dir, 'X.npy'), mode='w+',
+            dtype=np.float32, shape=x_shape
         )
-        group['X'][:, :] = X[idx, :]
-
-        group.create_dataset(
-            'C',
-            C.shape,
-            maxshape=C.shape,
-            dtype=np.float32,
-            chunks=(512, 7, 7),
-            compression='lzf'
+        C = np.lib.format.open_memmap(
+            os.path.join(split_dir, 'C.npy'), mode='w+',
+            dtype=np.float32, shape=c_shape
         )
-        group['C'][:, :, :] = C[idx, :, :]
+        return X, C
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+
+def scatter_to_buckets(X, C, n_buckets, chunk_rows, bucket_dir):
+    """Stream rows into randomly chosen bucket files, returning their sizes."""
+    x_files = [
+        open(os.path.join(bucket_dir, 'X_{}.bin'.format(b)), 'wb')
+        for b in range(n_buckets)
+    ]
+    c_files = [
+        open(os.path.join(bucket_dir, 'C_{}.bin'.format(b)), 'wb')
+        for b in range(n_buckets)
+    ]
+    counts = np.zeros(n_buckets, dtype=np.int64)
+
+    try:
+        for start in range(0, X.shape[0], chunk_rows):
+            stop = min(start + chunk_rows, X.shape[0])
+            X_chunk = np.asarray(X[start:stop], dtype=np.float32)
+            C_chunk = np.asarray(C[start:stop], dtype=np.float32)
+
+            buckets = np.random.randint(n_buckets, size=stop - start)
+            order = np.argsort(buckets, kind='stable')
+            sizes = np.bincount(buckets, minlength=n_buckets)
+            offsets = np.concatenate(([0], np.cumsum(sizes)))
+
+            X_chunk = X_chunk[order]
+            C_chunk = C_chunk[order]
+
+            for b in np.flatnonzero(sizes):
+                X_chunk[offsets[b]:offsets[b + 1]].tofile(x_files[b])
+                C_chunk[offsets[b]:offsets[b + 1]].tofile(c_files[b])
+
+            counts += sizes
+    finally:
+        for f in x_files + c_files:
+            f.close()
+
+    return counts
+
+
+def gather_from_buckets(X_out, C_out, counts, bucket_dir):
+    """Permute each bucket in memory and append it to the output."""
+    x_row = X_out.shape[1:]
+    c_row = C_out.shape[1:]
+
+    offset = 0
+    for b, count in enumerate(counts):
+        if count == 0:
+            continue
+        x_path = os.path.join(bucket_dir, 'X_{}.bin'.format(b))
+        c_path = os.path.join(bucket_dir, 'C_{}.bin'.format(b))
+
+        X_b = np.fromfile(x_path, dtype=np.float32).reshape((-1,) + x_row)
+        C_b = np.fromfile(c_path, dtype=np.float32).reshape((-1,) + c_row)
+
+        idx = np.random.permutation(count)
+        X_out[offset:offset + count] = X_b[idx]
+        C_out[offset:offset + count] = C_b[idx]
+        offset += count
+
+        del X_b, C_b
+        os.remove(x_path)
+        os.remove(c_path)
+
+
+def shuffle_store(store_in, store_out, max_memory=2048, tmp_dir=None):
+    """
+    Create a shuffled copy of dataset.
+
+    max_memory is the approximate memory budget in MB. Rows are streamed in
+    chunks of at most this size and the number of buckets is chosen so that
+    the expected bucket size is half of it, leaving headroom for the
+    permutation copy.
+    """
+    reader = StoreReader(store_in)
+    writer = StoreWriter(store_out)
+    budget = int(max_memory * 2**20)
+
+    try:
+        for d in SPLITS:
+
+            print('Shuffling {}'.format(d))
+
+            X, C = reader.arrays(d)
+
+            print('X shape: {}'.format(X.shape))
+            print('C shape: {}'.format(C.shape))
+
+            row_bytes = 4 * (
+                int(np.prod(X.shape[1:])) + int(np.prod(C.shape[1:]))
+            )
+            chunk_rows = max(1, budget // (2 * row_bytes))
+            n_buckets = max(
+                1, math.ceil(2 * X.shape[0] * row_bytes / budget)
+            )
+
+            print('Using {} buckets'.format(n_buckets))
+
+            bucket_dir = tempfile.mkdtemp(dir=tmp_dir)
+            try:
+                counts = scatter_to_buckets(
+                    X, C, n_buckets, chunk_rows, bucket_dir
+                )
+                X_out, C_out = writer.create(d, X.shape, C.shape)
+                gather_from_buckets(X_out, C_out, counts, bucket_dir)
+
+                if isinstance(X_out, np.memmap):
+                    X_out.flush()
+                    C_out.flush()
+            finally:
+                shutil.rmtree(bucket_dir, ignore_errors=True)
+    finally:
+        reader.close()
+        writer.close()
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('hdf5_in')
-    parser.add_argument('hdf5_out')
+    parser.add_argument(
+        '--max-memory', type=int, default=2048,
+        help='Approximate memory budget in MB'
+    )
+    parser.add_argument(
+        '--tmp-dir', default=None,
+        help='Directory for the temporary bucket files'
+    )
+    parser.add_argument('store_in')
+    parser.add_argument('store_out')
 
     args = parser.parse_args()
-    shuffle_store(args.hdf5_in, args.hdf5_out)
+    shuffle_store(
+        args.store_in,
+        args.store_out,
+        max_memory=args.max_memory,
+        tmp_dir=args.tmp_dir
+    )
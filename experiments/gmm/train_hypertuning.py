@@ -19,12 +19,11 @@ from deconv.utils.make_2d_toy_noise_covar import covar_gen
 from deconv.utils.compute_2d_log_likelihood import compute_data_ll
 from deconv.utils.misc import get_logger
 from deconv.flow.svi_no_mdn import SVIFlowToy, SVIFlowToyNoise
-from deconv.gmm.data import DeconvDataset
+from deconv.gmm.data import SharedDeconvDataset
 from sklearn.datasets import load_boston
 from deconv.utils.make_2d_toy_data import data_gen
 from deconv.utils.make_2d_toy_noise_covar import covar_gen
 from deconv.gmm.sgd_deconv_gmm_tim import SGDDeconvGMM
-from deconv.gmm.data import DeconvDataset
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--data', type=str, default='boston',
@@ -93,22 +92,18 @@ def main():
 
     best_eval = np.zeros((n_combs, 5))
 
+    dataset = SharedDeconvDataset(train_data, covar)
+
     counter = 0
     for lr, K in product(lr_list, K_list):
         logger.info((lr, K))
 
         for i, (train_index, eval_index) in enumerate(kf.split(train_data)):
-            X_train, X_eval = train_data[train_index], train_data[eval_index]
-            train_covars = np.repeat(
-                covar[np.newaxis, :, :], X_train.shape[0], axis=0)
-            eval_covars = np.repeat(
-                covar[np.newaxis, :, :], X_eval.shape[0], axis=0)
-
-            train_dataset = DeconvDataset(X_train, train_covars)
+            train_dataset = dataset.subset(train_index)
             train_loader = DataLoader(
                 train_dataset, batch_size=args.batch_size, shuffle=True)
 
-            eval_dataset = DeconvDataset(X_eval, eval_covars)
+            eval_dataset = dataset.subset(eval_index)
             eval_loader = DataLoader(
                 eval_dataset, batch_size=args.batch_size, shuffle=False)
 